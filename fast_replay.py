@@ -0,0 +1,1044 @@
+import sys
+import struct
+import collections
+
+from construct import *
+from construct.expr import Path
+from construct.core import BitwisableString
+from construct.lib import HexDisplayedInteger
+
+from replay import *
+
+# Alternative decoding engine for Replay, selected with Replay.parse(data, engine="fast")
+#
+# Walking the construct tree costs a Python call (and a fresh context Container) for every If and
+# every byte of every CString. Instead, this module compiles the very same Struct definitions from
+# replay.py into plain Python functions built on struct.unpack_from, once, at import time (the skipping,
+# raw and NumPy variants on first use). Field names, None-for-absent fields, FlagsEnum masks and lookup
+# side effects all match the construct path, so schema changes in replay.py are picked up automatically.
+# Anything the compiler doesn't understand raises instead of silently decoding differently.
+#
+# Run this file on a replay to check both engines still agree:  python fast_replay.py some.rep
+
+
+_new_container = Container.__new__
+_set_keys_order = Container.__dict__["__keys_order__"].__set__
+_dict_init = dict.__init__
+
+_U32 = struct.Struct("<I")
+
+
+def _mkc(keys, values):
+    # Container() goes through __setitem__ for every key, this doesn't
+    c = _new_container(Container)
+    _set_keys_order(c, keys[:])
+    _dict_init(c, zip(keys, values))
+    return c
+
+
+def _mkrc(keys, values):
+    c = _new_container(RawContainer)
+    _set_keys_order(c, keys[:])
+    _dict_init(c, zip(keys, values))
+    return c
+
+
+def _mkpr(keys, values, lifetimes):
+    # A ParsedReplay, see Replay.parse(lifetimes=True)
+    c = _new_container(ParsedReplay)
+    _set_keys_order(c, keys[:])
+    _dict_init(c, zip(keys, values))
+    object.__setattr__(c, "lifetimes", lifetimes)
+    return c
+
+
+class FlagsContainer(Container):
+    # FlagsEnum results are shared between every mask with the same value (there are dozens of masks per
+    # entity, allocating them was most of the decode time), so they can't be edited in place.
+    # Assign a new Container instead: entity.fields.m2 = Container(entity.fields.m2)(x1=False)
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("masks decoded by fast_replay are shared, replace them instead of editing them")
+
+    __setitem__ = __delitem__ = update = pop = popitem = clear = _readonly
+
+    def __reduce__(self):
+        # Unpickle back to the same shared instance instead of a copy
+        return (_sharedFlags, _FLAGS_IDS[id(self)])
+
+
+_FLAGS_TABLES = {} # {tuple(flags.items()): table}
+_FLAGS_IDS = {} # {id(FlagsContainer): (tuple(flags.items()), value)}
+
+
+def _sharedFlags(key, b):
+    return _FLAGS_TABLES[key][b]
+
+
+def _flags(flags):
+    # All 256 possible FlagsEnum results for this set of flags, same layout as FlagsEnum._decode
+    key = tuple(flags.items())
+
+    if key in _FLAGS_TABLES:
+        return _FLAGS_TABLES[key]
+
+    keys = ["_flagsenum"] + [BitwisableString(name) for name in flags]
+    table = []
+
+    for b in range(256):
+        c = _new_container(FlagsContainer)
+        _set_keys_order(c, keys[:])
+        _dict_init(c, zip(keys, [True] + [b & v == v for v in flags.values()]))
+        table.append(c)
+        _FLAGS_IDS[id(c)] = (key, b)
+
+    _FLAGS_TABLES[key] = table
+
+    return table
+
+
+def _mkctx(up, keys, values):
+    # Only used for Computed lambdas and other expressions we couldn't compile
+    ctx = Container(zip(keys, values))
+    ctx._ = up
+    return ctx
+
+
+def _computed(func, ctx):
+    return func(ctx) if callable(func) else func
+
+
+def _path(expr):
+    # Turn this.a.b.c into ["a", "b", "c"]
+    class Probe:
+        def __init__(self, keys):
+            self.keys = keys
+
+        def __getitem__(self, key):
+            return Probe(self.keys + [key])
+
+    return expr(Probe([])).keys
+
+
+class _Compiler:
+    # With skip=True the compiled functions only walk over the bytes and return (None, off). Masks, counts
+    # and plain numbers are still read since later fields may depend on them, everything that would
+    # allocate (Containers, strings, HexBytes, lists) is stepped over.
+    # With raw=True they return RawContainers and RawListContainers instead, see decode_tick(raw=True).
+    # With numpy=True PackedArrays become NumPy arrays, see decode_tick(numpy=True).
+    def __init__(self, skip=False, raw=False, numpy=False):
+        self.skip = skip
+        self.numpy = numpy
+        self.ns = {
+            "_mkc": _mkrc if raw else _mkc,
+            "_mkctx": _mkctx,
+            "HexDisplayedInteger": HexDisplayedInteger,
+            "_computed": _computed,
+            "ListContainer": RawListContainer if raw else ListContainer,
+            "StreamError": StreamError,
+            "_frombuffer": _frombuffer,
+        }
+        self.cache = {}
+        self.counter = 0
+        self.needs_up = set()
+
+        self.locals = []  # (name, var) of every field decoded so far
+        self.masks = {}  # name -> var holding the raw mask byte
+        self.up_masks = set()
+
+    def name(self, prefix):
+        self.counter += 1
+        return "_%s%d" % (prefix, self.counter)
+
+    def const(self, value, prefix="k"):
+        name = self.name(prefix)
+        self.ns[name] = value
+        return name
+
+    def flat_format(self, sc):
+        # Format string for Structs made exclusively of unconditional FormatFields (Vector3, Face, ...)
+        if not isinstance(sc, Struct):
+            return None
+
+        fmt = "<"
+        for sub in sc.subcons:
+            if not sub.name or not isinstance(sub.subcon, FormatField) or sub.parsed is not None:
+                return None
+
+            fmt += sub.subcon.fmtstr.lstrip("<")
+
+        return fmt
+
+    def struct(self, sc):
+        # Compile a Struct into "def f(buf, off, up, upm) -> (Container, off)"
+        # up is the enclosing Container (for `this._` lookups), upm its masks as plain ints
+        if id(sc) in self.cache:
+            return self.cache[id(sc)]
+
+        fname = self.name("struct")
+        self.cache[id(sc)] = fname
+
+        self.locals = []
+        self.masks = {}
+        self.up_masks = set()
+
+        body = []
+        group = None  # [mask, vars, lines] for a run of fields that all hang off the same mask
+        for sub in sc.subcons:
+            if not sub.name:
+                raise NotImplementedError("fast_replay can't compile unnamed subcons")
+
+            if sub.parsed is not None:
+                raise NotImplementedError("fast_replay can't compile parse hooks inside %s" % fname)
+
+            var = "v%d" % len(self.locals)
+            mask = self.mask_of(sub.subcon)
+
+            if group is not None and group[0] != mask:
+                body += self.group(*group)
+                group = None
+
+            if mask is None:
+                body += self.emit(sub.subcon, var, 1)
+            else:
+                if group is None:
+                    group = [mask, [], []]
+
+                group[1].append(var)
+                group[2] += self.emit(sub.subcon, var, 2)
+
+            self.locals.append((sub.name, var))
+
+            if self.is_mask(sub.subcon):
+                self.masks[sub.name] = var + "_m"
+
+        if group is not None:
+            body += self.group(*group)
+
+        keys = self.const([name for name, var in self.locals])
+        values = ", ".join(var for name, var in self.locals)
+
+        lines = ["def %s(buf, off, up, upm):" % fname]
+        lines += ["    %s = upm[%r]" % (self.up_mask_var(name), name) for name in sorted(self.up_masks)]
+        lines += body
+        if self.skip:
+            lines.append("    return None, off")
+        else:
+            lines.append("    return _mkc(%s, (%s,)), off" % (keys, values))
+
+        exec("\n".join(lines), self.ns)
+
+        if self.up_masks or "up," in "\n".join(body):
+            self.needs_up.add(fname)
+
+        return fname
+
+    def mask_of(self, sc):
+        # Most masks are 0 most of the time, so fields behind the same mask get skipped as a block
+        if not isinstance(sc, IfThenElse) or sc.elsesubcon is not Pass or not isinstance(sc.condfunc, Path):
+            return None
+
+        keys = _path(sc.condfunc)
+
+        if len(keys) == 3 and keys[0] == "_":
+            self.up_masks.add(keys[1])
+            return self.up_mask_var(keys[1])
+
+        if len(keys) == 2 and keys[0] in self.masks:
+            return self.masks[keys[0]]
+
+        return None
+
+    def group(self, mask, vars, lines):
+        return ["    if %s:" % mask] + lines + ["    else:", "        %s = None" % " = ".join(vars)]
+
+    def up_mask_var(self, name):
+        return "up_" + name
+
+    def is_mask(self, sc):
+        while isinstance(sc, IfThenElse):
+            sc = sc.thensubcon
+
+        return isinstance(sc, FlagsEnum)
+
+    def cond(self, condfunc):
+        if isinstance(condfunc, bool):
+            return repr(condfunc)
+
+        if not isinstance(condfunc, Path):
+            return "_computed(%s, %s)" % (self.const(condfunc, "f"), self.ctx())
+
+        keys = _path(condfunc)
+
+        if len(keys) == 3 and keys[0] == "_":  # this._.m1.x2
+            self.up_masks.add(keys[1])
+            return "(%s & %d)" % (self.up_mask_var(keys[1]), self.bit(keys[2]))
+
+        if len(keys) == 2 and keys[0] in self.masks:  # this.m2.x1
+            return "(%s & %d)" % (self.masks[keys[0]], self.bit(keys[1]))
+
+        if len(keys) == 1:  # this.includeFields
+            return self.local(keys[0])
+
+        raise NotImplementedError("fast_replay can't compile condition %r" % condfunc)
+
+    def bit(self, flag):
+        return Mask8.flags[flag]
+
+    def local(self, name):
+        for local_name, var in self.locals:
+            if local_name == name:
+                return var
+
+        raise NotImplementedError("fast_replay can't find field %r" % name)
+
+    def ctx(self):
+        keys = self.const([name for name, var in self.locals])
+        values = "".join(var + ", " for name, var in self.locals)
+        return "_mkctx(up, %s, (%s))" % (keys, values)
+
+    def count(self, count):
+        if isinstance(count, int):
+            return str(count)
+
+        if isinstance(count, Path) and len(_path(count)) == 1:
+            return self.local(_path(count)[0])
+
+        return "_computed(%s, %s)" % (self.const(count, "f"), self.ctx())
+
+    def emit(self, sc, var, lvl):
+        p = "    " * lvl
+
+        if isinstance(sc, Renamed):
+            if sc.parsed is not None:
+                raise NotImplementedError("fast_replay can't compile parse hooks inside structs")
+
+            return self.emit(sc.subcon, var, lvl)
+
+        if isinstance(sc, IfThenElse):
+            return ([p + "if %s:" % self.cond(sc.condfunc)] + self.emit(sc.thensubcon, var, lvl + 1) +
+                    [p + "else:"] + self.emit(sc.elsesubcon, var, lvl + 1))
+
+        if sc is Pass:
+            return [p + "%s = None" % var]
+
+        if sc is Flag:
+            return [p + "%s = buf[off] != 0" % var, p + "off += 1"]
+
+        if sc is Bool8:
+            # ByteSwapped(Aligned(4, Flag)), so the flag is the last of the 4 bytes
+            return [p + "%s = buf[off + 3] != 0" % var, p + "off += 4"]
+
+        if isinstance(sc, FormatField):
+            if sc.fmtstr[1:] == "B":
+                return [p + "%s = buf[off]" % var, p + "off += 1"]
+
+            packer = self.const(struct.Struct(sc.fmtstr), "s")
+            return [p + "%s, = %s.unpack_from(buf, off)" % (var, packer), p + "off += %d" % sc.length]
+
+        if isinstance(sc, FlagsEnum):
+            if sc.subcon.fmtstr[1:] != "B":
+                raise NotImplementedError("fast_replay only compiles 8 bit FlagsEnums")
+
+            return [p + "%s_m = buf[off]" % var,
+                    p + "%s = %s[%s_m]" % (var, self.const(_flags(sc.flags)), var),
+                    p + "off += 1"]
+
+        if isinstance(sc, Hex) and isinstance(sc.subcon, BytesInteger):
+            n = sc.subcon.length
+            if not isinstance(n, int) or sc.subcon.signed or sc.subcon.swapped:
+                raise NotImplementedError("fast_replay only compiles fixed size, unsigned, big endian HexBytes")
+
+            if self.skip:
+                return [p + "%s = None" % var, p + "off += %d" % n]
+
+            if n == 1:
+                value = "buf[off]"
+            elif n in (2, 4, 8):
+                value = "%s.unpack_from(buf, off)[0]" % self.const(struct.Struct(">" + " HI Q"[n // 2]), "s")
+            else:
+                value = "int.from_bytes(buf[off:off + %d], 'big')" % n
+
+            return [p + "%s = HexDisplayedInteger(%s)" % (var, value),
+                    p + "%s.fmtstr = %r" % (var, "0%dX" % (2 * n)),
+                    p + "off += %d" % n]
+
+        if isinstance(sc, StringEncoded):
+            enc = sc.encoding
+
+            if isinstance(sc.subcon, NullTerminated) and sc.subcon.subcon is GreedyBytes:  # CString
+                return [p + "end = buf.find(b'\\x00', off)",
+                        p + "if end < 0:",
+                        p + "    raise StreamError('unterminated CString')",
+                        p + ("%s = None" % var if self.skip else "%s = buf[off:end].decode(%r)" % (var, enc)),
+                        p + "off = end + 1"]
+
+            if isinstance(sc.subcon, FixedSized) and isinstance(sc.subcon.subcon, NullStripped):  # PaddedString
+                n = sc.subcon.length
+                if self.skip:
+                    return [p + "%s = None" % var, p + "off += %d" % n]
+
+                return [p + "%s = buf[off:off + %d].rstrip(b'\\x00').decode(%r)" % (var, n, enc),
+                        p + "off += %d" % n]
+
+            raise NotImplementedError("fast_replay can't compile string %r" % sc)
+
+        if isinstance(sc, Computed):
+            if isinstance(sc.func, Path) and len(_path(sc.func)) == 1:
+                return [p + "%s = %s" % (var, self.local(_path(sc.func)[0]))]
+
+            return [p + "%s = _computed(%s, %s)" % (var, self.const(sc.func, "f"), self.ctx())]
+
+        if isinstance(sc, Array):
+            return self.emit_array(sc, var, lvl)
+
+        if isinstance(sc, Switch):
+            keyfunc = sc.keyfunc
+            if not isinstance(keyfunc, Path) or len(_path(keyfunc)) != 1:
+                raise NotImplementedError("fast_replay can't compile switch on %r" % keyfunc)
+
+            if sc.default is not Pass:
+                raise NotImplementedError("fast_replay only compiles switches defaulting to Pass")
+
+            cases = self.const({k: self.ns[self.nested_call(case)] for k, case in sc.cases.items()}, "switch")
+
+            return [p + "fn = %s.get(%s)" % (cases, self.local(_path(keyfunc)[0])),
+                    p + "if fn is None:",
+                    p + "    %s = None" % var,
+                    p + "else:",
+                    p + "    %s, off = fn(buf, off, None, None)" % var]
+
+        if isinstance(sc, Struct):
+            fmt = self.flat_format(sc)
+            if fmt is not None:
+                packer = struct.Struct(fmt)
+                keys = [sub.name for sub in sc.subcons]
+
+                if self.skip:
+                    return [p + "%s = None" % var, p + "off += %d" % packer.size]
+
+                return [p + "%s = _mkc(%s, %s.unpack_from(buf, off))" % (var, self.const(keys), self.const(packer, "s")),
+                        p + "off += %d" % packer.size]
+
+            return [p + "%s, off = %s(buf, off, None, None)" % (var, self.nested_call(sc))]
+
+        raise NotImplementedError("fast_replay can't compile %r" % sc)
+
+    def emit_array(self, sc, var, lvl):
+        p = "    " * lvl
+        n = self.count(sc.count)
+        sub = sc.subcon
+
+        if self.skip:
+            size = sub.length if isinstance(sub, FormatField) else struct.calcsize(self.flat_format(sub) or "")
+
+            if size:
+                return [p + "%s = None" % var, p + "off += %s * %d" % (n, size)]
+
+            return ([p + "%s = None" % var, p + "for i in range(%s):" % n] +
+                    self.emit(sub, "item_" + var, lvl + 1))
+
+        if self.numpy and isinstance(sc, PackedArray):
+            dtype = _numpyDtype(sc)
+            return [p + "count = %s" % n,
+                    p + "%s = _frombuffer(buf, %s, count, off)" % (var, self.const(dtype, "dt")),
+                    p + "off += count * %d" % dtype.itemsize]
+
+        if isinstance(sub, FormatField) and sub.fmtstr[1:] == "B":
+            return [p + "count = %s" % n,
+                    p + "%s = ListContainer(buf[off:off + count])" % var,
+                    p + "off += count"]
+
+        fmt = self.flat_format(sub)
+        if fmt is not None:
+            packer = struct.Struct(fmt)
+            keys = self.const([s.name for s in sub.subcons])
+            return [p + "count = %s" % n,
+                    p + "end = off + count * %d" % packer.size,
+                    p + "%s = ListContainer([_mkc(%s, t) for t in %s.iter_unpack(buf[off:end])])" % (var, keys, self.const(packer, "s")),
+                    p + "off = end"]
+
+        item = "item_" + var
+        lines = [p + "%s = ListContainer()" % var,
+                 p + "for i in range(%s):" % n]
+        lines += self.emit(sub, item, lvl + 1)
+        lines.append(p + "    %s.append(%s)" % (var, item))
+
+        return lines
+
+    def nested(self, sc):
+        # Compiling a nested Struct clobbers the per-struct state, so save and restore it
+        if isinstance(sc, Renamed):
+            if sc.parsed is not None:
+                raise NotImplementedError("fast_replay can't compile parse hooks inside structs")
+
+            sc = sc.subcon
+
+        state = (self.locals, self.masks, self.up_masks)
+        fname = self.struct(sc)
+        self.locals, self.masks, self.up_masks = state
+
+        return fname
+
+    def nested_call(self, sc):
+        # Nested structs are called without an enclosing Container, so they can't look at `this._`
+        fname = self.nested(sc)
+
+        if fname in self.needs_up:
+            raise NotImplementedError("fast_replay can't compile nested structs that use this._")
+
+        return fname
+
+
+def _numpyDtype(sc):
+    # (n, 3) float32 for a PackedArray of Vector3 comes from a subarray dtype
+    import numpy as np
+
+    return np.dtype((sc.dtype, sc.shape)) if sc.shape else np.dtype(sc.dtype)
+
+
+def _frombuffer(buf, dtype, count, off):
+    # Arrays share the memory of bytes. Anything else (bytearray, mmap) is copied, since a NumPy view
+    # would stop it from being resized or closed.
+    import numpy as np
+
+    array = np.frombuffer(buf, dtype, count, off)
+
+    return array if type(buf) is bytes else array.copy()
+
+
+def _compile(sc, compiler=None):
+    # Parse hooks on top level structs (registerPrefab, registerPrefabSubEntities) are replicated by hand
+    compiler = compiler or _COMPILER
+
+    if isinstance(sc, Renamed):
+        sc = sc.subcon
+
+    return compiler.ns[compiler.nested(sc)]
+
+
+_COMPILER = _Compiler()
+
+_HEADER = _compile(ReplayHeader)
+_PREFAB = _compile(Prefab)
+_BRUSH = _compile(Brush)
+
+# Entity is compiled one entityType at a time, the entity header and lookup hooks are handled by hand below
+_ENTITY_CASES = Entity.fields.subcon.thensubcon.cases
+_ENTITY_FIELDS = {k: _compile(case) for k, case in _ENTITY_CASES.items()}
+
+# The other versions are compiled on first use, so importing this module (which every tool and every
+# pool worker does) only pays for the plain decoders above.
+
+# Skipping versions, for parse(data, entity_types=..., prefabs=False, brushes=False) and scan_tick
+_SKIP_DECODERS = []
+
+
+def _skipDecoders():
+    # [{entityType: fields}, PrefabEntity, Brush]
+    if not _SKIP_DECODERS:
+        compiler = _Compiler(skip=True)
+        _SKIP_DECODERS.extend([{k: _compile(case, compiler) for k, case in _ENTITY_CASES.items()},
+                               _compile(PrefabEntity, compiler), _compile(Brush, compiler)])
+
+    return _SKIP_DECODERS
+
+
+# Edit tracking versions, for parse(data, raw=True)
+_RAW_DECODERS = []
+
+
+def _rawDecoders():
+    # [{entityType: fields}, Prefab, Brush]
+    if not _RAW_DECODERS:
+        compiler = _Compiler(raw=True)
+        _RAW_DECODERS.extend([{k: _compile(case, compiler) for k, case in _ENTITY_CASES.items()},
+                              _compile(Prefab, compiler), _compile(Brush, compiler)])
+
+    return _RAW_DECODERS
+
+
+# NumPy versions, for parse(data, numpy=True). Also keeps NumPy optional.
+_NUMPY_DECODERS = []
+
+
+def _numpyDecoders():
+    if not _NUMPY_DECODERS:
+        compiler = _Compiler(numpy=True)
+        _NUMPY_DECODERS.extend([_compile(Prefab, compiler), _compile(Brush, compiler)])
+
+    return _NUMPY_DECODERS
+
+
+_ENT_KEYS = ["id", "destroy"]
+_ENTITY_KEYS = ["ent", "m1", "entityType", "entityTypeS", "fields"]
+_CHUNK_KEYS = {"prefabs": ["amount", "prefabs"], "entities": ["amount", "entities"], "brushes": ["amount", "brushes"]}
+_TICK_KEYS = ["timecode", "prefabChunks", "entityChunks", "brushChunks"]
+_REPLAY_KEYS = ["header", "ticks"]
+
+_MASKS = _flags(Mask8.flags)
+
+# Stand-in for the entity Container that the skipping field decoders get as `up`, Computed fields only
+# ever look at its m1
+_SKIP_UP = [_mkc(["m1"], (mask,)) for mask in _MASKS]
+
+
+class PrefabEntityType:
+    # Stand-in for PrefabEntity in lookups.prefabs when the prefab itself wasn't decoded,
+    # registerPrefabSubEntities only ever looks at entityType8
+    __slots__ = ["entityType8"]
+
+    def __init__(self, entityType8):
+        self.entityType8 = entityType8
+
+
+def decode_entity(buf, off, lookups, entity_types=None):
+    # With entity_types, entities of any other type are stepped over and returned as None.
+    # Lookups are updated either way.
+    raw, = _U32.unpack_from(buf, off)
+    off += 4
+
+    entity_id = raw >> 1
+    destroy = raw & 1
+
+    if destroy:
+        entity_type = lookups.entities.pop(entity_id)
+
+        if entity_types is not None and entity_type not in entity_types:
+            return None, off
+
+        return _mkc(_ENTITY_KEYS, (_mkc(_ENT_KEYS, (entity_id, destroy)), None, None, None, None)), off
+
+    m1 = buf[off]
+    off += 1
+
+    if m1 & 0x01: # CREATE
+        entity_type = buf[off]
+        off += 1
+
+        lookups.entities[entity_id] = entity_type
+    else:
+        entity_type = lookups.entities[entity_id]
+
+    # Prefab creates are always decoded, registering their sub-entities needs the prefabName
+    if entity_types is not None and entity_type not in entity_types and not (entity_type == 0x15 and m1 & 0x01):
+        skip_fields = _skipDecoders()[0].get(entity_type)
+
+        if skip_fields is not None:
+            fields, off = skip_fields(buf, off, _SKIP_UP[m1], {"m1": m1})
+
+        return None, off
+
+    entity = _mkc(_ENTITY_KEYS, (_mkc(_ENT_KEYS, (entity_id, destroy)), _MASKS[m1],
+                                 entity_type, ENTITY_TYPES[entity_type], None))
+
+    decode_fields = _ENTITY_FIELDS.get(entity_type)
+    if decode_fields is not None:
+        fields, off = decode_fields(buf, off, entity, {"m1": m1})
+        entity["fields"] = fields
+
+        if entity_type == 0x15 and m1 & 0x01: # Prefab, see registerPrefabSubEntities
+            index = entity_id + 1
+
+            for prefab_entity in lookups.prefabs[fields.prefabName]:
+                lookups.entities[index] = prefab_entity.entityType8
+                index += 1
+
+            if entity_types is not None and entity_type not in entity_types:
+                return None, off
+
+    return entity, off
+
+
+def decode_entity_raw(buf, off, lookups):
+    # decode_entity, but into RawContainers that remember the entity's bytes, see RawSpan
+    start = off
+    raw, = _U32.unpack_from(buf, off)
+    off += 4
+
+    entity_id = raw >> 1
+    destroy = raw & 1
+
+    if destroy:
+        lookups.entities.pop(entity_id)
+
+        entity = _mkrc(_ENTITY_KEYS, (_mkrc(_ENT_KEYS, (entity_id, destroy)), None, None, None, None))
+        _attach(entity, RawSpan(buf, start, off))
+
+        return entity, off
+
+    m1 = buf[off]
+    off += 1
+
+    if m1 & 0x01: # CREATE
+        entity_type = buf[off]
+        off += 1
+
+        lookups.entities[entity_id] = entity_type
+    else:
+        entity_type = lookups.entities[entity_id]
+
+    entity = _mkrc(_ENTITY_KEYS, (_mkrc(_ENT_KEYS, (entity_id, destroy)), _MASKS[m1],
+                                  entity_type, ENTITY_TYPES[entity_type], None))
+
+    decode_fields = _rawDecoders()[0].get(entity_type)
+    if decode_fields is not None:
+        fields, off = decode_fields(buf, off, entity, {"m1": m1})
+        dict.__setitem__(entity, "fields", fields)
+
+        if entity_type == 0x15 and m1 & 0x01: # Prefab, see registerPrefabSubEntities
+            index = entity_id + 1
+
+            for prefab_entity in lookups.prefabs[fields.prefabName]:
+                lookups.entities[index] = prefab_entity.entityType8
+                index += 1
+
+    _attach(entity, RawSpan(buf, start, off))
+
+    return entity, off
+
+
+def _attach(obj, span):
+    # Point every RawContainer / RawListContainer in obj at span. Entities met while attaching a tick
+    # already have their own span, which becomes a child of the tick's.
+    own = obj.__dict__.get("_span")
+
+    if own is not None:
+        own.parent = span
+        return
+
+    obj.__dict__["_span"] = span
+
+    for value in (dict.values(obj) if type(obj) is RawContainer else obj):
+        if type(value) is RawContainer or type(value) is RawListContainer:
+            _attach(value, span)
+
+
+def decode_prefab(buf, off, lookups):
+    prefab, off = _PREFAB(buf, off, None, None)
+    lookups.prefabs[prefab.prefabName] = prefab.entities
+
+    return prefab, off
+
+
+def skip_prefab(buf, off, lookups):
+    # Steps over a prefab, only keeping the entityType8 of its entities for the lookups
+    name = buf[off + 4:off + 36].rstrip(b"\x00").decode(ENC)
+    num_entities, = _U32.unpack_from(buf, off + 36)
+    off += 40
+
+    prefab_entity_skip = _skipDecoders()[1]
+
+    entities = []
+    for i in range(num_entities):
+        entities.append(PrefabEntityType(buf[off + 4]))
+        unused, off = prefab_entity_skip(buf, off, None, None)
+
+    lookups.prefabs[name] = entities
+
+    return None, off
+
+
+def decode_prefab_raw(buf, off, lookups):
+    prefab, off = _rawDecoders()[1](buf, off, None, None)
+    lookups.prefabs[prefab.prefabName] = prefab.entities
+
+    return prefab, off
+
+
+def decode_prefab_numpy(buf, off, lookups):
+    prefab, off = _numpyDecoders()[0](buf, off, None, None)
+    lookups.prefabs[prefab.prefabName] = prefab.entities
+
+    return prefab, off
+
+
+def decode_brush_numpy(buf, off, lookups=None):
+    return _numpyDecoders()[1](buf, off, None, None)
+
+
+def decode_brush_raw(buf, off, lookups=None):
+    return _rawDecoders()[2](buf, off, None, None)
+
+
+def decode_brush(buf, off, lookups=None):
+    return _BRUSH(buf, off, None, None)
+
+
+def skip_brush(buf, off, lookups=None):
+    return _skipDecoders()[2](buf, off, None, None)
+
+
+def _decode_chunks(buf, off, decode, kind, lookups, mkc=_mkc, mklist=ListContainer):
+    # Items that decode to None (skipped) are left out, so with a projection amount can be more than
+    # len(items)
+    chunks = mklist()
+    keys = _CHUNK_KEYS[kind]
+
+    while True:
+        amount = buf[off]
+        off += 1
+
+        items = mklist()
+        for i in range(amount):
+            item, off = decode(buf, off, lookups)
+
+            if item is not None:
+                list.append(items, item)
+
+        list.append(chunks, mkc(keys, (amount, items)))
+
+        if amount < 0xFF:
+            return chunks, off
+
+
+def decode_tick(buf, off, lookups, entity_types=None, prefabs=True, brushes=True, raw=False, profile=None, numpy=False):
+    # entity_types (a set of entityTypes) and prefabs / brushes = False project the tick, everything
+    # else is stepped over without being decoded. Projected ticks can't be built back into a replay.
+    # raw=True remembers the bytes of the tick and every entity in it, see RawSpan. As long as they
+    # aren't edited, building writes those bytes back instead of encoding them again.
+    # profile (a replay_profile.ParseProfile) is told about every item decoded and how long it took.
+    # numpy=True decodes the vertices, faces and faceTable of brushes and prefab brushes into read-only
+    # NumPy arrays (see replay.PackedArray), replace them instead of editing them. Building takes them back.
+    if raw:
+        return _decodeTickRaw(buf, off, lookups, profile)
+
+    start = off
+    timecode, = _U32.unpack_from(buf, off)
+    off += 4
+
+    if entity_types is None:
+        decode = decode_entity
+    else:
+        decode = lambda buf, off, lookups: decode_entity(buf, off, lookups, entity_types)
+
+    if numpy:
+        decode_prefabs = decode_prefab_numpy if prefabs else skip_prefab
+        decode_brushes = decode_brush_numpy if brushes else skip_brush
+    else:
+        decode_prefabs = decode_prefab if prefabs else skip_prefab
+        decode_brushes = decode_brush if brushes else skip_brush
+
+    if profile is not None:
+        decode_prefabs, decode, decode_brushes = profile.wrap(decode_prefabs, decode, decode_brushes)
+
+    prefab_chunks, off = _decode_chunks(buf, off, decode_prefabs, "prefabs", lookups)
+    entity_chunks, off = _decode_chunks(buf, off, decode, "entities", lookups)
+    brush_chunks, off = _decode_chunks(buf, off, decode_brushes, "brushes", lookups)
+
+    # Slicing doesn't complain about running past the end of the buffer, so check once per tick
+    if off > len(buf):
+        raise StreamError("tick runs past the end of the replay")
+
+    if profile is not None:
+        profile.tick(off - start)
+
+    return _mkc(_TICK_KEYS, (timecode, prefab_chunks, entity_chunks, brush_chunks)), off
+
+
+def _decodeTickRaw(buf, off, lookups, profile=None):
+    start = off
+    timecode, = _U32.unpack_from(buf, off)
+    off += 4
+
+    decode_prefabs, decode, decode_brushes = decode_prefab_raw, decode_entity_raw, decode_brush_raw
+
+    if profile is not None:
+        decode_prefabs, decode, decode_brushes = profile.wrap(decode_prefabs, decode, decode_brushes)
+
+    prefab_chunks, off = _decode_chunks(buf, off, decode_prefabs, "prefabs", lookups, _mkrc, RawListContainer)
+    entity_chunks, off = _decode_chunks(buf, off, decode, "entities", lookups, _mkrc, RawListContainer)
+    brush_chunks, off = _decode_chunks(buf, off, decode_brushes, "brushes", lookups, _mkrc, RawListContainer)
+
+    if off > len(buf):
+        raise StreamError("tick runs past the end of the replay")
+
+    if profile is not None:
+        profile.tick(off - start)
+
+    tick = _mkrc(_TICK_KEYS, (timecode, prefab_chunks, entity_chunks, brush_chunks))
+    _attach(tick, RawSpan(buf, start, off))
+
+    return tick, off
+
+
+_NO_ENTITIES = frozenset()
+
+
+def scan_entity(buf, off, lookups):
+    # Steps over an entity like decode_entity(entity_types=()) does, but returns where it is and what it
+    # is: (start, end, entity id, destroy, create, entityType)
+    raw, = _U32.unpack_from(buf, off)
+    entity_id = raw >> 1
+    destroy = raw & 1
+    create = not destroy and buf[off + 4] & 0x01
+
+    entity_type = buf[off + 5] if create else lookups.entities.get(entity_id)
+
+    unused, end = decode_entity(buf, off, lookups, _NO_ENTITIES)
+
+    return (off, end, entity_id, destroy, create, entity_type), end
+
+
+def scan_brush(buf, off, lookups=None):
+    unused, end = _skipDecoders()[2](buf, off, None, None)
+
+    return (off, end), end
+
+
+def scan_tick(buf, off, lookups):
+    # decode_tick for when only the layout matters: entities and brushes come back as the spans from
+    # scan_entity / scan_brush instead of Containers. Prefabs are still decoded.
+    timecode, = _U32.unpack_from(buf, off)
+    off += 4
+
+    prefab_chunks, off = _decode_chunks(buf, off, decode_prefab, "prefabs", lookups)
+    entity_chunks, off = _decode_chunks(buf, off, scan_entity, "entities", lookups)
+    brush_chunks, off = _decode_chunks(buf, off, scan_brush, "brushes", lookups)
+
+    if off > len(buf):
+        raise StreamError("tick runs past the end of the replay")
+
+    return _mkc(_TICK_KEYS, (timecode, prefab_chunks, entity_chunks, brush_chunks)), off
+
+
+def _layoutChunks(buf, off, decode, kind, lookups, items):
+    # _decode_chunks, but collecting (kind, index, start, end, entity id, entityType) for every item and
+    # ("chunk", ...) for the amount bytes in between
+    index = 0
+
+    while True:
+        amount = buf[off]
+        items.append(("chunk", index, off, off + 1, None, None))
+        off += 1
+
+        for i in range(amount):
+            start = off
+            item, off = decode(buf, off, lookups)
+
+            if kind == "entity":
+                items.append((kind, index, start, off, item[2], item[5]))
+            else:
+                items.append((kind, index, start, off, None, None))
+
+            index += 1
+
+        if amount < 0xFF:
+            return off
+
+
+def tick_layout(buf, off, lookups):
+    # scan_tick as a flat list: every part of the tick at off as (kind, index, start, end, entity id,
+    # entityType), and where it ends. kind is "timecode", "chunk", "prefab", "entity" or "brush".
+    items = [("timecode", 0, off, off + 4, None, None)]
+    off += 4
+
+    off = _layoutChunks(buf, off, decode_prefab, "prefab", lookups, items)
+    off = _layoutChunks(buf, off, scan_entity, "entity", lookups, items)
+    off = _layoutChunks(buf, off, scan_brush, "brush", lookups, items)
+
+    if off > len(buf):
+        raise StreamError("tick runs past the end of the replay")
+
+    return items, off
+
+
+def decode_span(buf, span):
+    # Decode one entity found by scan_entity on its own, with its entityType taken from the span.
+    # Prefab creates decode fine, but their sub-entities aren't registered anywhere.
+    start, end, entity_id, destroy, create, entity_type = span
+    lookups = ReplayLookups({entity_id: entity_type}, collections.defaultdict(list))
+
+    entity, off = decode_entity(buf, start, lookups)
+
+    return entity
+
+
+def decode_header(buf, off=0):
+    header, off = _HEADER(buf, off, None, None)
+
+    if off > len(buf):
+        raise StreamError("header runs past the end of the replay")
+
+    return header, off
+
+
+def parse(data, lookups=None, entity_types=None, prefabs=True, brushes=True, raw=False, profile=None, numpy=False, lifetimes=False):
+    # Works on anything struct.unpack_from can read that also has .find() for CStrings (bytes, bytearray, mmap)
+    # See decode_tick for entity_types, prefabs, brushes, raw, profile and numpy
+    # lifetimes=True adds every tick to an EntityLifetimes as soon as it's decoded, and returns a ParsedReplay
+    if lookups is None:
+        lookups = ReplayLookups()
+
+    if isinstance(data, memoryview):
+        data = data.tobytes()
+
+    header, off = decode_header(data)
+
+    table = EntityLifetimes() if lifetimes else None
+
+    # Same semantics as GreedyRange(Tick): stop at the first tick that fails to decode
+    ticks = ListContainer()
+    while True:
+        try:
+            tick, off = decode_tick(data, off, lookups, entity_types, prefabs, brushes, raw, profile, numpy)
+        except Exception:
+            break
+
+        if table is not None:
+            table.add_tick(len(ticks), tick)
+
+        ticks.append(tick)
+
+    if table is not None:
+        return _mkpr(_REPLAY_KEYS, (header, ticks), table)
+
+    return _mkc(_REPLAY_KEYS, (header, ticks))
+
+
+def _items(tick, kind):
+    chunks, key = {"prefab": ("prefabChunks", "prefabs"), "entity": ("entityChunks", "entities"), "brush": ("brushChunks", "brushes")}[kind]
+    return [item for chunk in tick[chunks] for item in chunk[key]]
+
+
+def compare(data):
+    # Parse with both engines and return a description of the first difference, or None
+    a = Replay.parse(data)
+    b = parse(data)
+
+    if a.header != b.header:
+        return "header differs"
+
+    if len(a.ticks) != len(b.ticks):
+        return "tick count differs: %d (construct) vs %d (fast)" % (len(a.ticks), len(b.ticks))
+
+    for i, (ta, tb) in enumerate(zip(a.ticks, b.ticks)):
+        if ta == tb:
+            continue
+
+        for kind in ["prefab", "entity", "brush"]:
+            for j, (ia, ib) in enumerate(zip(_items(ta, kind), _items(tb, kind))):
+                if ia != ib:
+                    return "tick %d (timecode %d) differs at %s %d:\n%s\n%s" % (i, ta.timecode, kind, j, ia, ib)
+
+        return "tick %d (timecode %d) differs" % (i, ta.timecode)
+
+    return None
+
+
+if __name__ == "__main__":
+    failed = False
+
+    for replay_p in sys.argv[1:]:
+        with open(replay_p, "rb") as replay_f:
+            replay_b = replay_f.read()
+
+        diff = compare(replay_b)
+
+        if diff is None:
+            print(replay_p, "OK")
+        else:
+            print(replay_p, "MISMATCH", diff)
+            failed = True
+
+    sys.exit(1 if failed else 0)
@@ -5,6 +5,8 @@ import sys
 import collections.abc
 
 from replay import *
+from replay_cache import iter_replay_cached
+from replay_profile import ParseProfile
 
 
 def print_to_file(p, replay):
@@ -16,6 +18,24 @@ def print_to_file(p, replay):
     print("Done!")
 
 
+def print_stream_to_file(p, header, ticks):
+    # Same output as print_to_file, but consumes ticks one at a time instead of needing the whole replay
+    with open(p, "w+") as sys.stdout:
+        print("header")
+        print_good(header, 1)
+
+        print("ticks")
+        for i, tick in enumerate(ticks):
+            if i != 0:
+                print()
+
+            print_good(tick, 1)
+
+    sys.stdout = sys.__stdout__
+
+    print("Done!")
+
+
 def print_good(root, lvl=0):
     prefix = "\t" * lvl
 
@@ -51,6 +71,10 @@ def print_good(root, lvl=0):
 if __name__ == "__main__":
     print("Make sure to avoid spaces in your file paths!")
 
+    # --profile also prints where the replay's bytes and parse time went, see replay_profile.py
+    profile = ParseProfile() if "--profile" in sys.argv else None
+    sys.argv = [arg for arg in sys.argv if arg != "--profile"]
+
     if len(sys.argv) == 2:
         replay_p = sys.argv[1]
     else:
@@ -60,12 +84,17 @@ if __name__ == "__main__":
 
     print("Parsing", replay_p)
 
-    with open(replay_p, "rb") as replay_f:
-        replay_b = bytearray(replay_f.read())
-
-    replay = Replay.parse(replay_b)
+    if profile is not None:
+        # The cache would skip parsing altogether
+        header, ticks = iter_replay(replay_p, engine="fast", profile=profile)
+    else:
+        header, ticks = iter_replay_cached(replay_p)
 
     dump_p = os.path.splitext(replay_p)[0] + ".txt"
     print("Dumping to", dump_p)
 
-    print_to_file(dump_p, replay)
+    print_stream_to_file(dump_p, header, ticks)
+
+    if profile is not None:
+        print()
+        profile.print()
@@ -2,7 +2,7 @@ import os
 import re
 import sys
 
-import copy
+import array
 import datetime
 
 import collections.abc
@@ -18,9 +18,6 @@ codecs.register_error("strict", codecs.ignore_errors)
 ENC = "ascii"
 ENC_2 = "utf-8"
 
-ENTITY_LOOKUP = {}
-PREFAB_LOOKUP = {}
-
 ENTITY_TYPES = {
     0x00: "WorldSpawn",
     0x01: "PlayerSpawn",
@@ -81,6 +78,44 @@ InputMask = FlagsEnum(Byte, fwd=0x01, back=0x02, left=0x04, right=0x08, jump=0x1
 Bool8 = ByteSwapped(Aligned(4, Flag))
 
 
+_NUMPY_CODES = {"B": "u1", "b": "i1", "H": "u2", "h": "i2", "I": "u4", "i": "i4", "f": "f4"}
+
+
+class PackedArray(Array):
+    # Array of fixed size items that Replay.parse(engine="fast", numpy=True) decodes into a NumPy array
+    # instead of a list of Containers: Structs whose fields are all the same type (Vector3) become an
+    # (n, fields) array, other Structs (Face) a structured array, and plain numbers a 1-D array.
+    # Building takes either form, NumPy arrays are written straight from their bytes.
+    def __init__(self, count, subcon):
+        super().__init__(count, subcon)
+
+        if isinstance(subcon, Struct):
+            fields = [(sub.name, "<" + _NUMPY_CODES[sub.subcon.fmtstr[-1]]) for sub in subcon.subcons]
+        else:
+            fields = [(None, "<" + _NUMPY_CODES[subcon.fmtstr[-1]])]
+
+        if len(fields) > 1 and len(set(code for name, code in fields)) > 1:
+            self.dtype = fields
+            self.shape = ()
+        else:
+            self.dtype = fields[0][1]
+            self.shape = (len(fields),) if isinstance(subcon, Struct) else ()
+
+    def _build(self, obj, stream, context, path):
+        if not hasattr(obj, "dtype"):
+            return Array._build(self, obj, stream, context, path)
+
+        count = self.count(context) if callable(self.count) else self.count
+
+        if obj.shape != (count,) + self.shape:
+            raise RangeError("expected an array of shape %r, found %r" % ((count,) + self.shape, obj.shape), path=path)
+
+        data = obj.astype(self.dtype, copy=False).tobytes()
+        stream_write(stream, data, len(data), path)
+
+        return obj
+
+
 Vector2 = Struct(
     "x" / Float32l,
     "y" / Float32l
@@ -136,9 +171,9 @@ PrefabBrush = Struct(
     "lenMaterialArrayBytes" / Int32ul,
     "unknown1" / Int32ul, # TODO: This might be boundEntityIdDivBy2
     "unknown2" / Int32sl,
-    "vertices" / Array(this.numVertices, Vector3),
-    "faces" / Array(this.numFaces, Face),
-    "faceTable" / Array(this.numEntriesFaceTable, Int8ul),
+    "vertices" / PackedArray(this.numVertices, Vector3),
+    "faces" / PackedArray(this.numFaces, Face),
+    "faceTable" / PackedArray(this.numEntriesFaceTable, Int8ul),
     "materials" / Array(this.lenMaterialColorArrays, CString(ENC)),
     "colors" / Array(this.lenMaterialColorArrays, ColorXRGB32l),
 )
@@ -154,9 +189,9 @@ Brush = Struct(
     "lenMaterialArrayBytes" / Int32ul,
     "entityIdAttachedTo" / Int32ul,
     "unknown2" / Int32sl,
-    "vertices" / Array(this.numVertices, Vector3),
-    "faces" / Array(this.numFaces, Face),
-    "faceTable" / Array(this.numEntriesFaceTable, Int8ul),
+    "vertices" / PackedArray(this.numVertices, Vector3),
+    "faces" / PackedArray(this.numFaces, Face),
+    "faceTable" / PackedArray(this.numEntriesFaceTable, Int8ul),
     "materials" / Array(this.lenMaterialColorArrays, CString(ENC)),
     "colors" / Array(this.lenMaterialColorArrays, ColorXRGB32l),
 )
@@ -408,10 +443,137 @@ PrefabEntity = Struct( # A lot of shortcuts taken here, but I don't wanna bother
 )
 
 
-def registerPrefab(type, ctx):
-    global PREFAB_LOOKUP
+class ReplayLookups:
+    # Entity and prefab types seen so far while parsing (or building) one replay. Updates don't carry
+    # their entityType, so it has to be remembered from the create. Every parse gets its own instance,
+    # passed down as Replay.parse(data, lookups=...) and reachable from the hooks as ctx._params.lookups
+    def __init__(self, entities=None, prefabs=None):
+        self.entities = {} if entities is None else entities # {entity id: entityType}
+        self.prefabs = {} if prefabs is None else prefabs # {prefabName: [PrefabEntity, ...]}
+
+    def copy(self):
+        return ReplayLookups(dict(self.entities), dict(self.prefabs))
+
+    def restore(self, other):
+        # Roll back to an earlier copy() in place, so references to .entities / .prefabs stay valid
+        self.entities.clear()
+        self.entities.update(other.entities)
+        self.prefabs.clear()
+        self.prefabs.update(other.prefabs)
+
+
+class RawSpan:
+    # Where a Tick or Entity decoded with raw=True came from, and whether anything in it was edited since.
+    # Editing an entity marks the tick it was decoded in as well.
+    __slots__ = ["buf", "start", "end", "parent", "dirty"]
+
+    def __init__(self, buf, start, end, parent=None):
+        self.buf = buf
+        self.start = start
+        self.end = end
+        self.parent = parent
+        self.dirty = False
+
+    def raw(self):
+        return bytes(self.buf[self.start:self.end])
+
+    def touch(self):
+        span = self
+
+        while span is not None and not span.dirty:
+            span.dirty = True
+            span = span.parent
+
+
+def _touch(obj):
+    span = obj.__dict__.get("_span")
+
+    if span is not None:
+        span.touch()
+
+
+def cleanSpan(obj):
+    # The RawSpan obj can be written back from, or None if it has to be built
+    if type(obj) is not RawContainer:
+        return None
 
-    PREFAB_LOOKUP[type.prefabName] = type.entities
+    span = obj.__dict__.get("_span")
+
+    return None if span is None or span.dirty else span
+
+
+class RawContainer(Container):
+    # Containers (and lists) decoded with raw=True, see fast_replay. Every edit marks their RawSpan dirty.
+    # Copies and pickles are plain Containers again.
+    def __setitem__(self, key, value):
+        _touch(self)
+        Container.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        _touch(self)
+        Container.__delitem__(self, key)
+
+    def clear(self):
+        _touch(self)
+        Container.clear(self)
+
+    def pop(self, key):
+        _touch(self)
+        return Container.pop(self, key)
+
+    def popitem(self):
+        _touch(self)
+        return Container.popitem(self)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+
+        return self[key]
+
+    def __reduce__(self):
+        return (Container, (list(self.items()),))
+
+
+class RawListContainer(ListContainer):
+    def sort(self, *args, **kwargs):
+        _touch(self)
+        ListContainer.sort(self, *args, **kwargs)
+
+    def __reduce__(self):
+        return (ListContainer, (list(self),))
+
+
+def _listEdit(name):
+    method = getattr(ListContainer, name)
+
+    def edit(self, *args):
+        _touch(self)
+        return method(self, *args)
+
+    return edit
+
+
+for _name in ["__setitem__", "__delitem__", "__iadd__", "__imul__", "append", "extend", "insert", "pop", "remove", "clear", "reverse"]:
+    setattr(RawListContainer, _name, _listEdit(_name))
+
+
+class RawStruct(Struct):
+    # Struct that writes objects decoded with raw=True back as their original bytes, as long as they
+    # weren't edited. Used for Tick and Entity.
+    def _build(self, obj, stream, context, path):
+        span = cleanSpan(obj)
+
+        if span is None:
+            return Struct._build(self, obj, stream, context, path)
+
+        stream_write(stream, span.raw(), span.end - span.start, path)
+
+        return obj
+
+
+def registerPrefab(type, ctx):
+    ctx._params.lookups.prefabs[type.prefabName] = type.entities
 
 
 Prefab = Struct(
@@ -423,41 +585,34 @@ Prefab = Struct(
 
 
 def checkEntityDestroy(type, ctx):
-    global ENTITY_LOOKUP
-
     if type.destroy:
-        del ENTITY_LOOKUP[type.id]
+        del ctx._params.lookups.entities[type.id]
 
 
 def checkEntityCreate(type, ctx):
-    global ENTITY_LOOKUP
-
     if ctx.m1.x1: # CREATE
         # print("REGISTER ENT", ctx.ent.id)
-        ENTITY_LOOKUP[ctx.ent.id] = type
+        ctx._params.lookups.entities[ctx.ent.id] = type
 
 
 def lookupEntity(ctx):
-    global ENTITY_LOOKUP
-
-    return ENTITY_LOOKUP[ctx.ent.id]
+    return ctx._params.lookups.entities[ctx.ent.id]
 
 
 def registerPrefabSubEntities(type, ctx):
-    global PREFAB_LOOKUP
-
     # Check that prefab's m1 has 0x01 - CREATE
     if not ctx.m1.x1:
         return
 
+    lookups = ctx._params.lookups
     index = ctx.ent.id + 1
 
-    for entity in PREFAB_LOOKUP[type.prefabName]:
-        ENTITY_LOOKUP[index] = entity.entityType8
+    for entity in lookups.prefabs[type.prefabName]:
+        lookups.entities[index] = entity.entityType8
         index += 1
 
 
-Entity = Struct(
+Entity = RawStruct(
     "ent" / ByteSwapped(BitStruct(
         "id" / BitsInteger(31),
         "destroy" / Bit,
@@ -1436,7 +1591,7 @@ TickBrushChunk = Struct(
 )
 
 
-Tick = Struct(
+Tick = RawStruct(
     "timecode" / Int32ul, # HEY YOU! THIS HAS TO STAY INT32UL BECAUSE allEntities() and other
                           # functions depend on comparing against this value!
     "prefabChunks" / RepeatUntil(lambda obj, lst, ctx: obj.amount < 0xFF, TickPrefabChunk),
@@ -1470,7 +1625,87 @@ ReplayHeader = Struct(
 )
 
 
-Replay = Struct(
+def _checkProjection(engine, entity_types, prefabs, brushes, raw=False, profile=None, numpy=False, lifetimes=False):
+    if engine != "fast" and (entity_types is not None or not prefabs or not brushes):
+        raise ValueError("entity_types, prefabs and brushes are only supported by engine=\"fast\"")
+
+    if numpy and engine != "fast":
+        raise ValueError("numpy is only supported by engine=\"fast\"")
+
+    if numpy and raw:
+        raise ValueError("raw can't be combined with numpy")
+
+    if profile is not None and engine != "fast":
+        raise ValueError("profile is only supported by engine=\"fast\"")
+
+    if raw and engine != "fast":
+        raise ValueError("raw is only supported by engine=\"fast\"")
+
+    if raw and (entity_types is not None or not prefabs or not brushes):
+        raise ValueError("raw can't be combined with entity_types, prefabs or brushes")
+
+    if lifetimes and (entity_types is not None or not prefabs):
+        raise ValueError("lifetimes can't be combined with entity_types or prefabs")
+
+
+class ParsedReplay(Container):
+    # What Replay.parse(data, lifetimes=True) returns: the same Container as always, plus its EntityLifetimes
+    # as replay.lifetimes. That's an attribute rather than a key, so building, comparing and printing the
+    # replay don't see it. The fast engine fills the table in while decoding, construct right after.
+    def __init__(self, *args, lifetimes=None, **entrieskw):
+        Container.__init__(self, *args, **entrieskw)
+        object.__setattr__(self, "lifetimes", lifetimes)
+
+
+class ReplayStruct(Struct):
+    # Replay.parse(data, engine="fast") decodes with fast_replay instead of walking the construct tree
+    # entity_types / prefabs / brushes only decode part of every tick, see fast_replay.decode_tick
+    # raw=True keeps the original bytes around, so build() only encodes the ticks and entities that were edited
+    # profile=ParseProfile() counts where the bytes and decode time go, see replay_profile.py
+    # numpy=True decodes brush geometry into NumPy arrays, see PackedArray and fast_replay.decode_tick
+    # lifetimes=True also fills in an EntityLifetimes and returns a ParsedReplay, see entityLifetimes
+    def parse(self, data, engine="construct", lookups=None, entity_types=None, prefabs=True, brushes=True, raw=False, profile=None, numpy=False, lifetimes=False, **contextkw):
+        if lookups is None:
+            lookups = ReplayLookups()
+
+        _checkProjection(engine, entity_types, prefabs, brushes, raw, profile, numpy, lifetimes)
+
+        if engine == "fast":
+            import fast_replay
+
+            return fast_replay.parse(data, lookups, entity_types, prefabs, brushes, raw, profile, numpy, lifetimes)
+
+        if engine != "construct":
+            raise ValueError("Unknown engine %r, expected \"construct\" or \"fast\"" % engine)
+
+        replay = Struct.parse(self, data, lookups=lookups, **contextkw)
+
+        if lifetimes:
+            # GreedyRange has no hook between ticks, so this is a second walk
+            return ParsedReplay(replay, lifetimes=EntityLifetimes(replay.ticks))
+
+        return replay
+
+    def parse_stream(self, stream, **contextkw):
+        if contextkw.get("lookups") is None:
+            contextkw["lookups"] = ReplayLookups()
+
+        return Struct.parse_stream(self, stream, **contextkw)
+
+    def build_stream(self, obj, stream, **contextkw):
+        if contextkw.get("lookups") is None:
+            contextkw["lookups"] = prepareLookups(obj)
+
+        return Struct.build_stream(self, obj, stream, **contextkw)
+
+    def open(self, replay_p, engine="fast"):
+        # Random access by timecode through a .repidx sidecar, see replay_index.py
+        import replay_index
+
+        return replay_index.ReplayFile(replay_p, engine)
+
+
+Replay = ReplayStruct(
     "header" / ReplayHeader,
     "ticks" / GreedyRange(Tick)
 )
@@ -1506,21 +1741,39 @@ def allBrushes(replay, after=0):
                 yield tick.timecode, brush
 
 
-def allInitialEntities(replay):
-    for chunk in replay.ticks[0].entityChunks:
-        for entity in chunk.entities:
-            if not entity.ent.destroy and entity.m1.x1:
-                yield entity
+def allInitialEntities(replay, lifetimes=None):
+    # Only the first tick matters, so without lifetimes (see entityLifetimes) that's all that's walked
+    if lifetimes is None:
+        lifetimes = parsedLifetimes(replay)
+
+    if lifetimes is None:
+        lifetimes = EntityLifetimes(replay.ticks[:1])
+
+    return iter(lifetimes.initial_entities())
+
+
+# Fields that hold the ID of another entity, per entityType. Brushes have entityIdAttachedTo as well.
+ENTITY_REFERENCE_FIELDS = {
+    0x04: ["spawnedByEntityId"], # Projectiles
+    0x05: ["spawnedByEntityId"],
+    0x06: ["spawnedByEntityId"],
+    0x07: ["spawnedByEntityId"],
+    0x08: ["spawnedByEntityId"],
+    0x0E: ["senderId"], # ChatMessage
+    0x0F: ["entityIdAttachedTo"], # CameraPath
+    0x10: ["creatorId"], # Vote
+    0x11: ["senderId", "receiverId"], # Damage
+}
 
 
 def refactorChangeEntityIdsRaw(changes, entities, brushes):
     # Change all references to this entity ID to the new one
     # This includes entity creation, updates, attachedTos, damage entities, votes, chatmessages, projectiles, brushes, etc.
     for tc, entity in entities:
-        if entity.ent.id in changes.keys():
-            prev_id = copy.deepcopy(entity.ent.id)
+        prev_id = entity.ent.id
 
-            entity.ent.id = changes[entity.ent.id]
+        if prev_id in changes:
+            entity.ent.id = changes[prev_id]
 
             if entity.entityType == 0x15: # Prefab
                 diff = prev_id - entity.ent.id
@@ -1528,76 +1781,488 @@ def refactorChangeEntityIdsRaw(changes, entities, brushes):
                 entity.fields.nextSubEntityId = entity.ent.id + 1
                 entity.fields.nextNormalEntityId -= diff
 
-        if entity.entityType in [0x04, 0x05, 0x06, 0x07, 0x08] and entity.fields.spawnedByEntityId in changes.keys():
-            entity.fields.spawnedByEntityId = changes[entity.fields.spawnedByEntityId]
+        for field in ENTITY_REFERENCE_FIELDS.get(entity.entityType, ()):
+            if entity.fields[field] in changes:
+                entity.fields[field] = changes[entity.fields[field]]
 
-        if entity.entityType == 0x0E and entity.fields.senderId in changes.keys():
-            entity.fields.senderId = changes[entity.fields.senderId]
+    for tc, brush in brushes:
+        if brush.entityIdAttachedTo in changes:
+            brush.entityIdAttachedTo = changes[brush.entityIdAttachedTo]
 
-        if entity.entityType == 0x0F and entity.fields.entityIdAttachedTo in changes.keys():
-            entity.fields.entityIdAttachedTo = changes[entity.fields.entityIdAttachedTo]
 
-        if entity.entityType == 0x10 and entity.fields.creatorId in changes.keys():
-            entity.fields.creatorId = changes[entity.fields.creatorId]
+class EntityReferences:
+    # Every place an entity ID shows up: the entities themselves (ent.id), the fields in
+    # ENTITY_REFERENCE_FIELDS and brushes' entityIdAttachedTo. Built with one pass over the replay,
+    # after that change_ids only touches the records that mention the changed IDs.
+    def __init__(self, entities=(), brushes=()):
+        self.entities = collections.defaultdict(list) # {id: [Entity, ...]}
+        self.references = collections.defaultdict(list) # {id: [(Container, field), ...]}
 
-        if entity.entityType == 0x11:
-            if entity.fields.senderId in changes.keys():
-                entity.fields.senderId = changes[entity.fields.senderId]
+        for tc, entity in entities:
+            self.entities[entity.ent.id].append(entity)
 
-            if entity.fields.receiverId in changes.keys():
-                entity.fields.receiverId = changes[entity.fields.receiverId]
+            for field in ENTITY_REFERENCE_FIELDS.get(entity.entityType, []):
+                if entity.fields[field] is not None:
+                    self.references[entity.fields[field]].append((entity.fields, field))
 
-    for tc, brush in brushes:
-        if brush.entityIdAttachedTo in changes.keys():
-            brush.entityIdAttachedTo = changes[brush.entityIdAttachedTo]
+        for tc, brush in brushes:
+            self.references[brush.entityIdAttachedTo].append((brush, "entityIdAttachedTo"))
+
+    def change_ids(self, changes):
+        # Same as refactorChangeEntityIdsRaw, every ID is changed at most once even if changes
+        # maps it on to yet another ID (or swaps IDs)
+        entities = {id: self.entities.pop(id) for id in changes.keys() if id in self.entities}
+        references = {id: self.references.pop(id) for id in changes.keys() if id in self.references}
+
+        for prev_id, id in changes.items():
+            for entity in entities.get(prev_id, []):
+                entity.ent.id = id
+
+                if entity.entityType == 0x15: # Prefab
+                    diff = prev_id - id
+
+                    entity.fields.nextSubEntityId = id + 1
+                    entity.fields.nextNormalEntityId -= diff
+
+            for container, field in references.get(prev_id, []):
+                container[field] = id
 
+            self.entities[id] += entities.get(prev_id, [])
+            self.references[id] += references.get(prev_id, [])
 
-def refactorChangeEntityIds(changes, replay, after=0):
+
+def entityReferences(replay, after=0):
+    # The EntityReferences of replay's ticks after `after`
+    return EntityReferences(allEntities(replay, after), allBrushes(replay, after))
+
+
+def refactorChangeEntityIds(changes, replay, after=0, references=None):
     # Change all references to this entity ID to the new one
     # This includes entity creation, updates, attachedTos, damage entities, votes, chatmessages, projectiles, brushes, etc.
-    refactorChangeEntityIdsRaw(changes, list(allEntities(replay, after)), list(allBrushes(replay, after)))
+    # On its own that's one pass over the replay per call, without building an index that would be thrown away.
+    # To remap the same replay several times, build entityReferences(replay, after) once and pass it every time:
+    # each call then only touches the records that mention the changed IDs. It stays up to date with the changes
+    # made through it, but not with other edits to the replay.
+    if references is None:
+        refactorChangeEntityIdsRaw(changes, allEntities(replay, after), allBrushes(replay, after))
+    else:
+        references.change_ids(changes)
+
+
+NEVER = 0xFFFFFFFF # EntityLifetimes timecode for "not in this replay"
+UNKNOWN_TYPE = 0xFF
+
+
+class EntityLifetimes:
+    # One row per entity lifetime (IDs get reused after a destroy), in the order they were created,
+    # as array columns:
+    #   ids
+    #   types           entityType, UNKNOWN_TYPE if neither a create nor an update was ever seen
+    #   created         timecode of the create, NEVER if it's not in the replay
+    #   destroyed       timecode of the destroy, NEVER if it's not in the replay
+    #   created_tick    index of the tick with the create, -1 if it's not in the replay
+    #   updates         number of updates
+    #   prefab_span     number of sub-entities for prefabs (0x15), their IDs follow the prefab's
+    # Prefab sub-entities get rows of their own, created along with their prefab. creates[row] is the
+    # Entity that created the row, None for prefab sub-entities.
+    def __init__(self, ticks=()):
+        self.ids = array.array("I")
+        self.types = array.array("B")
+        self.created = array.array("I")
+        self.destroyed = array.array("I")
+        self.created_tick = array.array("i")
+        self.updates = array.array("I")
+        self.prefab_span = array.array("I")
+        self.creates = []
+
+        self.by_id = collections.defaultdict(list) # {id: [row, ...]}
+        self.live = {} # {id: row} of entities that haven't been destroyed (yet)
+        self.prefabs = {} # {prefabName: [PrefabEntity, ...]}
+        self.referenced = {} # {id: None} in the order getReferencedEntityIds finds them, see referenced_ids
+
+        for index, tick in enumerate(ticks):
+            self.add_tick(index, tick)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _add(self, id, entity_type, timecode, tick_index, entity):
+        row = len(self.ids)
+
+        self.ids.append(id)
+        self.types.append(UNKNOWN_TYPE if entity_type is None else entity_type)
+        self.created.append(timecode)
+        self.destroyed.append(NEVER)
+        self.created_tick.append(tick_index)
+        self.updates.append(0)
+        self.prefab_span.append(0)
+        self.creates.append(entity)
+
+        self.by_id[id].append(row)
+        self.live[id] = row
+
+        return row
+
+    def add_tick(self, index, tick):
+        # Like allEntities(after=0), references only count in ticks with a timecode above 0
+        referencing = tick.timecode > 0
 
+        for chunk in tick.prefabChunks:
+            for prefab in chunk.prefabs:
+                self.prefabs[prefab.prefabName] = prefab.entities
 
-def getReferencedEntityIds(replay):
-    # Keep track of recipient entities that will be referenced by packets later on
-    ids = []
+        for chunk in tick.entityChunks:
+            for entity in chunk.entities:
+                id = entity.ent.id
 
-    for tc,ent in allEntities(replay):
-        # Don't keep WorldSpawn, it will always be replaced by the donor
-        if ent.entityType == 0x00:
-            continue
+                # Updates and destroys of anything but WorldSpawn, and every cameraPath create
+                if referencing and entity.entityType != 0x00 and (entity.ent.destroy or not entity.m1.x1 or entity.entityType == 0x0F):
+                    self.referenced[id] = None
+
+                if entity.ent.destroy:
+                    row = self.live.pop(id, None)
+
+                    if row is None:
+                        row = self._add(id, None, NEVER, -1, None)
+                        del self.live[id]
+
+                    self.destroyed[row] = tick.timecode
+
+                elif entity.m1.x1: # CREATE
+                    row = self._add(id, entity.entityType, tick.timecode, index, entity)
+
+                    if entity.entityType == 0x15: # Prefab, see registerPrefabSubEntities
+                        prefab_entities = self.prefabs.get(entity.fields.prefabName, [])
+                        self.prefab_span[row] = len(prefab_entities)
+
+                        for i, prefab_entity in enumerate(prefab_entities):
+                            self._add(id + 1 + i, prefab_entity.entityType8, tick.timecode, index, None)
+
+                else:
+                    row = self.live.get(id)
+
+                    if row is None:
+                        row = self._add(id, entity.entityType, NEVER, -1, None)
+
+                    self.updates[row] += 1
+
+    def rows(self, id):
+        return self.by_id.get(id, [])
 
-        if ent.ent.destroy or not ent.m1.x1:
-            ids.append(ent.ent.id)
+    def initial_entities(self):
+        # The creates in the first tick
+        return [self.creates[row] for row in range(len(self.ids)) if self.created_tick[row] == 0 and self.creates[row] is not None]
 
-        # Also look out for references through other entities, such as cameraPath
-        # For now, just keep cameraPath at all costs
-        elif ent.entityType == 0x0F:
-            ids.append(ent.ent.id)
+    def initial_entity(self, id):
+        for row in self.rows(id):
+            if self.created_tick[row] == 0 and self.creates[row] is not None:
+                return self.creates[row]
 
-    # Remove duplicates
-    ids = list(dict.fromkeys(ids))
+        return None
 
-    return ids
+    def creates_after(self, timecode):
+        # [(id, entityType, prefabName or None), ...] of every create after timecode, in order
+        return [(self.ids[row], self.types[row], self.creates[row].fields.prefabName if self.types[row] == 0x15 else None)
+                for row in range(len(self.ids)) if self.creates[row] is not None and self.created[row] > timecode]
 
+    def referenced_ids(self):
+        # IDs that are updated or destroyed, plus every cameraPath, in ticks with a timecode above 0
+        return list(self.referenced)
 
-def getEntity(id, replay):
-    for chunk in replay.ticks[0].entityChunks:
-        for entity in chunk:
-            if entity.ent.id == id and not entity.ent.destroy and entity.m1.x1:
-                return entity
+
+def parsedLifetimes(replay):
+    # The EntityLifetimes Replay.parse(..., lifetimes=True) filled in, or None
+    return replay.lifetimes if isinstance(replay, ParsedReplay) else None
+
+
+def entityLifetimes(replay):
+    # The EntityLifetimes of replay: the one filled in while parsing with lifetimes=True, or else a new one
+    # from one walk over the ticks. The helpers below use the parsed one by themselves and take any other as
+    # lifetimes=. Either is a snapshot, edit the replay and build one again with EntityLifetimes(replay.ticks).
+    lifetimes = parsedLifetimes(replay)
+
+    return EntityLifetimes(replay.ticks) if lifetimes is None else lifetimes
+
+
+def getReferencedEntityIds(replay, lifetimes=None):
+    # Keep track of recipient entities that will be referenced by packets later on
+    # WorldSpawn isn't kept, it will always be replaced by the donor. References through other entities,
+    # such as cameraPath, aren't followed, cameraPath is just kept at all costs.
+    if lifetimes is None:
+        lifetimes = entityLifetimes(replay)
+
+    return lifetimes.referenced_ids()
+
+
+def getEntity(id, replay, lifetimes=None):
+    if lifetimes is None:
+        lifetimes = parsedLifetimes(replay)
+
+    if lifetimes is None:
+        lifetimes = EntityLifetimes(replay.ticks[:1])
+
+    return lifetimes.initial_entity(id)
 
 
 def prepareLookups(replay):
-    global ENTITY_LOOKUP
+    lookups = ReplayLookups()
 
-    for tc, entity in allEntities(replay):
-        if not entity.ent.destroy and entity.m1.x1:
-            ENTITY_LOOKUP[entity.ent.id] = entity.entityType
+    for tick in replay.ticks:
+        registerTick(lookups, tick)
+
+    return lookups
+
+
+def registerTick(lookups, tick):
+    # What building needs to know about a tick's prefabs and creates for the ticks after it
+    for chunk in tick.prefabChunks:
+        for prefab in chunk.prefabs:
+            lookups.prefabs[prefab.prefabName] = prefab.entities
+
+    for chunk in tick.entityChunks:
+        for entity in chunk.entities:
+            if entity.ent.destroy or not entity.m1.x1:
+                continue
+
+            lookups.entities[entity.ent.id] = entity.entityType
+
+            # Updates to a prefab's sub-entities need their types too, see registerPrefabSubEntities
+            if entity.entityType == 0x15 and entity.fields.prefabName in lookups.prefabs:
+                for i, prefab_entity in enumerate(lookups.prefabs[entity.fields.prefabName]):
+                    lookups.entities[entity.ent.id + 1 + i] = prefab_entity.entityType8
 
 
 def build(rep: Replay):
     # Construct does not call process hooks while building, how nice :)
-    prepareLookups(rep)
+    return Replay.build(rep, lookups=prepareLookups(rep))
+
+
+def _open(f, mode="rb"):
+    # Accept both paths and already opened binary files
+    if isinstance(f, (str, bytes, os.PathLike)):
+        return open(f, mode), True
+
+    return f, False
+
+
+def _iterTicksConstruct(f, lookups):
+    while True:
+        # Same semantics as GreedyRange(Tick): stop at the first tick that fails to parse
+        try:
+            tick = Tick.parse_stream(f, lookups=lookups)
+        except Exception:
+            return
+
+        yield tick
+
+
+def _iterTicksFast(f, lookups, entity_types=None, prefabs=True, brushes=True, raw=False, profile=None, numpy=False):
+    import fast_replay
+
+    buf = b""
+    off = 0
+    want = 1 << 16
+    eof = False
+
+    while True:
+        if len(buf) - off < want and not eof:
+            more = f.read(max(want, 1 << 16))
+            eof = len(more) == 0
+            buf = buf[off:] + more
+            off = 0
+
+        # A tick that runs past the end of the buffer fails halfway, after it already touched the lookups
+        saved = lookups.copy()
+
+        try:
+            tick, off = fast_replay.decode_tick(buf, off, lookups, entity_types, prefabs, brushes, raw, profile, numpy)
+        except Exception:
+            if eof:
+                return
+
+            lookups.restore(saved)
+
+            want *= 2
+            continue
+
+        yield tick
+
+
+def iter_replay(f, engine="construct", lookups=None, entity_types=None, prefabs=True, brushes=True, raw=False, profile=None, numpy=False):
+    # Returns (header, ticks) where ticks is a generator that parses one Tick at a time off the file,
+    # so memory use is bounded by the largest tick instead of the whole replay.
+    # lookups (a ReplayLookups) is kept up to date as ticks are consumed, just like Replay.parse.
+    if engine not in ["construct", "fast"]:
+        raise ValueError("Unknown engine %r, expected \"construct\" or \"fast\"" % engine)
+
+    _checkProjection(engine, entity_types, prefabs, brushes, raw, profile, numpy)
+
+    if lookups is None:
+        lookups = ReplayLookups()
+
+    f, close = _open(f)
+
+    try:
+        if engine == "fast":
+            import fast_replay
+
+            header, size = fast_replay.decode_header(f.read(ReplayHeader.sizeof()))
+        else:
+            header = ReplayHeader.parse_stream(f)
+    except Exception:
+        if close:
+            f.close()
+
+        raise
+
+    def ticks():
+        try:
+            if engine == "fast":
+                yield from _iterTicksFast(f, lookups, entity_types, prefabs, brushes, raw, profile, numpy)
+            else:
+                yield from _iterTicksConstruct(f, lookups)
+        finally:
+            if close:
+                f.close()
+
+    return header, ticks()
+
+
+def iter_ticks(f, engine="construct", lookups=None, entity_types=None, prefabs=True, brushes=True, raw=False, profile=None, numpy=False):
+    header, ticks = iter_replay(f, engine, lookups, entity_types, prefabs, brushes, raw, profile, numpy)
+
+    yield from ticks
+
+
+_CHUNKS = {"prefabs": "prefabChunks", "entities": "entityChunks", "brushes": "brushChunks"}
+
+
+def makeChunks(items, kind):
+    # Split a list of prefabs / entities / brushes into Tick*Chunks of at most 0xFF items. A full chunk
+    # means another one follows, so an exact multiple of 0xFF (and an empty list) ends with an empty chunk.
+    items = list(items)
+
+    return ListContainer(Container(amount=len(items[i:i + 0xFF]), **{kind: ListContainer(items[i:i + 0xFF])})
+                         for i in range(0, len(items) + 1, 0xFF))
+
+
+def tickItems(tick, kind):
+    # Every prefab / entity / brush in a tick, across all of its chunks
+    return [item for chunk in tick[_CHUNKS[kind]] for item in chunk[kind]]
+
+
+class ReplayWriter:
+    # Writes a replay to a file one tick at a time, the counterpart to iter_replay:
+    #
+    #   header, ticks = iter_replay("in.rep", engine="fast", raw=True)
+    #
+    #   with ReplayWriter("out.rep", header) as writer:
+    #       for tick in ticks:
+    #           writer.write_tick(tick)
+    #
+    # Only the lookups are kept from one tick to the next, so memory use doesn't grow with the replay.
+    # Ticks are chunked again on the way out, so their chunks don't have to be right, only their items.
+    def __init__(self, f, header, lookups=None):
+        self.f, self.close_f = _open(f, "wb")
+        self.lookups = ReplayLookups() if lookups is None else lookups
+        self.num_ticks = 0
+
+        self.f.write(ReplayHeader.build(header))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, timecode, prefabs=(), entities=(), brushes=()):
+        # Write one tick made of plain lists of Prefabs, Entities and Brushes
+        self._writeTick(Container(timecode=timecode, prefabChunks=makeChunks(prefabs, "prefabs"),
+                                  entityChunks=makeChunks(entities, "entities"), brushChunks=makeChunks(brushes, "brushes")))
+
+    def write_tick(self, tick):
+        # Unedited ticks from Replay.parse(raw=True) / iter_replay(raw=True) are copied as they are
+        if cleanSpan(tick) is None:
+            self.write(tick.timecode, tickItems(tick, "prefabs"), tickItems(tick, "entities"), tickItems(tick, "brushes"))
+        else:
+            self._writeTick(tick)
+
+    def _writeTick(self, tick):
+        registerTick(self.lookups, tick)
+
+        self.f.write(Tick.build(tick, lookups=self.lookups))
+        self.num_ticks += 1
+
+    def flush(self):
+        self.f.flush()
+
+    def close(self):
+        if self.close_f:
+            self.f.close()
+        else:
+            self.f.flush()
+
+
+def write_replay(f, replay):
+    # build(), but straight into a file (or path) without holding all of the replay's bytes at once
+    with ReplayWriter(f, replay.header) as writer:
+        for tick in replay.ticks:
+            writer.write_tick(tick)
+
+        return writer.num_ticks
+
+
+HEADER_SIZE = ReplayHeader.sizeof() # 1384, ReplayHeader is fixed size
+
+
+def read_header(f):
+    # Decode only the ReplayHeader, without reading any of the tick data after it
+    import fast_replay
+
+    f, close = _open(f)
+
+    try:
+        header_b = f.read(HEADER_SIZE)
+    finally:
+        if close:
+            f.close()
+
+    if len(header_b) < HEADER_SIZE:
+        raise StreamError("replay is too short for a header: %d bytes" % len(header_b))
+
+    header, size = fast_replay.decode_header(header_b)
+
+    return header
+
+
+def scan_headers(paths):
+    # read_header for many files at once, yields (path, header, error) with either header or error set.
+    # All reads go into the same buffer, and the files are opened unbuffered so nothing past the header
+    # is read, which leaves a directory scan bound by open() and the disk.
+    import fast_replay
+
+    buf = bytearray(HEADER_SIZE)
+
+    for replay_p in paths:
+        try:
+            with open(replay_p, "rb", buffering=0) as replay_f:
+                n = replay_f.readinto(buf)
+
+                # Raw reads may return less than asked for without being at the end of the file
+                while 0 < n < HEADER_SIZE:
+                    more = replay_f.readinto(memoryview(buf)[n:])
+
+                    if not more:
+                        break
+
+                    n += more
+
+            if n < HEADER_SIZE:
+                raise StreamError("replay is too short for a header: %d bytes" % n)
+
+            header, size = fast_replay.decode_header(buf)
+        except Exception as e:
+            yield replay_p, None, "%s: %s" % (type(e).__name__, e)
+            continue
 
-    return Replay.build(rep)
+        yield replay_p, header, None
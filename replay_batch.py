@@ -0,0 +1,184 @@
+import os
+import sys
+import time
+import argparse
+import collections
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from replay import *
+from replay_profile import ParseProfile
+
+# Batch parsing of whole replay directories on a process pool
+#
+#   python replay_batch.py parse DIR --jobs 8
+#   python replay_batch.py parse DIR --profile
+#   python replay_batch.py headers DIR
+#
+# or from Python:
+#
+#   for result in parse_batch(find_replays(DIR), jobs=8, func=countTicks):
+#       ...
+#
+# Work is handed out in chunks of several files per task, so the per-task overhead of the pool
+# (pickling arguments, waking a worker) is paid once per chunk instead of once per file. Results
+# are yielded as soon as their chunk completes, in no particular order.
+#
+# With profile=True every worker parses with a replay_profile.ParseProfile and sends it back in the
+# BatchResult, parse --profile merges them into one report for the whole directory.
+
+BatchResult = collections.namedtuple("BatchResult", ["path", "size", "value", "error", "profile"], defaults=[None])
+
+
+def find_replays(dir_p):
+    # Every .rep file below dir_p, sorted so runs are reproducible
+    paths = []
+
+    for root, dirs, files in os.walk(dir_p):
+        for name in files:
+            if name.lower().endswith(".rep"):
+                paths.append(os.path.join(root, name))
+
+    return sorted(paths)
+
+
+def countTicks(replay):
+    return len(replay.ticks)
+
+
+def _parseOne(replay_p, engine, func, profile=False):
+    try:
+        with open(replay_p, "rb") as replay_f:
+            replay_b = replay_f.read()
+    except OSError as e:
+        return BatchResult(replay_p, 0, None, "%s: %s" % (type(e).__name__, e))
+
+    profile = ParseProfile() if profile else None
+
+    try:
+        replay = Replay.parse(replay_b, engine=engine, profile=profile)
+        value = replay if func is None else func(replay)
+    except Exception as e:
+        # Exceptions don't always survive pickling, send back a description instead
+        return BatchResult(replay_p, len(replay_b), None, "%s: %s" % (type(e).__name__, e))
+
+    return BatchResult(replay_p, len(replay_b), value, None, profile)
+
+
+def _parseChunk(paths, engine, func, profile=False):
+    return [_parseOne(replay_p, engine, func, profile) for replay_p in paths]
+
+
+def map_batch(work, paths, jobs=None, chunksize=None, *args):
+    # Runs work(chunk of paths, *args) on a process pool and yields every result from the lists it
+    # returns, as their chunks complete. work has to be picklable, i.e. a module level function.
+    paths = list(paths)
+    jobs = jobs or os.cpu_count() or 1
+
+    if chunksize is None:
+        # A few chunks per worker keeps them all busy until the end without making chunks tiny
+        chunksize = max(1, min(64, len(paths) // (jobs * 4)))
+
+    chunks = [paths[i:i + chunksize] for i in range(0, len(paths), chunksize)]
+
+    if jobs == 1:
+        for chunk in chunks:
+            yield from work(chunk, *args)
+
+        return
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(work, chunk, *args) for chunk in chunks]
+
+        for future in as_completed(futures):
+            yield from future.result()
+
+
+def parse_batch(paths, jobs=None, chunksize=None, engine="fast", func=None, profile=False):
+    # Parse every replay in paths and yield a BatchResult per file as they complete.
+    # func, if given, runs in the worker on each parsed replay and only its return value is sent back,
+    # which is a lot cheaper than pickling whole replays across processes. It has to be picklable,
+    # i.e. a module level function. profile=True needs engine="fast".
+    return map_batch(_parseChunk, paths, jobs, chunksize, engine, func, profile)
+
+
+def list_headers(dir_p):
+    start = time.perf_counter()
+    num_files = 0
+    num_errors = 0
+
+    for replay_p, header, error in scan_headers(find_replays(dir_p)):
+        num_files += 1
+
+        if error is None:
+            print("\t".join([replay_p, header.szMapTitle, header.szGameMode, header.szHostName, header.epochStartTimeS]))
+        else:
+            print("ERROR", replay_p, error)
+            num_errors += 1
+
+    elapsed = time.perf_counter() - start
+
+    print("%d headers (%d errors) in %.2f s: %.1f files/s" % (num_files, num_errors, elapsed, num_files / elapsed if elapsed else 0))
+
+    return 1 if num_errors else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="replay_batch.py", description="Batch operations on directories of replays")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    parse_p = commands.add_parser("parse", help="Parse every .rep file below DIR")
+    parse_p.add_argument("dir", metavar="DIR")
+    parse_p.add_argument("--jobs", "-j", type=int, default=None, help="Worker processes (default: CPU count)")
+    parse_p.add_argument("--chunksize", type=int, default=None, help="Files per task handed to a worker")
+    parse_p.add_argument("--engine", choices=["construct", "fast"], default="fast")
+    parse_p.add_argument("--profile", action="store_true", help="Print where the bytes and parse time went, over all files")
+
+    headers_p = commands.add_parser("headers", help="List the header of every .rep file below DIR, without parsing ticks")
+    headers_p.add_argument("dir", metavar="DIR")
+
+    args = parser.parse_args(argv)
+
+    if args.command == "headers":
+        return list_headers(args.dir)
+
+    if args.profile and args.engine != "fast":
+        parser.error("--profile needs --engine fast")
+
+    paths = find_replays(args.dir)
+    print("Parsing", len(paths), "replays from", args.dir)
+
+    start = time.perf_counter()
+    num_files = 0
+    num_bytes = 0
+    num_errors = 0
+    profile = ParseProfile() if args.profile else None
+
+    for result in parse_batch(paths, args.jobs, args.chunksize, args.engine, countTicks, args.profile):
+        num_files += 1
+        num_bytes += result.size
+
+        if result.profile is not None:
+            profile.merge(result.profile)
+
+        if result.error is None:
+            print("OK", result.path, result.value, "ticks")
+        else:
+            print("ERROR", result.path, result.error)
+            num_errors += 1
+
+    elapsed = time.perf_counter() - start
+
+    print("%d files (%d errors), %.1f MB in %.2f s: %.1f files/s, %.1f MB/s" % (
+        num_files, num_errors, num_bytes / 1e6, elapsed,
+        num_files / elapsed if elapsed else 0, num_bytes / 1e6 / elapsed if elapsed else 0))
+
+    if profile is not None:
+        print()
+        profile.print()
+
+    return 1 if num_errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,305 @@
+import io
+import os
+import gc
+import sys
+import json
+import time
+import platform
+import argparse
+import tempfile
+import contextlib
+import tracemalloc
+import subprocess
+
+from replay import *
+from replay_generate import ReplayGenerator
+
+from replay_cache import ParseCache
+from transplant import transplant_wrapper
+from print_replay import print_good
+
+# Benchmarks for the parts of the pipeline that see whole replays
+#
+#   python replay_bench.py run --sizes small,medium --out bench.json
+#   python replay_bench.py run --sizes small,medium --baseline bench.json
+#   python replay_bench.py compare new.json bench.json
+#
+# Inputs are synthetic replays from replay_generate.py (generated once and kept in --data-dir), plus any
+# real ones passed with --replay. Every benchmark runs `repeat` times and keeps the fastest wall time, then
+# once more under tracemalloc for its peak memory (Python allocations, so the numbers are comparable
+# between platforms). Setting up a run (parsing the input for build, say) isn't timed.
+#
+# A result is a regression when its wall time or peak memory is more than `threshold` (default 25%)
+# above the baseline's for the same benchmark and input. run --baseline and compare exit with 1 then.
+
+SIZES = {
+    # name: (ReplayGenerator arguments, repeats)
+    "small": (dict(ticks=1000, players=2, projectile_rate=4, brushes=100, prefabs=4), 3),
+    "medium": (dict(ticks=10000, players=8, projectile_rate=20, brushes=1000, prefabs=10), 1),
+    "huge": (dict(ticks=100000, players=16, projectile_rate=40, brushes=5000, prefabs=20), 1),
+}
+
+DONOR = dict(ticks=2, players=1, projectile_rate=0, brushes=200, prefabs=6, seed=1)
+
+DEFAULT_DATA_DIR = os.path.join(tempfile.gettempdir(), "replay_bench")
+DEFAULT_THRESHOLD = 0.25
+
+
+def generated(data_dir, params, seed=0):
+    # Path of a generated replay, generating it first if it isn't there yet
+    params = dict(params, seed=params.get("seed", seed))
+    name = "gen-%(ticks)d-%(players)d-%(projectile_rate)g-%(brushes)d-%(prefabs)d-%(seed)d.rep" % params
+    replay_p = os.path.join(data_dir, name)
+
+    if not os.path.exists(replay_p):
+        os.makedirs(data_dir, exist_ok=True)
+        print("Generating", replay_p, file=sys.stderr)
+
+        ReplayGenerator(**params).write(replay_p + ".tmp")
+        os.replace(replay_p + ".tmp", replay_p)
+
+    return replay_p
+
+
+# Every benchmark is set up with (replay path, replay bytes, donor path) and returns the function to time
+
+def benchParse(replay_p, data, donor_p):
+    return lambda: Replay.parse(data, engine="fast")
+
+
+def benchParseNumpy(replay_p, data, donor_p):
+    return lambda: Replay.parse(data, engine="fast", numpy=True)
+
+
+def benchParseConstruct(replay_p, data, donor_p):
+    return lambda: Replay.parse(data)
+
+
+def benchBuild(replay_p, data, donor_p):
+    replay = Replay.parse(data, engine="fast")
+
+    return lambda: Replay.build(replay)
+
+
+def benchTransplantMode(splice):
+    # Both modes from files to a file, parsing with the fast engine and without the parse cache, so the
+    # numbers are comparable and don't depend on what earlier runs left in ~/.cache
+    def setup(replay_p, data, donor_p):
+        def run():
+            with contextlib.redirect_stdout(io.StringIO()), tempfile.TemporaryDirectory() as tmp_p:
+                transplant_wrapper(donor_p, replay_p, os.path.join(tmp_p, "out.rep"), splice, "fast", ParseCache(max_bytes=0))
+
+        return run
+
+    return setup
+
+
+def benchRefactor(replay_p, data, donor_p):
+    # Moves every entity created in tick 0 to a fresh ID, the way transplant moves the recipient's
+    replay = Replay.parse(data, engine="fast")
+    changes = {entity.ent.id: 0x10000000 + entity.ent.id for entity in tickItems(replay.ticks[0], "entities") if entity.m1.x1}
+
+    return lambda: refactorChangeEntityIds(changes, replay)
+
+
+def benchPrintGood(replay_p, data, donor_p):
+    replay = Replay.parse(data, engine="fast")
+
+    def run():
+        with open(os.devnull, "w") as null_f, contextlib.redirect_stdout(null_f):
+            print_good(replay)
+
+    return run
+
+
+BENCHMARKS = {
+    "parse": benchParse,
+    "parse-numpy": benchParseNumpy,
+    "parse-construct": benchParseConstruct,
+    "build": benchBuild,
+    "transplant": benchTransplantMode(False),
+    "transplant-splice": benchTransplantMode(True),
+    "refactor": benchRefactor,
+    "print_good": benchPrintGood,
+}
+
+# parse-construct takes minutes on anything but the small input, ask for it with --bench
+DEFAULT_BENCHMARKS = [name for name in BENCHMARKS if name != "parse-construct"]
+
+
+def measure(setup, replay_p, data, donor_p, repeat, memory=True):
+    # (fastest wall time, [every wall time], peak traced bytes or None)
+    times = []
+
+    for i in range(repeat):
+        run = setup(replay_p, data, donor_p)
+        gc.collect()
+
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+
+        del run
+
+    peak = None
+
+    if memory:
+        run = setup(replay_p, data, donor_p)
+        gc.collect()
+
+        tracemalloc.start()
+
+        try:
+            run()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    return min(times), times, peak
+
+
+def countTicks(data):
+    return len(Replay.parse(data, engine="fast", entity_types=set(), prefabs=False, brushes=False).ticks)
+
+
+def gitRevision():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(inputs, benchmarks=DEFAULT_BENCHMARKS, donor_p=None, memory=True, data_dir=DEFAULT_DATA_DIR, log=sys.stderr):
+    # inputs is [(input name, replay path, repeat), ...]. Returns the results document that gets saved as JSON.
+    donor_p = donor_p or generated(data_dir, DONOR)
+    results = []
+
+    for input_name, replay_p, repeat in inputs:
+        with open(replay_p, "rb") as replay_f:
+            data = replay_f.read()
+
+        num_ticks = countTicks(data)
+
+        for name in benchmarks:
+            wall, times, peak = measure(BENCHMARKS[name], replay_p, data, donor_p, repeat, memory)
+
+            result = {
+                "benchmark": name,
+                "input": input_name,
+                "path": replay_p,
+                "bytes": len(data),
+                "ticks": num_ticks,
+                "repeat": repeat,
+                "wall_s": wall,
+                "wall_s_all": times,
+                "ticks_per_s": num_ticks / wall if wall else None,
+                "mb_per_s": len(data) / 1e6 / wall if wall else None,
+                "peak_mb": peak / 1e6 if peak is not None else None,
+            }
+            results.append(result)
+
+            print("%-18s %-10s %9.3f s %12.0f ticks/s %8.2f MB/s %10s" % (
+                name, input_name, wall, result["ticks_per_s"] or 0, result["mb_per_s"] or 0,
+                "%.1f MB" % result["peak_mb"] if peak is not None else "-"), file=log)
+
+    return {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "revision": gitRevision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+        },
+        "results": results,
+    }
+
+
+def compare(results, baseline, threshold=DEFAULT_THRESHOLD):
+    # [(benchmark, input, metric, new value, baseline value, ratio), ...] for everything that got worse than threshold
+    base = {(result["benchmark"], result["input"]): result for result in baseline["results"]}
+    regressions = []
+
+    for result in results["results"]:
+        old = base.get((result["benchmark"], result["input"]))
+
+        if old is None:
+            continue
+
+        for metric in ["wall_s", "peak_mb"]:
+            if result.get(metric) is None or not old.get(metric):
+                continue
+
+            ratio = result[metric] / old[metric]
+
+            if ratio > 1 + threshold:
+                regressions.append((result["benchmark"], result["input"], metric, result[metric], old[metric], ratio))
+
+    return regressions
+
+
+def printRegressions(regressions, threshold):
+    if not regressions:
+        print("No regressions over %d%%" % (threshold * 100))
+        return 0
+
+    for name, input_name, metric, new, old, ratio in regressions:
+        print("REGRESSION %-18s %-10s %-7s %10.3f -> %10.3f (%.2fx)" % (name, input_name, metric, old, new, ratio))
+
+    return 1
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="replay_bench.py", description="Benchmark parsing, building and editing replays")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_p = commands.add_parser("run", help="Run benchmarks")
+    run_p.add_argument("--sizes", default="small,medium", help="Generated inputs to use, out of %s (default: small,medium)" % ",".join(SIZES))
+    run_p.add_argument("--replay", action="append", default=[], metavar="PATH", help="Also benchmark this replay, can be repeated")
+    run_p.add_argument("--bench", default=",".join(DEFAULT_BENCHMARKS), help="Benchmarks to run, out of %s" % ",".join(BENCHMARKS))
+    run_p.add_argument("--repeat", type=int, default=None, help="Runs per benchmark, the fastest counts (default: per size)")
+    run_p.add_argument("--no-memory", action="store_true", help="Skip the extra run that measures peak memory")
+    run_p.add_argument("--data-dir", default=DEFAULT_DATA_DIR, help="Where generated inputs are kept (default: %s)" % DEFAULT_DATA_DIR)
+    run_p.add_argument("--out", help="Write the results to this JSON file")
+    run_p.add_argument("--baseline", help="Compare the results against this JSON file")
+    run_p.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD)
+
+    compare_p = commands.add_parser("compare", help="Compare two result files")
+    compare_p.add_argument("results")
+    compare_p.add_argument("baseline")
+    compare_p.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD)
+
+    args = parser.parse_args(argv)
+
+    if args.command == "compare":
+        with open(args.results) as results_f, open(args.baseline) as baseline_f:
+            return printRegressions(compare(json.load(results_f), json.load(baseline_f), args.threshold), args.threshold)
+
+    benchmarks = [name for name in args.bench.split(",") if name]
+    sizes = [name for name in args.sizes.split(",") if name]
+
+    for name in benchmarks:
+        if name not in BENCHMARKS:
+            parser.error("unknown benchmark %r" % name)
+
+    for name in sizes:
+        if name not in SIZES:
+            parser.error("unknown size %r" % name)
+
+    inputs = [(name, generated(args.data_dir, SIZES[name][0]), args.repeat or SIZES[name][1]) for name in sizes]
+    inputs += [(os.path.basename(replay_p), replay_p, args.repeat or 1) for replay_p in args.replay]
+
+    results = run_benchmarks(inputs, benchmarks, memory=not args.no_memory, data_dir=args.data_dir)
+
+    if args.out:
+        with open(args.out, "w") as out_f:
+            json.dump(results, out_f, indent=4)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_f:
+            return printRegressions(compare(results, json.load(baseline_f), args.threshold), args.threshold)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
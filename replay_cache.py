@@ -0,0 +1,305 @@
+import gc
+import os
+import io
+import sys
+import pickle
+import hashlib
+import copyreg
+
+from construct.lib import HexDisplayedInteger
+
+import fast_replay
+from replay import *
+
+# On-disk cache of parsed replays
+#
+# Entries are keyed by the sha256 of the replay's bytes, the engine that parsed it and CACHE_SCHEMA, so
+# renaming or copying a replay still hits, and editing replay.py invalidates everything. The engines
+# don't share entries, the fast engine's masks are shared FlagsContainers that mustn't be edited. Each
+# entry is one pickle file named after its key. Hits touch the entry's mtime, and once the cache grows
+# past max_bytes the least recently used entries are deleted.
+#
+#   REPLAY_CACHE_DIR    where entries go (default ~/.cache/reflex-replay-tools)
+#   REPLAY_CACHE_SIZE   size cap in MB (default 2048), 0 disables the cache
+#
+# iter_replay_cached only caches replays up to ITER_MAX_BYTES, bigger ones are streamed like iter_replay
+# does. A parsed replay takes up to a couple hundred times its size in memory, collecting all of its
+# ticks for the cache (or loading them from it) would undo the streaming.
+#
+# Pickling construct's Containers the default way goes through Container.__setitem__ for every key
+# when loading, so Containers, HexDisplayedIntegers and the header's supportedVersion Check get
+# reducers of their own. Those reducers also drop the _io streams that construct leaves behind.
+
+CACHE_VERSION = 1
+ITER_MAX_BYTES = 2 * 1024 * 1024
+
+_SCHEMA_FILES = ["replay.py", "fast_replay.py"]
+
+
+def _schemaHash():
+    h = hashlib.sha256(b"%d" % CACHE_VERSION)
+
+    for name in _SCHEMA_FILES:
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), name), "rb") as f:
+            h.update(f.read())
+
+    return h.hexdigest()[:16]
+
+
+CACHE_SCHEMA = _schemaHash()
+
+_SUPPORTED_VERSION = ReplayHeader.supportedVersion.subcon.func
+_CONTAINER_KEYS = {}
+_DROP_KEYS = {"_io"}
+
+
+def _reduceContainer(c):
+    keys = tuple(k for k in c.keys() if k not in _DROP_KEYS)
+
+    # Hand pickle the same list object for every Container with these keys, so it's only stored once
+    keys = _CONTAINER_KEYS.setdefault(keys, list(keys))
+
+    return (fast_replay._mkc, (keys, [c[k] for k in keys]))
+
+
+def _reduceParsedReplay(c):
+    # Keeps the lifetime table, see Replay.parse(lifetimes=True)
+    keys = [k for k in c.keys() if k not in _DROP_KEYS]
+
+    return (fast_replay._mkpr, (keys, [c[k] for k in keys], c.lifetimes))
+
+
+def _reduceHexDisplayedInteger(i):
+    return (HexDisplayedInteger.new, (int(i), i.fmtstr))
+
+
+def _supportedVersion():
+    return _SUPPORTED_VERSION
+
+
+def _reduceCheck(check):
+    if check is not _SUPPORTED_VERSION:
+        raise pickle.PicklingError("Can't cache %r" % check)
+
+    return (_supportedVersion, ())
+
+
+class _ReplayPickler(pickle.Pickler):
+    dispatch_table = copyreg.dispatch_table.copy()
+    dispatch_table[Container] = _reduceContainer
+    dispatch_table[ParsedReplay] = _reduceParsedReplay
+    dispatch_table[HexDisplayedInteger] = _reduceHexDisplayedInteger
+    dispatch_table[Check] = _reduceCheck
+
+
+def default_cache_dir():
+    return os.environ.get("REPLAY_CACHE_DIR") or os.path.join(os.path.expanduser("~"), ".cache", "reflex-replay-tools")
+
+
+def default_cache_size():
+    return int(os.environ.get("REPLAY_CACHE_SIZE", "2048")) * 1024 * 1024
+
+
+class ParseCache:
+    def __init__(self, cache_dir=None, max_bytes=None):
+        self.cache_dir = cache_dir or default_cache_dir()
+        self.max_bytes = default_cache_size() if max_bytes is None else max_bytes
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def key(self, replay_b, engine="fast"):
+        return _key(hashlib.sha256(replay_b).hexdigest(), engine)
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + ".pickle")
+
+    def get(self, key):
+        # Returns the cached replay, or None on a miss (or an unreadable entry)
+        entry_p = self.path(key)
+
+        # Loading allocates hundreds of thousands of Containers without freeing any, the cyclic GC
+        # keeps kicking in for nothing and would more than double the load time
+        gc_enabled = gc.isenabled()
+        gc.disable()
+
+        try:
+            with open(entry_p, "rb") as entry_f:
+                replay = pickle.load(entry_f)
+
+            # Mark as recently used for eviction
+            os.utime(entry_p)
+        except FileNotFoundError:
+            return None
+        except Exception:
+            # Truncated by a crash, or written by an incompatible version
+            self.discard(key)
+
+            return None
+        finally:
+            if gc_enabled:
+                gc.enable()
+
+        return replay
+
+    def put(self, key, replay):
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        f = io.BytesIO()
+        _ReplayPickler(f, pickle.HIGHEST_PROTOCOL).dump(replay)
+
+        if f.tell() > self.max_bytes:
+            return
+
+        # Write next to the entry and rename over it, so concurrent readers never see half an entry
+        entry_p = self.path(key)
+        tmp_p = "%s.%d.tmp" % (entry_p, os.getpid())
+
+        with open(tmp_p, "wb") as tmp_f:
+            tmp_f.write(f.getbuffer())
+
+        os.replace(tmp_p, entry_p)
+
+        self.evict()
+
+    def discard(self, key):
+        try:
+            os.remove(self.path(key))
+        except OSError:
+            pass
+
+    def entries(self):
+        # [(mtime, size, path), ...] for every entry, least recently used first
+        entries = []
+
+        try:
+            names = os.listdir(self.cache_dir)
+        except FileNotFoundError:
+            return entries
+
+        for name in names:
+            if not name.endswith(".pickle"):
+                continue
+
+            entry_p = os.path.join(self.cache_dir, name)
+
+            try:
+                st = os.stat(entry_p)
+            except OSError:
+                continue
+
+            entries.append((st.st_mtime, st.st_size, entry_p))
+
+        return sorted(entries)
+
+    def evict(self):
+        entries = self.entries()
+        total = sum(size for mtime, size, entry_p in entries)
+
+        for mtime, size, entry_p in entries:
+            if total <= self.max_bytes:
+                break
+
+            try:
+                os.remove(entry_p)
+            except OSError:
+                continue
+
+            total -= size
+
+    def clear(self):
+        for mtime, size, entry_p in self.entries():
+            try:
+                os.remove(entry_p)
+            except OSError:
+                pass
+
+
+def _key(digest, engine):
+    return "%s-%s-%s" % (digest, engine, CACHE_SCHEMA)
+
+
+def load_replay(replay_p, engine="fast", cache=None, lifetimes=False):
+    # Replay.parse with a cache in front of it. Every call returns a fresh replay, editing it is fine.
+    with open(replay_p, "rb") as replay_f:
+        replay_b = replay_f.read()
+
+    return parse_cached(replay_b, engine, cache, lifetimes)
+
+
+def parse_cached(replay_b, engine="fast", cache=None, lifetimes=False):
+    # lifetimes=True like Replay.parse. Entries keep their lifetime table, one stored without gets it added on a hit.
+    if cache is None:
+        cache = ParseCache()
+
+    if not cache.enabled:
+        return Replay.parse(replay_b, engine=engine, lifetimes=lifetimes)
+
+    key = cache.key(replay_b, engine)
+    replay = cache.get(key)
+
+    if replay is not None and lifetimes and parsedLifetimes(replay) is None:
+        replay = ParsedReplay(replay, lifetimes=EntityLifetimes(replay.ticks))
+
+    if replay is None:
+        replay = Replay.parse(replay_b, engine=engine, lifetimes=lifetimes)
+
+        try:
+            cache.put(key, replay)
+        except OSError:
+            # A read-only or full disk shouldn't keep anyone from parsing replays
+            pass
+
+    return replay
+
+
+def iter_replay_cached(replay_p, engine="construct", cache=None, max_bytes=ITER_MAX_BYTES):
+    # iter_replay with a cache in front of it for replays of up to max_bytes. Hits come straight from the
+    # cache, misses are streamed as usual while the ticks are collected, and stored once the last one has
+    # been consumed.
+    if cache is None:
+        cache = ParseCache()
+
+    if not cache.enabled or os.path.getsize(replay_p) > max_bytes:
+        return iter_replay(replay_p, engine)
+
+    h = hashlib.sha256()
+
+    with open(replay_p, "rb") as replay_f:
+        for block in iter(lambda: replay_f.read(1 << 20), b""):
+            h.update(block)
+
+    key = _key(h.hexdigest(), engine)
+
+    replay = cache.get(key)
+
+    if replay is not None:
+        return replay.header, iter(replay.ticks)
+
+    header, ticks = iter_replay(replay_p, engine)
+
+    def collect():
+        collected = ListContainer()
+
+        for tick in ticks:
+            collected.append(tick)
+            yield tick
+
+        try:
+            cache.put(key, Container(header=header, ticks=collected))
+        except OSError:
+            pass
+
+    return header, collect()
+
+
+if __name__ == "__main__":
+    # python replay_cache.py [clear]  -  show (or empty) the cache
+    cache = ParseCache()
+
+    if sys.argv[1:] == ["clear"]:
+        cache.clear()
+
+    entries = cache.entries()
+    print(cache.cache_dir, len(entries), "entries, %.1f / %.1f MB" % (sum(size for mtime, size, entry_p in entries) / 1e6, cache.max_bytes / 1e6))
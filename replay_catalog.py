@@ -0,0 +1,218 @@
+import os
+import sys
+import time
+import sqlite3
+import argparse
+
+from replay import *
+from replay_batch import find_replays
+
+# SQLite catalog of replay headers
+#
+#   python replay_catalog.py scan DIR
+#   python replay_catalog.py query --map dp5 --mode 1v1 --steam-id 76561197960287930
+#
+# One row per replay in `replays`, one row per player slot in `players`. Rescans only read the header
+# of files whose size or mtime changed since the last scan (see scan_headers), and drop rows for files
+# that disappeared. Files whose header doesn't decode are kept with their error, so they aren't retried
+# until they change.
+
+DEFAULT_DB = "replays.sqlite"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS replays (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    error TEXT,
+    protocol_version INTEGER,
+    map TEXT,
+    mode TEXT,
+    host TEXT,
+    start_time INTEGER,
+    workshop_id INTEGER,
+    player_count INTEGER
+);
+
+CREATE TABLE IF NOT EXISTS players (
+    replay_id INTEGER NOT NULL REFERENCES replays(id) ON DELETE CASCADE,
+    slot INTEGER NOT NULL,
+    name TEXT,
+    steam_id INTEGER,
+    score INTEGER,
+    team INTEGER,
+    PRIMARY KEY (replay_id, slot)
+);
+
+CREATE INDEX IF NOT EXISTS replays_map ON replays (map, mode);
+CREATE INDEX IF NOT EXISTS replays_mode ON replays (mode);
+CREATE INDEX IF NOT EXISTS replays_start_time ON replays (start_time);
+CREATE INDEX IF NOT EXISTS players_steam_id ON players (steam_id);
+CREATE INDEX IF NOT EXISTS players_name ON players (name);
+"""
+
+
+def _int64(value):
+    # SQLite integers are signed 64 bit, steamIds and workshopIds are unsigned
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def _uint64(value):
+    return value + (1 << 64) if value is not None and value < 0 else value
+
+
+class ReplayCatalog:
+    def __init__(self, db_p=DEFAULT_DB):
+        self.db = sqlite3.connect(db_p)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA foreign_keys = ON")
+        self.db.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.db.close()
+
+    def rescan(self, dir_p):
+        # Returns (scanned, unchanged, removed, errors)
+        dir_p = os.path.abspath(dir_p)
+
+        # Rows below dir_p. Not LIKE, that ignores case and would take /data/replays for /data/Replays.
+        prefix = os.path.join(dir_p, "")
+        known = {row["path"]: (row["id"], row["size"], row["mtime_ns"]) for row in
+                 self.db.execute("SELECT id, path, size, mtime_ns FROM replays WHERE substr(path, 1, ?) = ?", (len(prefix), prefix))}
+
+        changed = []
+        stats = {}
+        unchanged = 0
+
+        for replay_p in find_replays(dir_p):
+            try:
+                st = os.stat(replay_p)
+            except OSError:
+                continue
+
+            stats[replay_p] = st
+            row = known.pop(replay_p, None)
+
+            if row is not None and row[1] == st.st_size and row[2] == st.st_mtime_ns:
+                unchanged += 1
+            else:
+                changed.append(replay_p)
+
+        errors = 0
+
+        with self.db:
+            # Whatever is left in known wasn't found on disk anymore
+            self.db.executemany("DELETE FROM replays WHERE id = ?", [(row[0],) for row in known.values()])
+
+            for replay_p, header, error in scan_headers(changed):
+                st = stats[replay_p]
+
+                self.db.execute("DELETE FROM replays WHERE path = ?", (replay_p,))
+
+                if error is not None:
+                    errors += 1
+                    self.db.execute("INSERT INTO replays (path, size, mtime_ns, error) VALUES (?, ?, ?, ?)",
+                                    (replay_p, st.st_size, st.st_mtime_ns, error))
+                    continue
+
+                replay_id = self.db.execute(
+                    "INSERT INTO replays (path, size, mtime_ns, protocol_version, map, mode, host, start_time, workshop_id, player_count)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (replay_p, st.st_size, st.st_mtime_ns, header.protocolVersion, header.szMapTitle, header.szGameMode,
+                     header.szHostName, _int64(header.epochStartTime), _int64(header.workshopId), header.playerCount)).lastrowid
+
+                self.db.executemany("INSERT INTO players (replay_id, slot, name, steam_id, score, team) VALUES (?, ?, ?, ?, ?, ?)",
+                                    [(replay_id, slot, player.name, _int64(player.steamId), player.score, player.team)
+                                     for slot, player in enumerate(header.players[:header.playerCount])])
+
+        return len(changed), unchanged, len(known), errors
+
+    def query(self, map=None, mode=None, host=None, steam_id=None, player_name=None, after=None, before=None, workshop_id=None):
+        # Replays matching every given filter, newest first. after / before are epoch seconds.
+        where = ["r.error IS NULL"]
+        params = []
+
+        for column, value in [("r.map", map), ("r.mode", mode), ("r.host", host)]:
+            if value is not None:
+                where.append("%s = ?" % column)
+                params.append(value)
+
+        if workshop_id is not None:
+            where.append("r.workshop_id = ?")
+            params.append(_int64(workshop_id))
+
+        if after is not None:
+            where.append("r.start_time >= ?")
+            params.append(after)
+
+        if before is not None:
+            where.append("r.start_time < ?")
+            params.append(before)
+
+        if steam_id is not None:
+            where.append("r.id IN (SELECT replay_id FROM players WHERE steam_id = ?)")
+            params.append(_int64(steam_id))
+
+        if player_name is not None:
+            where.append("r.id IN (SELECT replay_id FROM players WHERE name = ?)")
+            params.append(player_name)
+
+        return [self._replay(row) for row in
+                self.db.execute("SELECT r.* FROM replays r WHERE %s ORDER BY r.start_time DESC" % " AND ".join(where), params)]
+
+    def players(self, replay_id):
+        return [dict(row, steam_id=_uint64(row["steam_id"])) for row in
+                self.db.execute("SELECT slot, name, steam_id, score, team FROM players WHERE replay_id = ? ORDER BY slot", (replay_id,))]
+
+    def errors(self):
+        return [(row["path"], row["error"]) for row in self.db.execute("SELECT path, error FROM replays WHERE error IS NOT NULL ORDER BY path")]
+
+    def _replay(self, row):
+        replay = dict(row)
+        replay["start_time"] = _uint64(replay["start_time"])
+        replay["workshop_id"] = _uint64(replay["workshop_id"])
+
+        return replay
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="replay_catalog.py", description="SQLite catalog of replay headers")
+    parser.add_argument("--db", default=DEFAULT_DB, help="Catalog database (default: %s)" % DEFAULT_DB)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    scan_p = commands.add_parser("scan", help="Add new and changed replays below DIR to the catalog")
+    scan_p.add_argument("dir", metavar="DIR")
+
+    query_p = commands.add_parser("query", help="List catalogued replays matching all filters")
+    query_p.add_argument("--map")
+    query_p.add_argument("--mode")
+    query_p.add_argument("--host")
+    query_p.add_argument("--steam-id", type=int)
+    query_p.add_argument("--player")
+    query_p.add_argument("--workshop-id", type=int)
+
+    args = parser.parse_args(argv)
+
+    with ReplayCatalog(args.db) as catalog:
+        if args.command == "scan":
+            start = time.perf_counter()
+            scanned, unchanged, removed, errors = catalog.rescan(args.dir)
+
+            print("%d scanned (%d errors), %d unchanged, %d removed in %.2f s" % (scanned, errors, unchanged, removed, time.perf_counter() - start))
+        else:
+            for replay in catalog.query(args.map, args.mode, args.host, args.steam_id, args.player, workshop_id=args.workshop_id):
+                players = ", ".join("%s (%d)" % (player["name"], player["score"]) for player in catalog.players(replay["id"]))
+                print("\t".join([replay["path"], replay["map"], replay["mode"], replay["host"], players]))
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,354 @@
+import sys
+import struct
+import random
+import argparse
+
+import fast_replay
+from replay import *
+from replay_state import FIELD_PLANS
+
+# Synthetic replays of any size
+#
+#   python replay_generate.py out.rep --ticks 100000 --players 8 --projectile-rate 20 --damage-rate 10 --seed 1
+#
+# or from Python:
+#
+#   generator = ReplayGenerator(ticks=100000, players=8, seed=1)
+#   generator.write("out.rep")               # streamed, constant memory
+#   replay = generator.replay()              # or a Container like Replay.parse returns
+#
+# Tick 0 holds the map: `brushes` boxes, `prefabs` prefab definitions with one instance each, a
+# WorldSpawn, a PlayerSpawn and a Player per player and one entity of every other static type. Every
+# tick after it moves the players around, and projectiles are created at `projectile_rate` per second
+# (over all players) and destroyed again a second or three later. Damage events between players
+# (`damage_rate`), chat messages (`chat_rate`) and votes (`vote_rate`) come and go the same way, each
+# referencing the players involved by their entity IDs. Fields the generator doesn't care about get
+# random values of the right shape, walking the schemas in replay.py.
+#
+# The same parameters and seed always produce the same bytes. No real player data is involved.
+
+TICK_MS = 8
+FIRST_TIMECODE = 1000
+
+PROJECTILE_TYPES = [0x04, 0x05, 0x06, 0x07, 0x08]
+STATIC_TYPES = [0x03, 0x09, 0x0A, 0x0B, 0x0C, 0x0D, 0x0F, 0x12, 0x13, 0x14, 0x16, 0x17, 0x18, 0x19, 0x1A, 0x1B, 0x1C,
+                0x1D, 0x1E, 0x1F, 0x20]
+VOTES = ["restart", "map generated", "mode ffa", "kick player1"]
+
+MATERIALS = ["internal/editor/textures/grid", "internal/editor/textures/editor_nolight", "internal/editor/textures/grid_dark"]
+MAP_SIZE = 2048.0
+
+_F32 = struct.Struct("<f")
+_INPUT = fast_replay._flags(InputMask.flags)
+
+# Vertex indices of a box's faces, corners numbered by bit 0 = x, bit 1 = y, bit 2 = z
+_BOX_FACES = [[0, 2, 3, 1], [4, 5, 7, 6], [0, 1, 5, 4], [2, 6, 7, 3], [0, 4, 6, 2], [1, 3, 7, 5]]
+
+
+def f32(value):
+    # Round to what a Float32l stores, so parsing the replay back gives the exact same values
+    return _F32.unpack(_F32.pack(value))[0]
+
+
+def vector(x, y, z):
+    return Container(x=f32(x), y=f32(y), z=f32(z))
+
+
+def randomViewAngle(rng):
+    # ViewAngle32l, x is a full turn in 16 bits
+    return Container(x=rng.getrandbits(16), y=rng.randint(-0x4000, 0x4000))
+
+
+def randomString(rng, max_length):
+    return "".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for i in range(rng.randint(0, max_length)))
+
+
+def randomValue(sc, rng, ctx=None, force=None):
+    # A random value that sc can build. ctx is the parent Container for this.* expressions, force
+    # overrides fields of a Struct by name.
+    if isinstance(sc, Renamed):
+        return randomValue(sc.subcon, rng, ctx)
+
+    if isinstance(sc, IfThenElse):
+        cond = sc.condfunc(ctx) if callable(sc.condfunc) else sc.condfunc
+        return randomValue(sc.thensubcon if cond else sc.elsesubcon, rng, ctx)
+
+    if sc is Pass:
+        return None
+
+    if sc is Flag:
+        return rng.random() < 0.5
+
+    if isinstance(sc, FormatField):
+        if sc.fmtstr[-1] == "f":
+            return f32(rng.uniform(-1000, 1000))
+
+        bits = 8 * sc.length
+
+        return rng.getrandbits(bits) - (1 << bits - 1 if sc.fmtstr[-1].islower() else 0)
+
+    if isinstance(sc, FlagsEnum):
+        return fast_replay._flags(sc.flags)[rng.getrandbits(8)]
+
+    if isinstance(sc, Hex):
+        return rng.getrandbits(8 * sc.subcon.length)
+
+    if isinstance(sc, StringEncoded):
+        # PaddedString needs room for at least one pad byte
+        return randomString(rng, min(sc.subcon.length - 1, 16) if isinstance(sc.subcon, FixedSized) else 16)
+
+    if isinstance(sc, Computed):
+        return sc.func(ctx) if callable(sc.func) else sc.func
+
+    if isinstance(sc, Array):
+        count = sc.count(ctx) if callable(sc.count) else sc.count
+        return ListContainer(randomValue(sc.subcon, rng, ctx) for i in range(count))
+
+    if isinstance(sc, Switch):
+        return randomValue(sc.cases.get(sc.keyfunc(ctx), sc.default), rng, ctx)
+
+    if isinstance(sc, Struct):
+        obj = Container()
+        inner = Container(_=ctx)
+
+        for sub in sc.subcons:
+            if force is not None and sub.name in force:
+                value = force[sub.name]
+            elif sub.name.startswith("num") or sub.name.startswith("len"):
+                value = rng.randint(0, 3)
+            else:
+                value = randomValue(sub.subcon, rng, inner)
+
+            obj[sub.name] = inner[sub.name] = value
+
+        return obj
+
+    if isinstance(sc, Subconstruct): # ByteSwapped, Aligned, Transformed, ...
+        return randomValue(sc.subcon, rng, ctx)
+
+    raise TypeError("Can't make up a value for %r" % sc)
+
+
+def randomFields(rng, entity_type, density=0.5, **values):
+    # {field name: value} for a random selection of an entityType's fields, with values taking precedence
+    plan = FIELD_PLANS[entity_type]
+    fields = {}
+    chosen = {} # Fields sharing a mask bit (CameraPath's position and rotation) come as a pair
+
+    for name, mask_name, bit in plan.fields:
+        if mask_name is None or chosen.setdefault((mask_name, bit), rng.random() < density):
+            fields[name] = randomValue(plan.subcons[name], rng)
+
+    fields.update(values)
+
+    return fields
+
+
+def box(rng, center, size):
+    # The geometry fields shared by Brush and PrefabBrush for an axis aligned box
+    vertices = [vector(center[0] + (size[0] if i & 1 else -size[0]) / 2, center[1] + (size[1] if i & 2 else -size[1]) / 2,
+                       center[2] + (size[2] if i & 4 else -size[2]) / 2) for i in range(8)]
+    faces = [Container(index=i, numEdges=4, unknown1=0, offsetX=0.0, offsetY=0.0, scaleX=1.0, scaleY=1.0, rotation=0.0)
+             for i in range(6)]
+    materials = [rng.choice(MATERIALS)]
+
+    return dict(numVertices=8, numFaces=6, numEntriesFaceTable=24, lenMaterialColorArrays=len(materials),
+                lenMaterialArrayBytes=sum(len(material) + 1 for material in materials),
+                vertices=vertices, faces=faces, faceTable=[i for face in _BOX_FACES for i in face], materials=materials,
+                colors=[Container(b=rng.getrandbits(8), g=rng.getrandbits(8), r=rng.getrandbits(8), x=0xFF) for material in materials])
+
+
+def randomBox(rng):
+    center = [rng.uniform(-MAP_SIZE, MAP_SIZE) for i in range(3)]
+    size = [rng.choice([16, 32, 64, 128, 256]) for i in range(3)]
+
+    return box(rng, center, size)
+
+
+class ReplayGenerator:
+    def __init__(self, ticks=1000, players=2, projectile_rate=4.0, brushes=100, prefabs=4, seed=0, damage_rate=2.0,
+                 chat_rate=0.2, vote_rate=0.05):
+        self.num_ticks = ticks
+        self.num_players = players
+        self.projectile_rate = projectile_rate # Projectiles per second, over all players
+        self.num_brushes = brushes
+        self.num_prefabs = prefabs
+        self.seed = seed
+        self.damage_rate = damage_rate # Damage, chat and vote entities per second, over all players
+        self.chat_rate = chat_rate
+        self.vote_rate = vote_rate
+
+    def _rng(self, part):
+        # Separate streams, so the header doesn't change when only the ticks' parameters do
+        return random.Random("%d/%s" % (self.seed, part))
+
+    def header(self):
+        rng = self._rng("header")
+        players = [Container(name="player%d" % (i + 1) if i < self.num_players else "", score=rng.randint(0, 50) if i < self.num_players else 0,
+                             team=i % 2 if i < self.num_players else 0, steamId=0) for i in range(16)]
+
+        return Container(tag=0, protocolVersion=89, playerCount=min(self.num_players, 16), markerCount=0, unknown1=0, workshopId=0,
+                         epochStartTime=1500000000 + rng.getrandbits(24), szGameMode="ffa", szMapTitle="generated%d" % self.seed,
+                         szHostName="replay_generate.py", players=players)
+
+    def prefabDefinitions(self, rng):
+        prefabs = []
+        entity_types = sorted(PrefabEntity.entity.subcon.cases)
+
+        for i in range(self.num_prefabs):
+            entities = []
+
+            for j in range(rng.randint(1, 4)):
+                entity_type = rng.choice(entity_types)
+                brushes = [Container(unknown1=0, unknown2=0, **randomBox(rng)) for k in range(rng.randint(0, 2))]
+
+                entities.append(randomValue(PrefabEntity, rng, force=dict(numBrushes=len(brushes), entityType8=entity_type,
+                                                                          entityType32=entity_type, unknown1=-1, brushes=brushes)))
+
+            prefabs.append(Container(prefabId=i, prefabName="prefab%d" % i, numEntities=len(entities), entities=entities))
+
+        return prefabs
+
+    def ticks(self):
+        # Yields every tick, built as they go so memory use doesn't depend on the tick count
+        rng = self._rng("ticks")
+        plans = {entity_type: FIELD_PLANS[entity_type] for entity_type in FIELD_PLANS}
+
+        next_id = 0
+        entities = []
+
+        def create(entity_type, **values):
+            nonlocal next_id
+
+            entity_id = next_id
+            next_id += 1
+            entities.append(plans[entity_type].entity(entity_id, entity_type, randomFields(rng, entity_type, **values), create=True))
+
+            return entity_id
+
+        prefabs = self.prefabDefinitions(rng)
+
+        create(0x00)
+
+        for i in range(self.num_players):
+            create(0x01, position=vector(*(rng.uniform(-MAP_SIZE, MAP_SIZE) for j in range(3))))
+
+        for entity_type in STATIC_TYPES:
+            create(entity_type)
+
+        for prefab in prefabs:
+            create(0x15, prefabName=prefab.prefabName, position=vector(*(rng.uniform(-MAP_SIZE, MAP_SIZE) for j in range(3))),
+                   angles=vector(rng.choice([0, 90, 180, 270]), 0, 0), nextSubEntityId=next_id + 1,
+                   nextNormalEntityId=next_id + 1 + prefab.numEntities)
+            next_id += prefab.numEntities # Sub-entities, see registerPrefabSubEntities
+
+        players = []
+
+        for i in range(self.num_players):
+            position = [rng.uniform(-MAP_SIZE, MAP_SIZE) for j in range(3)]
+            players.append((create(0x02, position=vector(*position), velocity=vector(0, 0, 0), weaponHeld=0), position, [0.0, 0.0, 0.0]))
+
+        brushes = [Container(brushId=i, unknown1=0, entityIdAttachedTo=0, unknown2=0, **randomBox(rng)) for i in range(self.num_brushes)]
+        timecode = FIRST_TIMECODE
+
+        yield Container(timecode=timecode, prefabChunks=makeChunks(prefabs, "prefabs"), entityChunks=makeChunks(entities, "entities"),
+                        brushChunks=makeChunks(brushes, "brushes"))
+
+        expiring = [] # [(timecode to destroy it at, entity id), ...] in order
+
+        def occurrences(rate):
+            # How many of something happening `rate` times per second happen in one tick
+            per_tick = rate * TICK_MS / 1000
+
+            return int(per_tick) + (rng.random() < per_tick % 1)
+
+        for i in range(1, self.num_ticks):
+            timecode += TICK_MS
+            entities = []
+
+            for player_id, position, velocity in players:
+                # Random walk with a bit of inertia, kept inside the map
+                for j in range(3):
+                    velocity[j] = max(-320.0, min(320.0, 0.9 * velocity[j] + rng.uniform(-40, 40)))
+                    position[j] = max(-MAP_SIZE, min(MAP_SIZE, position[j] + velocity[j] * TICK_MS / 1000))
+
+                values = dict(position=vector(*position), velocity=vector(*velocity),
+                              viewAngle=randomViewAngle(rng), input=_INPUT[rng.getrandbits(8)])
+
+                if rng.random() < 0.01:
+                    values["weaponHeld"] = rng.randint(0, 8)
+
+                entities.append(plans[0x02].entity(player_id, 0x02, values))
+
+            for j in range(occurrences(self.projectile_rate)):
+                owner = rng.choice(players) if players else None
+                entity_type = rng.choice(PROJECTILE_TYPES)
+                origin = owner[1] if owner is not None else [0.0, 0.0, 0.0]
+
+                entity_id = create(entity_type, origin=vector(*origin),
+                                   spawnedAtTimecode=timecode, spawnedByEntityId=owner[0] if owner is not None else 0)
+                expiring.append((timecode + rng.randint(1000, 3000), entity_id))
+
+            if players:
+                for j in range(occurrences(self.damage_rate)):
+                    # Between two different players when there are two
+                    sender, receiver = rng.sample(players, 2) if len(players) > 1 else players * 2
+
+                    entity_id = create(0x11, senderId=sender[0], receiverId=receiver[0])
+                    expiring.append((timecode + rng.randint(TICK_MS, 200), entity_id))
+
+                for j in range(occurrences(self.chat_rate)):
+                    entity_id = create(0x0E, senderId=rng.choice(players)[0], content=randomString(rng, 32))
+                    expiring.append((timecode + rng.randint(1000, 3000), entity_id))
+
+                for j in range(occurrences(self.vote_rate)):
+                    entity_id = create(0x10, createdAt=timecode, creatorId=rng.choice(players)[0], vote=rng.choice(VOTES))
+                    expiring.append((timecode + rng.randint(1000, 3000), entity_id))
+
+            expiring.sort()
+
+            while expiring and expiring[0][0] <= timecode:
+                entities.append(Container(ent=Container(id=expiring.pop(0)[1], destroy=1), m1=None, entityType=None,
+                                          entityTypeS=None, fields=None))
+
+            yield Container(timecode=timecode, prefabChunks=makeChunks([], "prefabs"), entityChunks=makeChunks(entities, "entities"),
+                            brushChunks=makeChunks([], "brushes"))
+
+    def replay(self):
+        return Container(header=self.header(), ticks=ListContainer(self.ticks()))
+
+    def write(self, f):
+        # Returns the number of ticks written
+        with ReplayWriter(f, self.header()) as writer:
+            for tick in self.ticks():
+                writer.write_tick(tick)
+
+            return writer.num_ticks
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="replay_generate.py", description="Generate a synthetic replay")
+    parser.add_argument("out", metavar="OUT")
+    parser.add_argument("--ticks", type=int, default=1000)
+    parser.add_argument("--players", type=int, default=2)
+    parser.add_argument("--projectile-rate", type=float, default=4.0, help="Projectiles per second, over all players")
+    parser.add_argument("--brushes", type=int, default=100)
+    parser.add_argument("--prefabs", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--damage-rate", type=float, default=2.0, help="Damage events per second, over all players")
+    parser.add_argument("--chat-rate", type=float, default=0.2, help="Chat messages per second, over all players")
+    parser.add_argument("--vote-rate", type=float, default=0.05, help="Votes per second, over all players")
+
+    args = parser.parse_args(argv)
+
+    generator = ReplayGenerator(args.ticks, args.players, args.projectile_rate, args.brushes, args.prefabs, args.seed,
+                                args.damage_rate, args.chat_rate, args.vote_rate)
+    num_ticks = generator.write(args.out)
+
+    print("Wrote", num_ticks, "ticks to", args.out)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
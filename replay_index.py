@@ -0,0 +1,243 @@
+import os
+import sys
+import mmap
+import array
+import struct
+import bisect
+
+import replay
+import fast_replay
+from replay import *
+
+# Tick offset index (.repidx sidecar) for random access into a replay by timecode
+#
+# The index stores the byte offset and timecode of every tick, plus a snapshot of the ReplayLookups
+# every `interval` ticks. Those snapshots are what lets us start parsing in the middle
+# of a replay, update-only entities need their entityType from an earlier create.
+#
+#   with Replay.open("match.rep") as rep:
+#       for tick in rep.seek(20 * 60 * 1000):
+#           ...
+#
+# Layout, all little endian:
+#   "RIDX" u32 version, u64 replay size, u64 replay mtime_ns, u32 interval, u32 numTicks
+#   u64 offsets[numTicks], u32 timecodes[numTicks]
+#   u32 numPrefabTables, per table: u32 numPrefabs, per prefab: u16 lenName, name, u32 numEntities, u8 entityType8s[numEntities]
+#   u32 numCheckpoints, per checkpoint: u32 tickIndex, u32 prefabTable, u32 numEntities, u32 ids[numEntities], u8 types[numEntities]
+
+INDEX_MAGIC = b"RIDX"
+INDEX_VERSION = 1
+INDEX_INTERVAL = 256
+
+_INDEX_HEADER = struct.Struct("<4sIQQII")
+_U16 = struct.Struct("<H")
+_U32 = struct.Struct("<I")
+_CHECKPOINT = struct.Struct("<III")
+
+
+def index_path(replay_p):
+    return os.path.splitext(replay_p)[0] + ".repidx"
+
+
+class ReplayIndex:
+    def __init__(self, size, mtime_ns, interval, offsets, timecodes, prefab_tables, checkpoints):
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.interval = interval
+        self.offsets = offsets # array("Q")
+        self.timecodes = timecodes # array("I")
+        self.prefab_tables = prefab_tables # [{prefabName: [entityType8, ...]}, ...]
+        self.checkpoints = checkpoints # [(tick index, prefab table index, {id: entityType}), ...]
+
+    def matches(self, replay_p):
+        st = os.stat(replay_p)
+
+        return st.st_size == self.size and st.st_mtime_ns == self.mtime_ns
+
+    def checkpoint_before(self, timecode):
+        # Last checkpoint at or before the first tick with tick.timecode >= timecode
+        tick = bisect.bisect_left(self.timecodes, timecode)
+
+        return self.checkpoints[min(tick // self.interval, len(self.checkpoints) - 1)]
+
+    def to_bytes(self):
+        out = [_INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, self.size, self.mtime_ns, self.interval, len(self.offsets)),
+               self.offsets.tobytes(), self.timecodes.tobytes(), _U32.pack(len(self.prefab_tables))]
+
+        for table in self.prefab_tables:
+            out.append(_U32.pack(len(table)))
+
+            for name, types in table.items():
+                name_b = name.encode(ENC_2)
+                out += [_U16.pack(len(name_b)), name_b, _U32.pack(len(types)), bytes(types)]
+
+        out.append(_U32.pack(len(self.checkpoints)))
+
+        for tick_index, table, entities in self.checkpoints:
+            out += [_CHECKPOINT.pack(tick_index, table, len(entities)),
+                    array.array("I", entities.keys()).tobytes(), bytes(entities.values())]
+
+        return b"".join(out)
+
+    @staticmethod
+    def from_bytes(data):
+        magic, version, size, mtime_ns, interval, num_ticks = _INDEX_HEADER.unpack_from(data, 0)
+        off = _INDEX_HEADER.size
+
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            raise ValueError("Not a version %d replay index" % INDEX_VERSION)
+
+        offsets = array.array("Q", data[off:off + 8 * num_ticks])
+        off += 8 * num_ticks
+        timecodes = array.array("I", data[off:off + 4 * num_ticks])
+        off += 4 * num_ticks
+
+        prefab_tables = []
+        num_tables, = _U32.unpack_from(data, off)
+        off += 4
+
+        for i in range(num_tables):
+            table = {}
+            num_prefabs, = _U32.unpack_from(data, off)
+            off += 4
+
+            for j in range(num_prefabs):
+                len_name, = _U16.unpack_from(data, off)
+                name = data[off + 2:off + 2 + len_name].decode(ENC_2)
+                off += 2 + len_name
+
+                num_entities, = _U32.unpack_from(data, off)
+                table[name] = list(data[off + 4:off + 4 + num_entities])
+                off += 4 + num_entities
+
+            prefab_tables.append(table)
+
+        checkpoints = []
+        num_checkpoints, = _U32.unpack_from(data, off)
+        off += 4
+
+        for i in range(num_checkpoints):
+            tick_index, table, num_entities = _CHECKPOINT.unpack_from(data, off)
+            off += _CHECKPOINT.size
+
+            ids = array.array("I", data[off:off + 4 * num_entities])
+            off += 4 * num_entities
+            types = data[off:off + num_entities]
+            off += num_entities
+
+            checkpoints.append((tick_index, table, dict(zip(ids, types))))
+
+        return ReplayIndex(size, mtime_ns, interval, offsets, timecodes, prefab_tables, checkpoints)
+
+
+def build_index(replay_p, interval=INDEX_INTERVAL):
+    # One pass over the replay with the fast decoder, recording where every tick starts. Nothing but the
+    # lookups is needed, so every entity, prefab and brush is skipped instead of decoded
+    st = os.stat(replay_p)
+
+    # Same error as read_header. mmap can't map an empty file, and a short header would fail inside decode_header.
+    if st.st_size < HEADER_SIZE:
+        raise StreamError("replay is too short for a header: %d bytes" % st.st_size)
+
+    offsets = array.array("Q")
+    timecodes = array.array("I")
+    prefab_tables = []
+    checkpoints = []
+
+    lookups = ReplayLookups()
+
+    with open(replay_p, "rb") as replay_f, mmap.mmap(replay_f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        header, off = fast_replay.decode_header(buf)
+
+        while True:
+            if len(offsets) % interval == 0:
+                table = {name: [entity.entityType8 for entity in entities] for name, entities in lookups.prefabs.items()}
+
+                if not prefab_tables or prefab_tables[-1] != table:
+                    prefab_tables.append(table)
+
+                checkpoints.append((len(offsets), len(prefab_tables) - 1, dict(lookups.entities)))
+
+            try:
+                tick, end = fast_replay.decode_tick(buf, off, lookups, entity_types=set(), prefabs=False, brushes=False)
+            except Exception:
+                break
+
+            offsets.append(off)
+            timecodes.append(tick.timecode)
+            off = end
+
+    return ReplayIndex(st.st_size, st.st_mtime_ns, interval, offsets, timecodes, prefab_tables, checkpoints)
+
+
+def load_index(replay_p, save=True):
+    # Read the sidecar if it's still up to date, otherwise rebuild it (and try to save it next to the replay)
+    idx_p = index_path(replay_p)
+
+    try:
+        with open(idx_p, "rb") as idx_f:
+            index = ReplayIndex.from_bytes(idx_f.read())
+
+        if index.matches(replay_p):
+            return index
+    except (OSError, ValueError, struct.error):
+        pass
+
+    index = build_index(replay_p)
+
+    if save:
+        try:
+            with open(idx_p, "wb") as idx_f:
+                idx_f.write(index.to_bytes())
+        except OSError:
+            pass
+
+    return index
+
+
+class ReplayFile:
+    def __init__(self, replay_p, engine="fast"):
+        if engine not in ["construct", "fast"]:
+            raise ValueError("Unknown engine %r, expected \"construct\" or \"fast\"" % engine)
+
+        self.path = replay_p
+        self.engine = engine
+        self.index = load_index(replay_p)
+        self.f = open(replay_p, "rb")
+        self.header = ReplayHeader.parse_stream(self.f)
+        self.lookups = ReplayLookups()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.f.close()
+
+    def seek(self, timecode):
+        # Yields every tick with tick.timecode >= timecode, decoding from the nearest checkpoint before it.
+        # Like iter_ticks, self.lookups follows along as the ticks are consumed.
+        tick_index, table, entities = self.index.checkpoint_before(timecode)
+
+        self.lookups = ReplayLookups(dict(entities), {name: [fast_replay.PrefabEntityType(t) for t in types] for name, types in self.index.prefab_tables[table].items()})
+
+        if tick_index == len(self.index.offsets):
+            return
+
+        self.f.seek(self.index.offsets[tick_index])
+
+        for tick in (replay._iterTicksFast(self.f, self.lookups) if self.engine == "fast" else replay._iterTicksConstruct(self.f, self.lookups)):
+            if tick.timecode >= timecode:
+                yield tick
+
+
+if __name__ == "__main__":
+    for replay_p in sys.argv[1:]:
+        index = build_index(replay_p)
+
+        with open(index_path(replay_p), "wb") as idx_f:
+            idx_f.write(index.to_bytes())
+
+        print(replay_p, len(index.offsets), "ticks,", len(index.checkpoints), "checkpoints")
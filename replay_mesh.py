@@ -0,0 +1,297 @@
+import os
+import sys
+import math
+
+import numpy as np
+
+from replay import *
+from replay_state import WorldState
+
+# Map geometry out of a replay, as a triangle mesh
+#
+#   python replay_mesh.py match.rep match.obj
+#
+# or from Python:
+#
+#   brushes, state = load_map("match.rep")
+#   geometry = map_geometry(brushes, state)
+#   write_obj("match.obj", geometry)
+#
+# Tick 0's brushChunks hold the map's brushes. Prefabs are placed by their Prefab (0x15) entities: every
+# brush of every PrefabEntity in the instance's definition is rotated by the entity's angles and moved to
+# its position. Everything is gathered into flat arrays first (see MapGeometry), then every face is fan
+# triangulated at once, so exporting is a handful of NumPy operations however big the map is.
+#
+# Two guesses, since the replay format doesn't say: angles are yaw, pitch and roll in degrees about Y
+# (Reflex is Y up), X and Z, and Face.index is the face's index into its brush's materials (faces whose
+# index is out of range get the brush's first material). Brushes attached to entities are exported where
+# the replay put them, without following the entity.
+
+
+class MapGeometry:
+    # Every brush of a map in flat arrays:
+    #
+    #   vertices        (V, 3) float32  world space
+    #   brush_starts    (B + 1,)        brush i's vertices are vertices[brush_starts[i]:brush_starts[i + 1]]
+    #   face_edges      (F,)            numEdges of every face
+    #   face_brush      (F,)            brush of every face
+    #   face_material   (F,)            index into materials
+    #   face_table      (sum(face_edges),) the faces' corners as indices into vertices, one face after the other
+    #   brush_prefab    (B,)            ID of the Prefab entity a brush was placed by, -1 for the map's own
+    #   materials       [name, ...]
+    #   colors          [(r, g, b), ...] the first color seen with every material
+    def __init__(self):
+        self.vertices = np.zeros((0, 3), np.float32)
+        self.brush_starts = np.zeros(1, np.int64)
+        self.face_edges = np.zeros(0, np.int64)
+        self.face_brush = np.zeros(0, np.int64)
+        self.face_material = np.zeros(0, np.int64)
+        self.face_table = np.zeros(0, np.int64)
+        self.brush_prefab = np.zeros(0, np.int64)
+        self.materials = []
+        self.colors = []
+        self.skipped = 0 # brushes whose faces don't match their faceTable
+
+    def __len__(self):
+        return len(self.brush_prefab)
+
+    def triangles(self):
+        # Fan triangulation of every face: (T, 3) indices into vertices and the (T,) material of every triangle
+        edges = self.face_edges
+        num_triangles = np.maximum(edges - 2, 0)
+        face_starts = np.concatenate([[0], np.cumsum(edges)[:-1]])
+
+        faces = np.repeat(np.arange(len(edges)), num_triangles)
+        first = np.repeat(np.concatenate([[0], np.cumsum(num_triangles)[:-1]]), num_triangles)
+        corner = np.arange(len(faces)) - first + 1 # 1 .. numEdges - 2 within every face
+
+        starts = face_starts[faces]
+        triangles = np.stack([self.face_table[starts], self.face_table[starts + corner], self.face_table[starts + corner + 1]], axis=1)
+
+        return triangles, self.face_material[faces]
+
+    def bounds(self):
+        # (B, 3) minimums and maximums of every brush's vertices
+        if not len(self):
+            return np.zeros((0, 3), np.float32), np.zeros((0, 3), np.float32)
+
+        starts = self.brush_starts[:-1]
+
+        return np.minimum.reduceat(self.vertices, starts), np.maximum.reduceat(self.vertices, starts)
+
+
+def rotation(angles):
+    # 3x3 rotation matrix for a Vector3 of yaw, pitch and roll in degrees
+    yaw, pitch, roll = (math.radians(a) for a in (angles.x, angles.y, angles.z))
+
+    cy, sy = math.cos(yaw), math.sin(yaw)
+    cp, sp = math.cos(pitch), math.sin(pitch)
+    cr, sr = math.cos(roll), math.sin(roll)
+
+    ry = np.array([[cy, 0, sy], [0, 1, 0], [-sy, 0, cy]])
+    rx = np.array([[1, 0, 0], [0, cp, -sp], [0, sp, cp]])
+    rz = np.array([[cr, -sr, 0], [sr, cr, 0], [0, 0, 1]])
+
+    return ry @ rx @ rz
+
+
+def _brushArrays(brush):
+    # (vertices, numEdges, Face.index, faceTable) of a Brush or PrefabBrush, parsed with numpy=True or not
+    if hasattr(brush.vertices, "dtype"):
+        return brush.vertices, brush.faces["numEdges"], brush.faces["index"], brush.faceTable
+
+    return (np.array([(v.x, v.y, v.z) for v in brush.vertices], np.float32).reshape(-1, 3),
+            np.array([face.numEdges for face in brush.faces], np.int64),
+            np.array([face.index for face in brush.faces], np.int64),
+            np.array(brush.faceTable, np.int64))
+
+
+def _concatenate(arrays, dtype):
+    return np.concatenate(arrays).astype(dtype, copy=False) if arrays else np.zeros(0, dtype)
+
+
+class _Builder:
+    # Collects brushes as they are, all the arithmetic happens on the concatenated arrays in build()
+    def __init__(self):
+        self.geometry = MapGeometry()
+        self.material_ids = {}
+        self.parts = [] # (vertices, edges, Face.index, table, [material id, ...], prefab entity id) per brush
+
+    def material(self, name, color):
+        if name not in self.material_ids:
+            self.material_ids[name] = len(self.geometry.materials)
+            self.geometry.materials.append(name)
+            self.geometry.colors.append((color.r, color.g, color.b) if color is not None else (0xFF, 0xFF, 0xFF))
+
+        return self.material_ids[name]
+
+    def local(self, brush):
+        # A brush's arrays in its own coordinates
+        vertices, edges, index, table = _brushArrays(brush)
+        materials = list(brush.materials) or [""]
+        colors = list(brush.colors) + [None] * (len(materials) - len(brush.colors))
+
+        return vertices, edges, index, table, [self.material(name, color) for name, color in zip(materials, colors)]
+
+    def add(self, part, prefab=-1):
+        if len(part[0]):
+            self.parts.append(part + (prefab,))
+
+    def build(self):
+        geometry = self.geometry
+        parts = self.parts
+
+        num_vertices = np.array([len(part[0]) for part in parts], np.int64)
+        num_faces = np.array([len(part[1]) for part in parts], np.int64)
+        num_entries = np.array([len(part[3]) for part in parts], np.int64)
+        num_materials = np.array([len(part[4]) for part in parts], np.int64)
+
+        vertices = _concatenate([part[0] for part in parts], np.float32).reshape(-1, 3)
+        edges = _concatenate([part[1] for part in parts], np.int64)
+        index = _concatenate([part[2] for part in parts], np.int64)
+        table = _concatenate([part[3] for part in parts], np.int64)
+        material_ids = np.array([material_id for part in parts for material_id in part[4]], np.int64)
+
+        brushes = np.arange(len(parts))
+        face_brush = np.repeat(brushes, num_faces)
+        entry_brush = np.repeat(brushes, num_entries)
+
+        # Brushes whose faces don't use up exactly their faceTable, or point past their vertices, are left out
+        table_max = np.full(len(parts), -1, np.int64)
+        np.maximum.at(table_max, entry_brush, table)
+        valid = (np.bincount(face_brush, edges, len(parts)) == num_entries) & (table_max < num_vertices)
+        geometry.skipped = int(len(parts) - valid.sum())
+
+        # Face.index into the brush's own materials, the first one when it's out of range
+        material_starts = np.cumsum(num_materials) - num_materials
+        index = np.where(index < num_materials[face_brush], index, 0)
+        face_material = material_ids[material_starts[face_brush] + index]
+
+        keep_faces = valid[face_brush]
+        keep_entries = valid[entry_brush]
+        num_vertices = num_vertices[valid]
+
+        geometry.brush_starts = np.concatenate([[0], np.cumsum(num_vertices)])
+        geometry.vertices = vertices[np.repeat(valid, np.array([len(part[0]) for part in parts], np.int64))]
+        geometry.face_edges = edges[keep_faces]
+        geometry.face_material = face_material[keep_faces]
+        geometry.face_brush = np.repeat(np.arange(len(num_vertices)), num_faces[valid])
+        geometry.face_table = table[keep_entries] + np.repeat(geometry.brush_starts[:-1], num_entries[valid])
+        geometry.brush_prefab = np.array([part[5] for part in parts], np.int64)[valid]
+
+        return geometry
+
+
+def map_geometry(brushes, state=None):
+    # MapGeometry of brushes (a list of Brushes) plus the prefab instances in state (a WorldState)
+    builder = _Builder()
+
+    for brush in brushes:
+        builder.add(builder.local(brush))
+
+    if state is None:
+        return builder.build()
+
+    definitions = {} # {prefabName: ([local arrays of every brush], all their vertices)}, shared by every instance
+
+    for entity_id, entity in state.of_type(0x15):
+        fields = entity.fields
+        name = fields.get("prefabName")
+
+        if name not in state.prefabs:
+            continue
+
+        if name not in definitions:
+            parts = [builder.local(brush) for prefab_entity in state.prefabs[name].entities for brush in prefab_entity.brushes]
+            vertices = _concatenate([part[0] for part in parts], np.float64).reshape(-1, 3)
+            definitions[name] = (parts, vertices, np.cumsum([len(part[0]) for part in parts])[:-1])
+
+        parts, vertices, splits = definitions[name]
+        position = fields.get("position")
+        angles = fields.get("angles")
+
+        matrix = rotation(angles) if angles is not None else np.identity(3)
+        offset = np.array([position.x, position.y, position.z]) if position is not None else np.zeros(3)
+
+        # One transform per instance, then split back into its brushes
+        for part, placed in zip(parts, np.split((vertices @ matrix.T + offset).astype(np.float32), splits)):
+            builder.add((placed,) + part[1:], entity_id)
+
+    return builder.build()
+
+
+def tick_map(tick):
+    # (brushes, WorldState after it) of a replay's first tick
+    state = WorldState()
+    state.apply(tick)
+
+    return tickItems(tick, "brushes"), state
+
+
+def load_map(replay_p):
+    # tick_map of the first tick, parsing nothing past it
+    header, ticks = iter_replay(replay_p, engine="fast", entity_types={0x15}, numpy=True)
+
+    try:
+        tick = next(ticks)
+    finally:
+        ticks.close()
+
+    return tick_map(tick)
+
+
+def write_obj(obj_p, geometry, mtl_p=None):
+    # Wavefront OBJ with a group per material, plus an MTL file next to it with every material's color
+    mtl_p = mtl_p or os.path.splitext(obj_p)[0] + ".mtl"
+    triangles, materials = geometry.triangles()
+
+    # Grouped by material, in the order materials were first seen
+    order = np.argsort(materials, kind="stable")
+    triangles = triangles[order] + 1
+    materials = materials[order]
+    group_starts = np.searchsorted(materials, np.arange(len(geometry.materials) + 1))
+
+    with open(obj_p, "w") as obj_f:
+        obj_f.write("# %d brushes, %d vertices, %d triangles\n" % (len(geometry), len(geometry.vertices), len(triangles)))
+        obj_f.write("mtllib %s\n" % os.path.basename(mtl_p))
+
+        # One big % per block instead of a call per line
+        obj_f.write("v %.4f %.4f %.4f\n" * len(geometry.vertices) % tuple(geometry.vertices.ravel().tolist()))
+
+        for i, name in enumerate(geometry.materials):
+            group = triangles[group_starts[i]:group_starts[i + 1]]
+
+            if not len(group):
+                continue
+
+            obj_f.write("g %s\nusemtl %s\n" % (_objName(name), _objName(name)))
+            obj_f.write("f %d %d %d\n" * len(group) % tuple(group.ravel().tolist()))
+
+    with open(mtl_p, "w") as mtl_f:
+        for name, color in zip(geometry.materials, geometry.colors):
+            mtl_f.write("newmtl %s\nKd %.4f %.4f %.4f\n\n" % ((_objName(name),) + tuple(c / 255 for c in color)))
+
+    return len(triangles)
+
+
+def _objName(name):
+    # Material paths without whitespace, OBJ names end at the first space
+    return "_".join(name.split()) or "none"
+
+
+def export_obj(replay_p, obj_p):
+    brushes, state = load_map(replay_p)
+    geometry = map_geometry(brushes, state)
+
+    return geometry, write_obj(obj_p, geometry)
+
+
+if __name__ == "__main__":
+    # python replay_mesh.py match.rep [match.obj]
+    replay_p = sys.argv[1]
+    obj_p = sys.argv[2] if len(sys.argv) > 2 else os.path.splitext(replay_p)[0] + ".obj"
+
+    geometry, num_triangles = export_obj(replay_p, obj_p)
+
+    print("%d brushes (%d skipped), %d materials, %d triangles" % (len(geometry), geometry.skipped, len(geometry.materials), num_triangles))
+    print("Saved to", obj_p)
@@ -0,0 +1,178 @@
+import sys
+import collections
+
+from replay import *
+from replay_state import FIELD_PLANS, WorldState, maskByte, mask
+
+# Drop entity fields that don't change anything
+#
+#   stats = optimize("match.rep", "match.min.rep")
+#   stats.print()
+#
+# Plenty of updates send fields again with the value the entity already has, a Player's position while
+# it stands still, its weaponHeld on every tick it doesn't switch. Folding the replay the same way
+# replay_state.py does, those fields are taken out of their updates and their mask bits cleared. Updates
+# left with nothing in them are dropped altogether. Creates and destroys are never touched, so the state
+# at every tick is the same as in the original replay.
+#
+# Ticks without any redundant fields are copied from their original bytes, see Replay.parse(raw=True).
+
+
+class OptimizeStats:
+    def __init__(self):
+        # {entityTypeS: Counter(updates=, fields=, dropped=, bytes=)}
+        self.types = collections.defaultdict(collections.Counter)
+
+    def total(self):
+        return sum(self.types.values(), collections.Counter())
+
+    def print(self, f=sys.stdout):
+        print("%-20s %10s %10s %10s %10s" % ("entityType", "updates", "fields", "dropped", "bytes"), file=f)
+
+        for name, counts in sorted(self.types.items(), key=lambda item: -item[1]["bytes"]):
+            print("%-20s %10d %10d %10d %10d" % (name, counts["updates"], counts["fields"], counts["dropped"], counts["bytes"]), file=f)
+
+        total = self.total()
+        print("%-20s %10d %10d %10d %10d" % ("total", total["updates"], total["fields"], total["dropped"], total["bytes"]), file=f)
+
+
+def _same(a, b):
+    return a is b or a == b
+
+
+def optimizeEntity(entity, current, stats):
+    # Clears the fields of an update that current already has. Returns False if nothing is left of it.
+    plan = FIELD_PLANS.get(entity.entityType)
+
+    if plan is None or entity.fields is None or not current:
+        return True
+
+    fields = entity.fields
+    bits = {"m1": maskByte(entity.m1)}
+
+    for name, gate in plan.masks:
+        if fields[name] is not None:
+            bits[name] = maskByte(fields[name])
+
+    original = dict(bits)
+    removed = []
+
+    for mask_name, group in plan.groups:
+        b = bits.get(mask_name)
+
+        if not b:
+            continue
+
+        for bit, name in group:
+            if b & bit and name in current and _same(fields[name], current[name]):
+                b &= ~bit
+                removed.append((mask_name, name))
+
+        bits[mask_name] = b
+
+    if not removed:
+        return True
+
+    open_masks = {}
+
+    for name, gate in plan.masks:
+        if name not in bits:
+            continue
+
+        open_masks[name] = gate is None or plan.gate_open(gate, bits["m1"])
+
+        if not open_masks[name] and bits[name]:
+            # Clearing m1 would close the gate of a mask that still flags something, keep m1 as it was
+            bits["m1"] = original["m1"]
+            removed = [(mask_name, name) for mask_name, name in removed if mask_name != "m1"]
+
+            return _clear(entity, plan, bits, original, removed, stats) if removed else True
+
+    return _clear(entity, plan, bits, original, removed, stats)
+
+
+def _clear(entity, plan, bits, original, removed, stats):
+    fields = entity.fields
+    counts = stats.types[entity.entityTypeS]
+    saved = 0
+
+    for mask_name, name in removed:
+        saved += plan.field_size(name, fields[name])
+        fields[name] = None
+
+    counts["fields"] += len(removed)
+
+    entity["m1"] = mask(bits["m1"])
+    written = 0
+
+    for name, gate in plan.masks:
+        if name not in bits:
+            continue
+
+        if gate is not None and not plan.gate_open(gate, bits["m1"]):
+            fields[name] = None
+            saved += 1
+        else:
+            fields[name] = mask(bits[name])
+            written += 1
+
+    if not any(bits.values()) and not plan.always:
+        # 4 bytes of ent, m1 and every mask that's still written
+        counts["dropped"] += 1
+        counts["bytes"] += saved + 5 + written
+
+        return False
+
+    counts["bytes"] += saved
+
+    return True
+
+
+def optimize_ticks(ticks, stats=None):
+    # Yields the optimized ticks. Entities are edited in place.
+    stats = OptimizeStats() if stats is None else stats
+    world = WorldState()
+
+    for tick in ticks:
+        for chunk in tick.prefabChunks:
+            for prefab in chunk.prefabs:
+                world.prefabs[prefab.prefabName] = prefab
+
+        entities = tickItems(tick, "entities")
+        kept = []
+
+        for entity in entities:
+            if not entity.ent.destroy and not entity.m1.x1:
+                stats.types[entity.entityTypeS]["updates"] += 1
+                current = world.entities.get(entity.ent.id)
+
+                if not optimizeEntity(entity, current.fields if current is not None else None, stats):
+                    continue
+
+            world.apply_entity(entity, tick.timecode)
+            kept.append(entity)
+
+        world.timecode = tick.timecode
+
+        if len(kept) != len(entities):
+            tick = Container(timecode=tick.timecode, prefabChunks=tick.prefabChunks,
+                             entityChunks=makeChunks(kept, "entities"), brushChunks=tick.brushChunks)
+
+        yield tick
+
+
+def optimize(replay_p, out, stats=None):
+    # Streams replay_p into out (a path or file), returns the OptimizeStats
+    stats = OptimizeStats() if stats is None else stats
+    header, ticks = iter_replay(replay_p, engine="fast", raw=True)
+
+    with ReplayWriter(out, header) as writer:
+        for tick in optimize_ticks(ticks, stats):
+            writer.write_tick(tick)
+
+    return stats
+
+
+if __name__ == "__main__":
+    # python replay_optimize.py match.rep match.min.rep
+    optimize(sys.argv[1], sys.argv[2]).print()
@@ -0,0 +1,222 @@
+import sys
+import time
+import struct
+import collections
+
+from replay import *
+from replay_state import FIELD_PLANS, maskByte
+
+# Where a replay's bytes and parse time go
+#
+#   profile = ParseProfile()
+#   replay = Replay.parse(replay_b, engine="fast", profile=profile)
+#   profile.print()
+#
+# iter_replay / iter_ticks take profile= as well (engine="fast" only), and so do the --profile flags of
+# print_replay.py, replay_batch.py parse and trajectories.py. Counted are:
+#
+#   chunks      per chunk kind (prefabs, entities, brushes): items, bytes and decode time
+#   types       per entityType: entities (creates, updates, destroys), bytes and decode time
+#   bits        per entityType, mask and bit: how often it's set and the bytes of the fields it flags
+#
+# Times are wall time around every decode call, so they include the profiling overhead of timing them.
+# The bytes a tick spends on its timecode and chunk amounts show up as the tick overhead.
+
+_U32 = struct.Struct("<I")
+
+KINDS = ["prefabs", "entities", "brushes"]
+
+
+def _entityType(buf, off, lookups):
+    # The entityType of the entity at off, before decoding it pops it from / adds it to the lookups
+    raw, = _U32.unpack_from(buf, off)
+
+    if not raw & 1 and buf[off + 4] & 0x01:
+        return buf[off + 5]
+
+    return lookups.entities.get(raw >> 1)
+
+
+class ParseProfile:
+    def __init__(self):
+        self.ticks = collections.Counter() # count, bytes
+        self.chunks = {kind: collections.Counter() for kind in KINDS} # {kind: Counter(count=, bytes=, seconds=)}
+        self.types = collections.defaultdict(collections.Counter) # {entityType: Counter(count=, creates=, ..., seconds=)}
+        self.bits = collections.defaultdict(collections.Counter) # {(entityType, mask name, bit): Counter(count=, bytes=)}
+
+        self._pending = []
+
+    def wrap(self, decode_prefab, decode_entity, decode_brush):
+        # Called by fast_replay.decode_tick at the start of every tick. Items are only counted once their
+        # tick decoded completely, iter_replay retries ticks that ran past the end of its buffer.
+        self._pending = []
+
+        return self._wrapItem("prefabs", decode_prefab), self._wrapEntity(decode_entity), self._wrapItem("brushes", decode_brush)
+
+    def _wrapItem(self, kind, decode):
+        pending = self._pending
+        clock = time.perf_counter
+
+        def profiled(buf, off, lookups):
+            start = clock()
+            item, end = decode(buf, off, lookups)
+            pending.append((kind, None, None, end - off, clock() - start))
+
+            return item, end
+
+        return profiled
+
+    def _wrapEntity(self, decode):
+        pending = self._pending
+        clock = time.perf_counter
+
+        def profiled(buf, off, lookups):
+            entity_type = _entityType(buf, off, lookups)
+
+            start = clock()
+            entity, end = decode(buf, off, lookups)
+            pending.append(("entities", entity_type, entity, end - off, clock() - start))
+
+            return entity, end
+
+        return profiled
+
+    def tick(self, nbytes):
+        self.ticks["count"] += 1
+        self.ticks["bytes"] += nbytes
+
+        for kind, entity_type, entity, nbytes, seconds in self._pending:
+            chunk = self.chunks[kind]
+            chunk["count"] += 1
+            chunk["bytes"] += nbytes
+            chunk["seconds"] += seconds
+
+            if kind == "entities":
+                self._entity(entity_type, entity, nbytes, seconds)
+
+        self._pending.clear()
+
+    def _entity(self, entity_type, entity, nbytes, seconds):
+        counts = self.types[entity_type]
+        counts["count"] += 1
+        counts["bytes"] += nbytes
+        counts["seconds"] += seconds
+
+        if entity is None:
+            # Stepped over by an entity_types projection
+            counts["skipped"] += 1
+            return
+
+        if entity.ent.destroy:
+            counts["destroys"] += 1
+            return
+
+        counts["creates" if entity.m1.x1 else "updates"] += 1
+
+        plan = FIELD_PLANS.get(entity_type)
+
+        if plan is None or entity.fields is None:
+            return
+
+        fields = entity.fields
+
+        for mask_name, group in plan.groups:
+            flags = entity.m1 if mask_name == "m1" else fields[mask_name]
+
+            if flags is None:
+                continue
+
+            b = maskByte(flags)
+
+            if not b:
+                continue
+
+            for bit, name in group:
+                if b & bit:
+                    # Fields sharing a bit (CameraPath) are counted once per field, under the same bit
+                    counts = self.bits[(entity_type, mask_name, bit)]
+                    counts["count"] += 1
+                    counts["bytes"] += plan.field_size(name, fields[name])
+
+    def merge(self, other):
+        # Add another profile's counts to this one, e.g. from the workers of replay_batch.py
+        self.ticks.update(other.ticks)
+
+        for kind in KINDS:
+            self.chunks[kind].update(other.chunks[kind])
+
+        for key, counts in other.types.items():
+            self.types[key].update(counts)
+
+        for key, counts in other.bits.items():
+            self.bits[key].update(counts)
+
+        return self
+
+    def __getstate__(self):
+        # Without the per-tick scratch list, and with plain dicts so it pickles without the defaultdicts
+        return {"ticks": self.ticks, "chunks": self.chunks, "types": dict(self.types), "bits": dict(self.bits)}
+
+    def __setstate__(self, state):
+        self.__init__()
+        self.ticks = state["ticks"]
+        self.chunks = state["chunks"]
+        self.types.update(state["types"])
+        self.bits.update(state["bits"])
+
+    def report(self):
+        # Everything as plain dicts and lists, ready for json.dump
+        def fieldNames(entity_type, mask_name, bit):
+            return [name for name, field_mask, field_bit in FIELD_PLANS[entity_type].fields if field_mask == mask_name and field_bit == bit]
+
+        return {
+            "ticks": dict(self.ticks),
+            "chunks": {kind: dict(counts) for kind, counts in self.chunks.items()},
+            "entity_types": [dict(counts, entityType=entity_type, name=ENTITY_TYPES.get(entity_type, "unknown"))
+                             for entity_type, counts in sorted(self.types.items(), key=lambda item: -item[1]["bytes"])],
+            "mask_bits": [dict(counts, entityType=entity_type, name=ENTITY_TYPES.get(entity_type, "unknown"), mask=mask_name,
+                               bit=bit, fields=fieldNames(entity_type, mask_name, bit))
+                          for (entity_type, mask_name, bit), counts in sorted(self.bits.items(), key=lambda item: -item[1]["bytes"])],
+        }
+
+    def print(self, f=sys.stdout, top=25):
+        report = self.report()
+        total = report["ticks"].get("bytes", 0) or 1
+        items = sum(counts.get("bytes", 0) for counts in report["chunks"].values())
+
+        print("%d ticks, %d bytes (%.1f%% timecodes and chunk amounts)" % (
+            report["ticks"].get("count", 0), report["ticks"].get("bytes", 0), 100 * (total - items) / total), file=f)
+        print(file=f)
+
+        print("%-10s %10s %12s %7s %10s" % ("chunks", "items", "bytes", "%", "ms"), file=f)
+
+        for kind, counts in report["chunks"].items():
+            print("%-10s %10d %12d %6.1f%% %10.1f" % (kind, counts.get("count", 0), counts.get("bytes", 0),
+                                                     100 * counts.get("bytes", 0) / total, 1000 * counts.get("seconds", 0)), file=f)
+
+        print(file=f)
+        print("%-22s %9s %9s %9s %9s %12s %7s %10s %8s" % ("entityType", "count", "creates", "updates", "destroys", "bytes", "%", "ms", "us/ent"), file=f)
+
+        for counts in report["entity_types"]:
+            print("%-22s %9d %9d %9d %9d %12d %6.1f%% %10.1f %8.2f" % (
+                counts["name"], counts["count"], counts.get("creates", 0), counts.get("updates", 0), counts.get("destroys", 0),
+                counts["bytes"], 100 * counts["bytes"] / total, 1000 * counts["seconds"], 1e6 * counts["seconds"] / counts["count"]), file=f)
+
+        print(file=f)
+        print("%-22s %-5s %4s %9s %12s %7s  %s" % ("entityType", "mask", "bit", "count", "bytes", "%", "fields"), file=f)
+
+        for counts in report["mask_bits"][:top]:
+            print("%-22s %-5s 0x%02X %9d %12d %6.1f%%  %s" % (
+                counts["name"], counts["mask"], counts["bit"], counts["count"], counts["bytes"],
+                100 * counts["bytes"] / total, ", ".join(counts["fields"])), file=f)
+
+
+if __name__ == "__main__":
+    # python replay_profile.py match.rep [more.rep ...]
+    profile = ParseProfile()
+
+    for replay_p in sys.argv[1:]:
+        with open(replay_p, "rb") as replay_f:
+            Replay.parse(replay_f.read(), engine="fast", profile=profile)
+
+    profile.print()
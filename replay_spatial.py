@@ -0,0 +1,412 @@
+import sys
+import hashlib
+
+import numpy as np
+
+import fast_replay
+from replay import *
+from replay_cache import ParseCache, CACHE_SCHEMA
+from replay_mesh import tick_map, map_geometry
+
+# Spatial index over a map's brushes, prefab instances included
+#
+#   index = brush_index("match.rep")
+#   index.within((x, y, z), 500)                  # brushes within 500 units of a point
+#   index.points_inside(positions)                # (n,) brush each point is inside of, -1 for none
+#   index.rays(origins, directions, 1000)         # first brush every ray hits, and how far away
+#
+# Brushes are binned by their bounding boxes into a uniform grid of cells (CSR arrays: the sorted keys
+# of occupied cells and the brushes in each). Brushes that would cover more than MAX_CELLS cells (floors,
+# skyboxes) skip the grid and are tested against every query instead. Queries look up the cells they
+# touch, rays are cut into pieces of a couple of cells and look up the cells of every piece's bounding
+# box, and the candidates are then tested exactly: brushes are convex, so a point is inside one when it's
+# behind all of its face planes.
+#
+# Every query has a bulk version taking (n, 3) arrays, which looks up and tests all of them in a few NumPy
+# operations. Rows that aren't finite (the NaNs of trajectories.py) never match anything. Results of the
+# bulk versions are pairs: (query indices, brush indices), sorted by query.
+#
+# brush_index() keeps indexes in memory and in the parse cache (see replay_cache.py), keyed by a hash of
+# the map's brushes, prefabs and prefab instances, so every replay on the same map shares one. Only the
+# header and the first tick are read from the replay, hit or miss.
+
+MAX_CELLS = 64
+RAY_PIECE = 2 # cells, see BrushIndex._segments
+INDEX_VERSION = 1
+
+_EPSILON = 1e-3 # units a point may be outside a face plane and still count as inside
+
+_INDEXES = {} # {key: BrushIndex}, for brush_index()
+
+
+def _cells(ilo, span, dims):
+    # Every cell of every box from its first cell and size in cells: (box of every cell, cell keys)
+    counts = np.prod(span, axis=1)
+    boxes = np.repeat(np.arange(len(span)), counts)
+    k = np.arange(len(boxes)) - np.repeat(np.cumsum(counts) - counts, counts)
+
+    sy = span[boxes, 1]
+    sz = span[boxes, 2]
+    cells = ilo[boxes] + np.stack([k // (sy * sz), k // sz % sy, k % sz], axis=1)
+
+    return boxes, (cells[:, 0] * dims[1] + cells[:, 1]) * dims[2] + cells[:, 2]
+
+
+def _groups(counts):
+    # Start of every group in a flat array of groups with these sizes
+    return np.cumsum(counts) - counts
+
+
+class BrushIndex:
+    def __init__(self, geometry, cell_size=None):
+        self.geometry = geometry
+        self.lo, self.hi = (bounds.astype(np.float64) for bounds in geometry.bounds())
+
+        num_brushes = len(geometry)
+
+        if cell_size is None:
+            # Twice the typical brush, so most brushes only cover a few cells
+            cell_size = 2 * float(np.median((self.hi - self.lo).max(axis=1))) if num_brushes else 1.0
+
+        self.cell_size = max(cell_size, 1.0)
+        self.origin = self.lo.min(axis=0) if num_brushes else np.zeros(3)
+        self.dims = (np.floor(((self.hi.max(axis=0) if num_brushes else self.origin) - self.origin) / self.cell_size).astype(np.int64) + 1)
+
+        ilo = self._cell(self.lo)
+        span = self._cell(self.hi) - ilo + 1
+        big = np.prod(span, axis=1) > MAX_CELLS
+
+        self.big = np.flatnonzero(big)
+        small = np.flatnonzero(~big)
+
+        boxes, keys = _cells(ilo[small], span[small], self.dims)
+        order = np.argsort(keys, kind="stable")
+
+        self.cell_keys, starts = np.unique(keys[order], return_index=True)
+        self.cell_starts = np.append(starts, len(keys))
+        self.cell_brushes = small[boxes[order]]
+
+        self._planes()
+
+    def _cell(self, points):
+        return np.floor((points - self.origin) / self.cell_size).astype(np.int64)
+
+    def _planes(self):
+        # Every face as an outward plane (normal, distance), grouped by brush
+        geometry = self.geometry
+        vertices = geometry.vertices.astype(np.float64)
+        edges = geometry.face_edges
+
+        # Newell's method, which doesn't mind collinear corners
+        face_starts = _groups(edges)
+        entry_face = np.repeat(np.arange(len(edges)), edges)
+        entries = np.arange(len(entry_face))
+        following = np.where(entries + 1 < face_starts[entry_face] + edges[entry_face], entries + 1, face_starts[entry_face])
+
+        a = vertices[geometry.face_table]
+        b = vertices[geometry.face_table[following]]
+        cross = np.stack([(a[:, 1] - b[:, 1]) * (a[:, 2] + b[:, 2]), (a[:, 2] - b[:, 2]) * (a[:, 0] + b[:, 0]),
+                          (a[:, 0] - b[:, 0]) * (a[:, 1] + b[:, 1])], axis=1)
+
+        normals = np.zeros((len(edges), 3))
+        centers = np.zeros((len(edges), 3))
+        np.add.at(normals, entry_face, cross)
+        np.add.at(centers, entry_face, a)
+        centers /= np.maximum(edges, 1)[:, None]
+
+        lengths = np.linalg.norm(normals, axis=1)
+        keep = (edges >= 3) & (lengths > 1e-9)
+        normals = normals[keep] / lengths[keep, None]
+        distances = np.einsum("ij,ij->i", normals, centers[keep])
+        face_brush = geometry.face_brush[keep]
+
+        # Brushes are convex, their vertices' mean is inside, so it has to be behind every plane
+        counts = np.diff(geometry.brush_starts)
+        middles = np.zeros((len(counts), 3))
+        np.add.at(middles, np.repeat(np.arange(len(counts)), counts), vertices)
+        middles /= np.maximum(counts, 1)[:, None]
+
+        flip = np.einsum("ij,ij->i", normals, middles[face_brush]) > distances
+        normals[flip] *= -1
+        distances[flip] *= -1
+
+        self.normals = normals
+        self.distances = distances
+        self.face_counts = np.bincount(face_brush, minlength=len(counts))
+        self.face_starts = _groups(self.face_counts)
+
+    def __len__(self):
+        return len(self.lo)
+
+    # Candidates
+
+    def _pairs(self, queries, keys, owners):
+        # (query, brush) pairs out of the cells every query touches (keys, with the query of every key in
+        # owners), plus the big brushes for every query. Deduplicated and sorted by query.
+        if not len(self):
+            return np.zeros(0, np.int64), np.zeros(0, np.int64)
+
+        index = np.searchsorted(self.cell_keys, keys)
+        index = np.minimum(index, max(len(self.cell_keys) - 1, 0))
+        found = (self.cell_keys[index] == keys) if len(self.cell_keys) else np.zeros(len(keys), bool)
+
+        index = index[found]
+        owners = owners[found]
+        counts = self.cell_starts[index + 1] - self.cell_starts[index]
+
+        query = np.repeat(owners, counts)
+        brush = self.cell_brushes[np.repeat(self.cell_starts[index], counts) + np.arange(counts.sum()) - np.repeat(_groups(counts), counts)]
+
+        if len(self.big):
+            query = np.concatenate([query, np.repeat(queries, len(self.big))])
+            brush = np.concatenate([brush, np.tile(self.big, len(queries))])
+
+        codes = np.unique(query * len(self) + brush)
+
+        return codes // len(self), codes % len(self)
+
+    def boxes(self, lo, hi):
+        # (query, brush) pairs of every box (lo[i], hi[i]) and every brush whose bounding box overlaps it
+        lo = np.atleast_2d(np.asarray(lo, np.float64))
+        hi = np.atleast_2d(np.asarray(hi, np.float64))
+
+        valid = np.isfinite(lo).all(axis=1) & np.isfinite(hi).all(axis=1)
+        valid &= (hi >= self.origin).all(axis=1) & (lo <= self.origin + self.dims * self.cell_size).all(axis=1)
+        queries = np.flatnonzero(valid)
+
+        ilo = np.clip(self._cell(lo[queries]), 0, self.dims - 1)
+        span = np.clip(self._cell(hi[queries]), 0, self.dims - 1) - ilo + 1
+
+        boxes, keys = _cells(ilo, span, self.dims)
+        query, brush = self._pairs(queries, keys, queries[boxes])
+
+        overlap = (self.lo[brush] <= hi[query]).all(axis=1) & (self.hi[brush] >= lo[query]).all(axis=1)
+
+        return query[overlap], brush[overlap]
+
+    def box(self, lo, hi):
+        return self.boxes([lo], [hi])[1]
+
+    # Points
+
+    def _inside(self, points, query, brush):
+        # Which of the (point, brush) pairs have the point inside the brush
+        counts = self.face_counts[brush]
+        has_faces = counts > 0
+        query, brush, counts = query[has_faces], brush[has_faces], counts[has_faces]
+
+        pair = np.repeat(np.arange(len(brush)), counts)
+        faces = np.repeat(self.face_starts[brush], counts) + np.arange(counts.sum()) - np.repeat(_groups(counts), counts)
+
+        outside = np.einsum("ij,ij->i", self.normals[faces], points[query[pair]]) - self.distances[faces]
+        inside = np.zeros(len(brush), bool)
+
+        if len(brush):
+            inside = np.maximum.reduceat(outside, _groups(counts)) <= _EPSILON
+
+        return query[inside], brush[inside]
+
+    def points(self, points):
+        # (point, brush) pairs of every point and every brush it's inside of
+        points = np.atleast_2d(np.asarray(points, np.float64))
+        query, brush = self.boxes(points, points)
+
+        return self._inside(points, query, brush)
+
+    def points_inside(self, points):
+        # (n,) the first brush every point is inside of, -1 for points in the open
+        points = np.atleast_2d(np.asarray(points, np.float64))
+        query, brush = self.points(points)
+
+        result = np.full(len(points), -1, np.int64)
+        first = np.unique(query, return_index=True)[1]
+        result[query[first]] = brush[first]
+
+        return result
+
+    def point(self, point):
+        # Every brush the point is inside of
+        return self.points([point])[1]
+
+    def pairs_within(self, points, radius):
+        # (point, brush) pairs of every point and every brush whose bounding box is within radius of it
+        points = np.atleast_2d(np.asarray(points, np.float64))
+        query, brush = self.boxes(points - radius, points + radius)
+
+        p = points[query]
+        gap = np.maximum(np.maximum(self.lo[brush] - p, 0), p - self.hi[brush])
+        near = np.einsum("ij,ij->i", gap, gap) <= radius * radius
+
+        return query[near], brush[near]
+
+    def within(self, point, radius):
+        return self.pairs_within([point], radius)[1]
+
+    # Rays
+
+    def _segments(self, origins, directions, length):
+        # Every ray clipped to the grid and cut into pieces of at most RAY_PIECE cells, as boxes:
+        # (ray of every piece, lo, hi). Rays that miss the grid have no pieces.
+        grid_lo = self.origin
+        grid_hi = self.origin + self.dims * self.cell_size
+        inside = (origins >= grid_lo) & (origins <= grid_hi)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t1 = np.where(directions == 0, np.where(inside, -np.inf, np.inf), (grid_lo - origins) / directions)
+            t2 = np.where(directions == 0, np.where(inside, np.inf, -np.inf), (grid_hi - origins) / directions)
+
+        start = np.maximum(np.minimum(t1, t2).max(axis=1), 0.0)
+        end = np.minimum(np.maximum(t1, t2).min(axis=1), length)
+        rays = np.flatnonzero(start <= end)
+
+        piece = RAY_PIECE * self.cell_size
+        counts = np.floor((end[rays] - start[rays]) / piece).astype(np.int64) + 1
+        owners = np.repeat(rays, counts)
+        k = np.arange(counts.sum()) - np.repeat(_groups(counts), counts)
+
+        t_lo = start[owners] + k * piece
+        t_hi = np.minimum(t_lo + piece, end[owners])
+        a = origins[owners] + directions[owners] * t_lo[:, None]
+        b = origins[owners] + directions[owners] * t_hi[:, None]
+
+        return owners, np.minimum(a, b), np.maximum(a, b)
+
+    def rays(self, origins, directions, length=np.inf):
+        # (n,) the first brush every ray hits within length, -1 for none, and (n,) how far along it is.
+        # Rays starting inside a brush hit it at 0.
+        origins = np.atleast_2d(np.asarray(origins, np.float64))
+        directions = np.atleast_2d(np.asarray(directions, np.float64))
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            directions = directions / np.linalg.norm(directions, axis=1)[:, None]
+
+        result = np.full(len(origins), -1, np.int64)
+        distance = np.full(len(origins), np.inf)
+
+        valid = np.isfinite(origins).all(axis=1) & np.isfinite(directions).all(axis=1)
+        queries = np.flatnonzero(valid)
+
+        if not len(self) or not len(queries):
+            return result, distance
+
+        # Candidates are the brushes overlapping the boxes of the ray's pieces, then tested exactly
+        owners, lo, hi = self._segments(origins[queries], directions[queries], length)
+        piece, brush = self.boxes(lo, hi)
+
+        codes = np.unique(queries[owners[piece]] * len(self) + brush)
+        query, brush, t = self._hits(origins, directions, codes // len(self), codes % len(self), length)
+
+        order = np.lexsort((t, query))
+        first = order[np.unique(query[order], return_index=True)[1]]
+        result[query[first]] = brush[first]
+        distance[query[first]] = t[first]
+
+        return result, distance
+
+    def _hits(self, origins, directions, query, brush, length):
+        # Clips every (ray, brush) pair against the brush's planes (Cyrus & Beck): (ray, brush, distance) of the hits
+        counts = self.face_counts[brush]
+        has_faces = counts > 0
+        query, brush, counts = query[has_faces], brush[has_faces], counts[has_faces]
+
+        if not len(brush):
+            return query, brush, np.zeros(0)
+
+        pair = np.repeat(np.arange(len(brush)), counts)
+        faces = np.repeat(self.face_starts[brush], counts) + np.arange(counts.sum()) - np.repeat(_groups(counts), counts)
+
+        normals = self.normals[faces]
+        facing = np.einsum("ij,ij->i", normals, directions[query[pair]])
+        behind = self.distances[faces] - np.einsum("ij,ij->i", normals, origins[query[pair]])
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t = behind / facing
+
+        groups = _groups(counts)
+        enter = np.maximum.reduceat(np.where(facing < 0, t, -np.inf), groups)
+        leave = np.minimum.reduceat(np.where(facing > 0, t, np.inf), groups)
+        parallel_outside = np.maximum.reduceat((facing == 0) & (behind < -_EPSILON), groups)
+
+        hit = ~parallel_outside & (enter <= leave) & (leave >= 0) & (enter <= length)
+
+        return query[hit], brush[hit], np.maximum(enter[hit], 0)
+
+    def ray(self, origin, direction, length=np.inf):
+        # (brush, distance) of the first brush the ray hits, (-1, inf) for none
+        result, distance = self.rays([origin], [direction], length)
+
+        return int(result[0]), float(distance[0])
+
+
+def map_key(replay_b):
+    # Hash of the bytes that make up the map in tick 0: prefab definitions, brushes and Prefab entities.
+    # replay_b has to go as far as the end of tick 0, see read_first_tick.
+    h = hashlib.sha256(b"%d" % INDEX_VERSION)
+    items, off = fast_replay.tick_layout(replay_b, HEADER_SIZE, ReplayLookups())
+
+    for kind, index, start, end, entity_id, entity_type in items:
+        if kind in ["prefab", "brush"] or (kind == "entity" and entity_type == 0x15):
+            h.update(replay_b[start:end])
+
+    return h.hexdigest()
+
+
+def read_first_tick(replay_p):
+    # The bytes of the header and the first tick, read in blocks that double until the tick fits
+    with open(replay_p, "rb") as replay_f:
+        replay_b = replay_f.read(1 << 20)
+
+        while True:
+            try:
+                items, end = fast_replay.tick_layout(replay_b, HEADER_SIZE, ReplayLookups())
+            except Exception:
+                more = replay_f.read(len(replay_b))
+
+                if not more:
+                    raise
+
+                replay_b += more
+                continue
+
+            return replay_b[:end]
+
+
+def brush_index(replay_p, cell_size=None, cache=None):
+    # The BrushIndex of a replay's map, built once per map
+    replay_b = read_first_tick(replay_p)
+    key = "brushes-%s-%s-%s" % (map_key(replay_b), cell_size, CACHE_SCHEMA)
+
+    if key in _INDEXES:
+        return _INDEXES[key]
+
+    if cache is None:
+        cache = ParseCache()
+
+    index = cache.get(key) if cache.enabled else None
+
+    if index is None:
+        tick, end = fast_replay.decode_tick(replay_b, HEADER_SIZE, ReplayLookups(), entity_types={0x15}, numpy=True)
+        index = BrushIndex(map_geometry(*tick_map(tick)), cell_size)
+
+        if cache.enabled:
+            try:
+                cache.put(key, index)
+            except OSError:
+                pass
+
+    _INDEXES[key] = index
+
+    return index
+
+
+if __name__ == "__main__":
+    # python replay_spatial.py match.rep x y z [radius]
+    index = brush_index(sys.argv[1])
+    point = [float(c) for c in sys.argv[2:5]]
+    radius = float(sys.argv[5]) if len(sys.argv) > 5 else 0.0
+
+    print("%d brushes in %d cells of %g units, %d too big for the grid" % (len(index), len(index.cell_keys), index.cell_size, len(index.big)))
+    print("Inside:", ", ".join(str(brush) for brush in index.point(point)) or "nothing")
+
+    if radius:
+        print("Within %g:" % radius, ", ".join(str(brush) for brush in index.within(point, radius)) or "nothing")
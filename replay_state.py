@@ -0,0 +1,392 @@
+import os
+import sys
+import mmap
+import bisect
+import collections
+
+import replay
+import fast_replay
+from replay import *
+
+# World state at any timecode
+#
+#   engine = StateEngine(Replay.parse(replay_b, engine="fast"))
+#   state = engine.state_at(612 * 1000)
+#
+#   for entity_id, entity in state.of_type(0x02):
+#       print(entity_id, entity.fields["position"])
+#
+# Entity updates only carry the fields flagged in their masks, so the state of an entity is every update
+# since its create folded on top of each other. StateEngine does that fold once over the whole replay and
+# keeps a keyframe (a copy of the state) every `interval` ticks. state_at then only has to fold the ticks
+# between the closest keyframe and the timecode. If the keyframes grow past memory_budget bytes, every
+# other one is dropped and the interval doubles.
+#
+# States share their field values with the replay and with each other, don't edit them in place.
+
+KEYFRAME_INTERVAL = 256
+KEYFRAME_BUDGET = 256 * 1024 * 1024
+
+_ENTRY_BYTES = 100 # Rough size of one field in a keyframe: dict slot, key and value references
+
+_MASK8 = list(Mask8.flags.items())
+_MASK8_TABLE = fast_replay._flags(Mask8.flags)
+
+
+def maskByte(flags):
+    # The byte a Mask8 was decoded from. Masks from the fast engine are shared, so they can be looked up.
+    shared = fast_replay._FLAGS_IDS.get(id(flags))
+
+    if shared is not None:
+        return shared[1]
+
+    return sum(bit for name, bit in _MASK8 if flags[name])
+
+
+def mask(b):
+    # The Mask8 Container for a byte, shared like the fast engine's
+    return _MASK8_TABLE[b]
+
+
+class FieldPlan:
+    # Which mask bit every field of an entityType hangs off, read from the Entity schema in replay.py.
+    #   masks       [(mask name, gate), ...] in order, gate is the name of a Computed the mask depends on or None
+    #   fields      [(field name, mask name or None, bit), ...], mask "m1" is the entity's own m1.
+    #               Fields without a mask are always present.
+    #   computed    {name: Computed} fields that don't take up any bytes
+    #   subcons     {field name: the construct the field's value is encoded with, without its Ifs}
+    def __init__(self, struct):
+        self.struct = struct
+        self.masks = []
+        self.fields = []
+        self.computed = {}
+        self.subcons = {}
+        self.sizes = {} # {field name: fixed size in bytes, or None if it depends on the value}
+        self.keys = [sub.name for sub in struct.subcons]
+
+        for sub in struct.subcons:
+            sc = sub.subcon
+            gate = None
+
+            if isinstance(sc, Computed):
+                self.computed[sub.name] = sc
+                continue
+
+            # If(this.includeFields, ...) around a mask or a field, see CameraPath
+            if self._cond(sc) is not None and len(self._cond(sc)) == 1:
+                gate = self._cond(sc)[0]
+                sc = sc.thensubcon
+
+            if isinstance(sc, FlagsEnum) and sc.flags is Mask8.flags:
+                self.masks.append((sub.name, gate))
+                continue
+
+            cond = self._cond(sc)
+            self.subcons[sub.name] = sc if cond is None else sc.thensubcon
+
+            if cond is None:
+                self.fields.append((sub.name, None, 0))
+            elif len(cond) == 3 and cond[0] == "_":
+                self.fields.append((sub.name, cond[1], Mask8.flags[cond[2]]))
+            else:
+                self.fields.append((sub.name, cond[0], Mask8.flags[cond[1]]))
+
+        # [(mask name, [(bit, field name), ...]), ...] for folding
+        groups = collections.OrderedDict((name, []) for name in ["m1"] + [name for name, gate in self.masks])
+
+        for name, mask_name, bit in self.fields:
+            if mask_name is not None:
+                groups[mask_name].append((bit, name))
+
+        self.groups = [(mask_name, bits) for mask_name, bits in groups.items() if bits]
+        self.always = [name for name, mask_name, bit in self.fields if mask_name is None]
+        self.free = [bit for name, bit in _MASK8 if bit != 0x01 and not any(mask_name == "m1" and field_bit == bit
+                                                                           for field, mask_name, field_bit in self.fields)]
+
+    @staticmethod
+    def _cond(sc):
+        if isinstance(sc, IfThenElse) and sc.elsesubcon is Pass and isinstance(sc.condfunc, Path):
+            return fast_replay._path(sc.condfunc)
+
+        return None
+
+    def present(self, entity):
+        # {field name: value} of every field the entity carries
+        fields = entity.fields
+        values = {}
+
+        for mask_name, bits in self.groups:
+            flags = entity.m1 if mask_name == "m1" else fields[mask_name]
+
+            if flags is None:
+                continue
+
+            b = maskByte(flags)
+
+            if b == 0:
+                continue
+
+            for bit, name in bits:
+                if b & bit:
+                    values[name] = fields[name]
+
+        for name in self.always:
+            values[name] = fields[name]
+
+        return values
+
+    def field_size(self, name, value):
+        # How many bytes the field takes up with this value
+        size = self.sizes.get(name, -1)
+
+        if size == -1:
+            try:
+                size = self.sizes[name] = self.subcons[name].sizeof()
+            except SizeofError:
+                size = self.sizes[name] = None
+
+        return len(self.subcons[name].build(value)) if size is None else size
+
+    def entity(self, entity_id, entity_type, values, create=False):
+        # An Entity carrying exactly the fields in values, with its masks set to match. Fields sharing a mask
+        # bit have to be in values together.
+        bits = {"m1": 0x01 if create else 0x00}
+
+        for name, mask_name, bit in self.fields:
+            if mask_name is not None and values.get(name) is not None:
+                bits[mask_name] = bits.get(mask_name, 0) | bit
+
+        for name, gate in self.masks:
+            # Fields behind a gate that's closed for this m1 (see CameraPath) need an m1 bit that opens it,
+            # one that doesn't flag a field of its own so it doesn't cost any bytes
+            if gate is not None and bits.get(name) and not self.gate_open(gate, bits["m1"]):
+                for bit in self.free:
+                    if self.gate_open(gate, bits["m1"] | bit):
+                        bits["m1"] |= bit
+                        break
+
+        m1 = mask(bits["m1"])
+        fields = dict.fromkeys(self.keys)
+        ctx = Container(_=Container(m1=m1))
+        masks = {"m1": m1}
+
+        for name, sc in self.computed.items():
+            fields[name] = ctx[name] = sc.func(ctx)
+
+        for name, gate in self.masks:
+            # A mask behind a false gate isn't written, and neither are the fields it flags (see CameraPath)
+            masks[name] = fields[name] = None if gate is not None and not ctx[gate] else mask(bits.get(name, 0))
+
+        for name, mask_name, bit in self.fields:
+            if mask_name is None or masks[mask_name] is not None and bits.get(mask_name, 0) & bit:
+                fields[name] = values.get(name)
+
+        return Container(ent=Container(id=entity_id, destroy=0), m1=m1, entityType=entity_type,
+                         entityTypeS=ENTITY_TYPES[entity_type], fields=fast_replay._mkc(self.keys, [fields[name] for name in self.keys]))
+
+    def gate_open(self, gate, m1):
+        # Whether the Computed gate (see masks) is true for an entity with this m1 byte
+        return self.computed[gate].func(Container(_=Container(m1=mask(m1))))
+
+
+FIELD_PLANS = {entity_type: FieldPlan(case.subcon if isinstance(case, Renamed) else case)
+               for entity_type, case in Entity.fields.subcon.thensubcon.cases.items()}
+
+
+class EntityState:
+    # Everything known about one entity: its type and the latest value of every field it ever carried
+    __slots__ = ["entity_type", "fields", "created", "prefab"]
+
+    def __init__(self, entity_type, fields=None, created=None, prefab=None):
+        self.entity_type = entity_type
+        self.fields = {} if fields is None else fields
+        self.created = created # Timecode of the create, None if it wasn't seen
+        self.prefab = prefab # ID of the Prefab entity this is a sub-entity of, created along with it
+
+    def copy(self):
+        return EntityState(self.entity_type, dict(self.fields), self.created, self.prefab)
+
+    def __repr__(self):
+        return "EntityState(%s, %r)" % (ENTITY_TYPES.get(self.entity_type, self.entity_type), self.fields)
+
+
+class WorldState:
+    def __init__(self):
+        self.timecode = None
+        self.entities = {} # {entity id: EntityState}
+        self.prefabs = {} # {prefabName: Prefab}, for the types of prefab sub-entities
+
+    def copy(self):
+        state = WorldState()
+        state.timecode = self.timecode
+        state.entities = {entity_id: entity.copy() for entity_id, entity in self.entities.items()}
+        state.prefabs = dict(self.prefabs)
+
+        return state
+
+    def size(self):
+        # Rough number of bytes a copy() takes
+        return _ENTRY_BYTES * sum(len(entity.fields) + 1 for entity in self.entities.values())
+
+    def of_type(self, entity_type):
+        return [(entity_id, entity) for entity_id, entity in self.entities.items() if entity.entity_type == entity_type]
+
+    def apply(self, tick):
+        # Fold one tick into the state
+        for chunk in tick.prefabChunks:
+            for prefab in chunk.prefabs:
+                self.prefabs[prefab.prefabName] = prefab
+
+        for chunk in tick.entityChunks:
+            for entity in chunk.entities:
+                self.apply_entity(entity, tick.timecode)
+
+        self.timecode = tick.timecode
+
+    def apply_entity(self, entity, timecode):
+        entity_id = entity.ent.id
+
+        if entity.ent.destroy:
+            self.entities.pop(entity_id, None)
+            return
+
+        plan = FIELD_PLANS.get(entity.entityType)
+        fields = plan.present(entity) if plan is not None and entity.fields is not None else {}
+
+        if entity.m1.x1: # CREATE
+            self.entities[entity_id] = EntityState(entity.entityType, fields, timecode)
+
+            if entity.entityType == 0x15: # Prefab, see registerPrefabSubEntities
+                prefab = self.prefabs.get(entity.fields.prefabName)
+
+                for i, prefab_entity in enumerate(prefab.entities if prefab is not None else []):
+                    self.entities[entity_id + 1 + i] = EntityState(prefab_entity.entityType8, None, timecode, entity_id)
+
+            return
+
+        state = self.entities.get(entity_id)
+
+        if state is None:
+            state = self.entities[entity_id] = EntityState(entity.entityType)
+
+        state.fields.update(fields)
+
+
+class StateEngine:
+    # replay is a parsed replay, or a path. For paths only the keyframes are kept in memory, state_at
+    # decodes the ticks it needs from the file again.
+    def __init__(self, replay, interval=KEYFRAME_INTERVAL, memory_budget=KEYFRAME_BUDGET):
+        self.interval = interval
+        self.memory_budget = memory_budget
+        self.keyframes = [] # [(tick index, WorldState, ReplayLookups or None), ...]
+        self.keyframe_bytes = 0
+        self.timecodes = []
+
+        if isinstance(replay, (str, bytes, os.PathLike)):
+            self.path = replay
+            self.ticks = None
+            self.offsets = []
+
+            lookups = ReplayLookups()
+            state = WorldState()
+
+            with open(replay, "rb") as replay_f, mmap.mmap(replay_f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                header, off = fast_replay.decode_header(buf)
+
+                while True:
+                    if len(self.timecodes) % self.interval == 0:
+                        self._keyframe(len(self.timecodes), state, lookups)
+
+                    try:
+                        tick, end = fast_replay.decode_tick(buf, off, lookups)
+                    except Exception:
+                        break
+
+                    self.offsets.append(off)
+                    self.timecodes.append(tick.timecode)
+                    state.apply(tick)
+                    off = end
+        else:
+            self.path = None
+            self.ticks = replay.ticks if isinstance(replay, dict) else list(replay)
+            state = WorldState()
+
+            for index, tick in enumerate(self.ticks):
+                if index % self.interval == 0:
+                    self._keyframe(index, state, None)
+
+                self.timecodes.append(tick.timecode)
+                state.apply(tick)
+
+        self.final = state
+
+    def _keyframe(self, index, state, lookups):
+        snapshot = state.copy()
+
+        self.keyframes.append((index, snapshot, None if lookups is None else lookups.copy()))
+        self.keyframe_bytes += snapshot.size()
+
+        while self.keyframe_bytes > self.memory_budget and len(self.keyframes) > 1:
+            # Keep every other keyframe, always including the first one
+            self.keyframes = self.keyframes[::2]
+            self.keyframe_bytes = sum(keyframe.size() for index, keyframe, lookups in self.keyframes)
+            self.interval *= 2
+
+    def _ticksFrom(self, index, lookups, raw=False):
+        if self.ticks is not None:
+            for i in range(index, len(self.ticks)):
+                yield self.ticks[i]
+
+            return
+
+        if index == len(self.offsets):
+            return
+
+        lookups = lookups.copy()
+
+        with open(self.path, "rb") as replay_f:
+            replay_f.seek(self.offsets[index])
+
+            # _iterTicksFast stops at the first tick that fails to decode, same as the first pass did
+            yield from replay._iterTicksFast(replay_f, lookups, raw=raw)
+
+    def first_tick(self):
+        # Tick 0, where the map's prefabs and brushes are
+        return next(self._ticksFrom(0, ReplayLookups()), None)
+
+    def state_at(self, timecode):
+        # The state after every tick with tick.timecode <= timecode
+        state, ticks = self.seek(timecode + 1)
+        ticks.close()
+
+        return state
+
+    def seek(self, timecode, raw=False):
+        # (state before timecode, the ticks from there on), so the ticks can be streamed on without
+        # decoding them twice. The state is folded as far as the first tick with tick.timecode >= timecode.
+        # raw=True decodes the ticks of a path like iter_ticks(raw=True) does.
+        end = bisect.bisect_left(self.timecodes, timecode)
+        k = bisect.bisect_right([index for index, keyframe, lookups in self.keyframes], end) - 1
+        index, keyframe, lookups = self.keyframes[k]
+
+        state = keyframe.copy()
+        ticks = self._ticksFrom(index, lookups, raw)
+
+        for i in range(index, end):
+            state.apply(next(ticks))
+
+        return state, ticks
+
+
+if __name__ == "__main__":
+    # python replay_state.py match.rep 612.5  -  print every entity's state at 612.5 s into the replay
+    replay_p = sys.argv[1]
+    seconds = float(sys.argv[2])
+
+    engine = StateEngine(replay_p)
+    state = engine.state_at(engine.timecodes[0] + int(seconds * 1000))
+
+    print("State at timecode", state.timecode, "-", len(state.entities), "entities")
+
+    for entity_id, entity in sorted(state.entities.items()):
+        print(entity_id, entity)
@@ -0,0 +1,126 @@
+import sys
+import contextlib
+
+from replay import *
+from replay_state import FIELD_PLANS, WorldState
+
+# Cut a clip out of a replay
+#
+#   trim("match.rep", start, end, "clip.rep")
+#
+# The clip starts with a tick that recreates the world as it was right before `start`: every prefab the
+# replay defined, tick 0's brushes (the map) and a create for every entity that was alive, carrying all
+# of its fields as of then. After it come the replay's own ticks from `start` to `end`.
+#
+# Without an engine, the ticks up to `start` are folded into the state in the same pass that streams the
+# clip, and nothing after `end` is decoded. Cutting several clips out of the same replay, pass the same
+# StateEngine (see replay_state.py) to every trim instead: building it folds the whole replay once, after
+# that only the ticks since the closest keyframe before `start` and the clip itself are decoded.
+
+
+def worldTick(state, brushes):
+    # A tick recreating state from scratch. Prefab sub-entities are created along with their prefab,
+    # so they only get an update with their fields after it.
+    entities = []
+
+    for entity_id, entity in state.entities.items():
+        plan = FIELD_PLANS.get(entity.entity_type)
+
+        if plan is None:
+            continue
+
+        if entity.prefab is None or entity.prefab not in state.entities:
+            entities.append(plan.entity(entity_id, entity.entity_type, entity.fields, create=True))
+        elif entity.fields:
+            entities.append(plan.entity(entity_id, entity.entity_type, entity.fields))
+
+    return Container(timecode=state.timecode, prefabChunks=makeChunks(list(state.prefabs.values()), "prefabs"),
+                     entityChunks=makeChunks(entities, "entities"), brushChunks=makeChunks(brushes, "brushes"))
+
+
+def trim_ticks(engine, start, end):
+    # Yields the clip's ticks, see above. start and end are timecodes, both inclusive.
+    state, ticks = engine.seek(start, raw=True)
+
+    try:
+        if state.timecode is not None:
+            # Nothing before start? Then tick 0 is part of the clip anyway
+            yield worldTick(state, tickItems(engine.first_tick(), "brushes"))
+
+        for tick in ticks:
+            if tick.timecode > end:
+                break
+
+            yield tick
+    finally:
+        ticks.close()
+
+
+def stream_ticks(ticks, start, end):
+    # trim_ticks without a StateEngine: one pass over ticks, stopping after the clip
+    state = WorldState()
+    brushes = None
+    clipping = False
+
+    for tick in ticks:
+        if brushes is None:
+            brushes = tickItems(tick, "brushes")
+
+        if tick.timecode < start:
+            state.apply(tick)
+            continue
+
+        if not clipping:
+            clipping = True
+
+            if state.timecode is not None:
+                yield worldTick(state, brushes)
+
+        if tick.timecode > end:
+            break
+
+        yield tick
+
+    if not clipping and state.timecode is not None:
+        # Every tick was before start
+        yield worldTick(state, brushes)
+
+
+def trim(replay, start, end, f, engine=None):
+    # replay is a path or a Replay.parse(..., engine="fast") result, f a path or file to write the clip to.
+    # Returns the number of ticks written.
+    if engine is not None:
+        header = replay.header if isinstance(replay, dict) else read_header(replay)
+        ticks = trim_ticks(engine, start, end)
+    elif isinstance(replay, dict):
+        header = replay.header
+        ticks = stream_ticks(replay.ticks, start, end)
+    else:
+        header, replay_ticks = iter_replay(replay, engine="fast", raw=True)
+        ticks = stream_ticks(replay_ticks, start, end)
+
+    try:
+        with ReplayWriter(f, header) as writer:
+            for tick in ticks:
+                writer.write_tick(tick)
+
+            return writer.num_ticks
+    finally:
+        ticks.close()
+
+        if engine is None and not isinstance(replay, dict):
+            replay_ticks.close()
+
+
+if __name__ == "__main__":
+    # python replay_trim.py match.rep 600 620 clip.rep  -  seconds from the start of the replay
+    replay_p, start_s, end_s, clip_p = sys.argv[1:5]
+
+    header, ticks = iter_replay(replay_p, engine="fast", entity_types=set(), prefabs=False, brushes=False)
+
+    with contextlib.closing(ticks):
+        first = next(ticks).timecode
+
+    num_ticks = trim(replay_p, first + int(float(start_s) * 1000), first + int(float(end_s) * 1000), clip_p)
+
+    print("Wrote", num_ticks, "ticks to", clip_p)
@@ -0,0 +1,222 @@
+import os
+import sys
+import time
+import struct
+import bisect
+import argparse
+import collections
+
+from replay import *
+from replay_batch import find_replays, map_batch
+
+import fast_replay
+
+# Round trip check for whole replay directories: parse every replay, build it again and compare bytes
+#
+#   python replay_verify.py DIR --jobs 8
+#   python replay_verify.py match.rep --writer
+#
+# Building leans on prepareLookups, the Bool8 padding and the camera_path_field_stuff guess, so a schema
+# change can break it without any error, the output just isn't the same replay anymore. Run this over an
+# archive after touching the schema.
+#
+# The build writes into a stream that compares every write against the original bytes, so a broken
+# replay stops at its first wrong byte instead of being built to the end. That offset is then bisected
+# in the layout of the tick it falls into (see fast_replay.tick_layout), which gives the first
+# differing tick and the prefab, entity or brush in it. --writer checks write_replay / ReplayWriter
+# instead of build().
+
+VerifyResult = collections.namedtuple("VerifyResult", ["path", "size", "ok", "error", "mismatch"])
+
+# Where the built bytes first differ. kind is "header", "timecode", "chunk", "prefab", "entity" or "brush",
+# or "end" when the build came out shorter or longer than the replay.
+Mismatch = collections.namedtuple("Mismatch", ["offset", "kind", "tick", "timecode", "index", "start", "end",
+                                               "entity_id", "entity_type", "expected", "got"])
+
+_CONTEXT = 16 # bytes shown around the first difference
+
+
+class _CompareStream:
+    # Write-only stream that checks what's written against data. construct wraps exceptions raised by
+    # write() in a StreamError, so the first difference is kept in .differs before raising.
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+        self.differs = None
+
+    def write(self, b):
+        n = len(b)
+        end = self.pos + n
+
+        if self.data[self.pos:end] != b:
+            expected = self.data[self.pos:end]
+
+            for i in range(n):
+                if i >= len(expected) or expected[i] != b[i]:
+                    break
+
+            self.differs = (self.pos + i, bytes(b[i:i + _CONTEXT]))
+            raise ValueError("built bytes differ at offset %d" % (self.pos + i))
+
+        self.pos = end
+
+        return n
+
+    def tell(self):
+        return self.pos
+
+    def flush(self):
+        pass
+
+
+def locate(data, offset, got=b""):
+    # The Mismatch for the first differing byte at offset
+    expected = bytes(data[offset:offset + _CONTEXT])
+
+    if offset < HEADER_SIZE:
+        return Mismatch(offset, "header", None, None, None, 0, HEADER_SIZE, None, None, expected, got)
+
+    if offset >= len(data):
+        return Mismatch(offset, "end", None, None, None, len(data), len(data), None, None, expected, got)
+
+    lookups = ReplayLookups()
+    off = HEADER_SIZE
+    index = 0
+
+    while True:
+        start = off
+
+        try:
+            items, off = fast_replay.tick_layout(data, off, lookups)
+        except Exception:
+            # Past the last tick that parses, the same place Replay.parse stops at
+            return Mismatch(offset, "end", index, None, None, start, len(data), None, None, expected, got)
+
+        if offset < off:
+            break
+
+        index += 1
+
+    timecode = struct.unpack_from("<I", data, start)[0]
+    kind, item_index, item_start, item_end, entity_id, entity_type = items[bisect.bisect_right([item[2] for item in items], offset) - 1]
+
+    return Mismatch(offset, kind, index, timecode, item_index, item_start, item_end, entity_id, entity_type, expected, got)
+
+
+def verify_bytes(data, engine="fast", writer=False):
+    # (ok, error, Mismatch or None) for one replay's bytes
+    try:
+        replay = Replay.parse(data, engine=engine)
+    except Exception as e:
+        return False, "parse failed: %s: %s" % (type(e).__name__, e), None
+
+    stream = _CompareStream(data)
+
+    try:
+        if writer:
+            write_replay(stream, replay)
+        else:
+            Replay.build_stream(replay, stream, lookups=prepareLookups(replay))
+    except Exception as e:
+        if stream.differs is not None:
+            return False, None, locate(data, *stream.differs)
+
+        # Whatever was being built when it broke starts at the end of what was written
+        return False, "build failed: %s: %s" % (type(e).__name__, e), locate(data, stream.pos)
+
+    if stream.pos != len(data):
+        return False, None, locate(data, stream.pos)
+
+    return True, None, None
+
+
+def verify_file(replay_p, engine="fast", writer=False):
+    try:
+        with open(replay_p, "rb") as replay_f:
+            data = replay_f.read()
+    except OSError as e:
+        return VerifyResult(replay_p, 0, False, "%s: %s" % (type(e).__name__, e), None)
+
+    ok, error, mismatch = verify_bytes(data, engine, writer)
+
+    return VerifyResult(replay_p, len(data), ok, error, mismatch)
+
+
+def _verifyChunk(paths, engine, writer):
+    return [verify_file(replay_p, engine, writer) for replay_p in paths]
+
+
+def verify_batch(paths, jobs=None, chunksize=1, engine="fast", writer=False):
+    # verify_file for every path on a process pool, yields VerifyResults as they complete. Biggest
+    # files go first so a long one doesn't start last and keep the run going on its own.
+    paths = sorted(paths, key=lambda replay_p: -os.path.getsize(replay_p) if os.path.exists(replay_p) else 0)
+
+    return map_batch(_verifyChunk, paths, jobs, chunksize, engine, writer)
+
+
+def describe(mismatch):
+    if mismatch.kind == "header":
+        where = "header"
+    elif mismatch.tick is None:
+        where = "end of replay"
+    elif mismatch.timecode is None:
+        where = "end of replay, after %d ticks" % mismatch.tick
+    else:
+        where = "tick %d (timecode %d), %s" % (mismatch.tick, mismatch.timecode, mismatch.kind)
+
+        if mismatch.kind in ["prefab", "entity", "brush"]:
+            where += " %d" % mismatch.index
+
+        if mismatch.entity_id is not None:
+            where += " id %d (%s)" % (mismatch.entity_id, ENTITY_TYPES.get(mismatch.entity_type, "unknown"))
+
+        where += " at %d..%d" % (mismatch.start, mismatch.end)
+
+    return "offset %d: %s, expected %s got %s" % (mismatch.offset, where, mismatch.expected.hex(" "), mismatch.got.hex(" ") or "nothing")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="replay_verify.py", description="Check that replays build back into the bytes they were parsed from")
+    parser.add_argument("paths", nargs="+", metavar="PATH", help="Replays, or directories to search for .rep files")
+    parser.add_argument("--jobs", "-j", type=int, default=None, help="Worker processes (default: CPU count)")
+    parser.add_argument("--engine", choices=["construct", "fast"], default="fast", help="Engine to parse with (default: fast)")
+    parser.add_argument("--writer", action="store_true", help="Build with ReplayWriter instead of build()")
+    args = parser.parse_args(argv)
+
+    paths = []
+
+    for path in args.paths:
+        paths += find_replays(path) if os.path.isdir(path) else [path]
+
+    print("Verifying", len(paths), "replays")
+
+    start = time.perf_counter()
+    num_files = 0
+    num_bytes = 0
+    num_failed = 0
+
+    for result in verify_batch(paths, args.jobs, engine=args.engine, writer=args.writer):
+        num_files += 1
+        num_bytes += result.size
+
+        if result.ok:
+            print("OK", result.path)
+            continue
+
+        num_failed += 1
+        print("FAIL", result.path, result.error or "")
+
+        if result.mismatch is not None:
+            print("    " + describe(result.mismatch))
+
+    elapsed = time.perf_counter() - start
+
+    print("%d files (%d failed), %.1f MB in %.2f s: %.1f files/s, %.1f MB/s" % (
+        num_files, num_failed, num_bytes / 1e6, elapsed,
+        num_files / elapsed if elapsed else 0, num_bytes / 1e6 / elapsed if elapsed else 0))
+
+    return 1 if num_failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,52 @@
+import pytest
+
+from replay import *
+from replay_generate import ReplayGenerator
+
+TICKS = 400
+
+
+def plain(obj):
+    # obj as dicts and lists. Container's == compares every nested value twice, once from each side,
+    # which takes minutes on a few hundred ticks.
+    if isinstance(obj, dict):
+        return {key: plain(value) for key, value in obj.items() if not key.startswith("_")}
+
+    if isinstance(obj, list):
+        return [plain(value) for value in obj]
+
+    return obj
+
+
+@pytest.fixture(scope="module", params=[0, 1])
+def replay_b(request):
+    # Every entity type: the static ones in tick 0, then projectiles (alive 125 to 375 ticks), damage,
+    # chat messages and votes referencing the players, created and destroyed again within the replay.
+    # Prefabs and brushes too.
+    return Replay.build(ReplayGenerator(ticks=TICKS, players=3, projectile_rate=40, brushes=20, prefabs=4, seed=request.param,
+                                        damage_rate=20, chat_rate=5, vote_rate=5).replay())
+
+
+def test_covers_every_entity_type(replay_b):
+    replay = Replay.parse(replay_b, engine="fast")
+    entity_types = {entity.entityType for tc, entity in allEntities(replay)}
+
+    assert set(ENTITY_TYPES) <= entity_types
+    assert None in entity_types # Destroys
+
+
+def test_parse_matches_construct(replay_b):
+    assert plain(Replay.parse(replay_b)) == plain(Replay.parse(replay_b, engine="fast"))
+
+
+def test_truncated_matches_construct(replay_b):
+    # Both stop at the first tick that doesn't decode
+    truncated = replay_b[:len(replay_b) * 2 // 3]
+    replay = Replay.parse(truncated, engine="fast")
+
+    assert plain(Replay.parse(truncated)) == plain(replay)
+    assert 0 < len(replay.ticks) < TICKS
+
+
+def test_build_round_trip(replay_b):
+    assert Replay.build(Replay.parse(replay_b, engine="fast")) == replay_b
@@ -0,0 +1,78 @@
+import copy
+
+import pytest
+
+from replay import *
+from replay_cache import ParseCache, load_replay
+from replay_generate import ReplayGenerator
+
+
+def generatedBytes(**parameters):
+    return Replay.build(ReplayGenerator(**parameters).replay())
+
+
+def test_refactor_sees_edits_between_calls():
+    replay = Replay.parse(generatedBytes(ticks=20, players=2, seed=3))
+    player_id = next(entity.ent.id for entity in allInitialEntities(replay) if entity.entityType == 0x02)
+    keys = list(replay.keys())
+
+    refactorChangeEntityIds({}, replay)
+
+    # An update added after the first call
+    update = copy.deepcopy(next(entity for entity in replay.ticks[10].entityChunks[0].entities if entity.ent.id == player_id))
+    replay.ticks[10].entityChunks[0].entities.append(update)
+
+    refactorChangeEntityIds({player_id: 9999}, replay)
+
+    assert update.ent.id == 9999
+    assert list(replay.keys()) == keys
+
+
+def test_refactor_with_references():
+    replay_b = generatedBytes(ticks=20, players=2, seed=3)
+    replay = Replay.parse(replay_b)
+    expected = Replay.parse(replay_b)
+    references = entityReferences(replay)
+
+    for changes in [{2: 1000, 3: 1001}, {1000: 3, 1001: 2}, {2: 3, 3: 2}]:
+        refactorChangeEntityIds(changes, replay, references=references)
+        refactorChangeEntityIds(changes, expected)
+
+    assert replay == expected
+
+
+def sameLifetimes(a, b):
+    columns = ["ids", "types", "created", "destroyed", "created_tick", "updates", "prefab_span"]
+
+    return all(getattr(a, column) == getattr(b, column) for column in columns) and a.referenced_ids() == b.referenced_ids()
+
+
+@pytest.mark.parametrize("engine", ["construct", "fast"])
+def test_parse_fills_in_lifetimes(engine):
+    replay_b = generatedBytes(ticks=400, players=3, damage_rate=20, chat_rate=5, vote_rate=5, seed=5)
+    replay = Replay.parse(replay_b, engine=engine, lifetimes=True)
+
+    assert sameLifetimes(replay.lifetimes, EntityLifetimes(replay.ticks))
+    assert entityLifetimes(replay) is replay.lifetimes
+
+    # Not a key, the replay is the same as ever
+    assert list(replay.keys()) == list(Replay.parse(replay_b, engine=engine).keys())
+    assert Replay.build(replay) == replay_b
+
+
+def test_cache_keeps_lifetimes(tmp_path):
+    replay_p = str(tmp_path / "match.rep")
+    ReplayGenerator(ticks=100, players=2, seed=5).write(replay_p)
+    cache = ParseCache(str(tmp_path / "cache"))
+
+    parsed = load_replay(replay_p, cache=cache, lifetimes=True)
+    cached = load_replay(replay_p, cache=cache, lifetimes=True)
+
+    assert cached is not parsed and sameLifetimes(cached.lifetimes, parsed.lifetimes)
+    assert cached.lifetimes.initial_entities()[0] is cached.ticks[0].entityChunks[0].entities[0]
+
+    # An entry stored without a table gets one on a hit
+    cache.clear()
+    load_replay(replay_p, cache=cache)
+
+    assert sameLifetimes(load_replay(replay_p, cache=cache, lifetimes=True).lifetimes, parsed.lifetimes)
@@ -0,0 +1,39 @@
+import os
+
+import pytest
+
+from replay_generate import ReplayGenerator
+from replay_batch import find_replays, parse_batch, countTicks
+
+
+@pytest.fixture(scope="module")
+def replay_dir(tmp_path_factory):
+    replay_dir = tmp_path_factory.mktemp("batch")
+    os.makedirs(replay_dir / "sub")
+
+    for i, name in enumerate(["a.rep", "sub/b.REP", "sub/c.rep"]):
+        ReplayGenerator(ticks=20 + i, seed=i).write(str(replay_dir / name))
+
+    (replay_dir / "broken.rep").write_bytes(b"\x00" * 10)
+    (replay_dir / "notes.txt").write_text("not a replay")
+
+    return str(replay_dir)
+
+
+def test_find_replays(replay_dir):
+    assert find_replays(replay_dir) == [os.path.join(replay_dir, name) for name in ["a.rep", "broken.rep", "sub/b.REP", "sub/c.rep"]]
+
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_parse_batch(replay_dir, jobs):
+    results = {os.path.relpath(result.path, replay_dir): result for result in
+               parse_batch(find_replays(replay_dir), jobs=jobs, chunksize=1, func=countTicks, profile=True)}
+
+    assert sorted(results) == ["a.rep", "broken.rep", "sub/b.REP", "sub/c.rep"]
+    assert {name: result.value for name, result in results.items() if result.error is None} == {"a.rep": 20, "sub/b.REP": 21, "sub/c.rep": 22}
+
+    assert results["broken.rep"].error is not None
+    assert results["sub/c.rep"].size == os.path.getsize(os.path.join(replay_dir, "sub/c.rep"))
+
+    # The profiles come back from the workers
+    assert results["sub/c.rep"].profile.ticks["count"] == 22
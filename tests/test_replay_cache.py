@@ -0,0 +1,32 @@
+from replay import *
+from replay_cache import ParseCache, load_replay, iter_replay_cached
+from replay_generate import ReplayGenerator
+
+
+def test_engines_have_their_own_entries(tmp_path):
+    replay_p = str(tmp_path / "match.rep")
+    ReplayGenerator(ticks=20, players=2, seed=4).write(replay_p)
+    cache = ParseCache(str(tmp_path / "cache"))
+
+    load_replay(replay_p, engine="fast", cache=cache)
+    replay = load_replay(replay_p, engine="construct", cache=cache)
+
+    # The construct engine's masks can be edited, the fast engine's shared ones can't
+    entity = next(allInitialEntities(replay))
+    entity.m1.x2 = True
+
+    assert len(cache.entries()) == 2
+
+
+def test_iter_streams_big_replays(tmp_path):
+    replay_p = str(tmp_path / "match.rep")
+    ReplayGenerator(ticks=20, players=2, seed=4).write(replay_p)
+    cache = ParseCache(str(tmp_path / "cache"))
+
+    header, ticks = iter_replay_cached(replay_p, "fast", cache, max_bytes=0)
+    assert len(list(ticks)) == 20
+    assert not cache.entries()
+
+    header, ticks = iter_replay_cached(replay_p, "fast", cache)
+    assert len(list(ticks)) == 20
+    assert len(cache.entries()) == 1
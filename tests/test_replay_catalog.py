@@ -0,0 +1,52 @@
+import os
+
+from replay_catalog import ReplayCatalog
+from replay_generate import ReplayGenerator
+
+
+def writeReplay(path, **parameters):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    ReplayGenerator(**parameters).write(path)
+
+    return path
+
+
+def test_rescan_is_incremental(tmp_path):
+    replays_p = str(tmp_path / "replays")
+    writeReplay(os.path.join(replays_p, "a.rep"), ticks=5, players=2, seed=1)
+    writeReplay(os.path.join(replays_p, "b.rep"), ticks=5, players=3, seed=2)
+
+    with open(os.path.join(replays_p, "broken.rep"), "wb") as f:
+        f.write(b"not a replay")
+
+    with ReplayCatalog(str(tmp_path / "catalog.sqlite")) as catalog:
+        assert catalog.rescan(replays_p) == (3, 0, 0, 1)
+        assert catalog.rescan(replays_p) == (0, 3, 0, 0)
+
+        os.remove(os.path.join(replays_p, "a.rep"))
+        writeReplay(os.path.join(replays_p, "c.rep"), ticks=5, players=2, seed=3)
+
+        assert catalog.rescan(replays_p) == (1, 2, 1, 0)
+        assert [os.path.basename(path) for path, error in catalog.errors()] == ["broken.rep"]
+
+        replays = catalog.query(map="generated2")
+        assert [os.path.basename(replay["path"]) for replay in replays] == ["b.rep"]
+        assert [player["name"] for player in catalog.players(replays[0]["id"])] == ["player1", "player2", "player3"]
+        assert len(catalog.query(player_name="player3")) == 1
+
+
+def test_rescan_only_touches_its_own_directory(tmp_path):
+    # Directories that only differ in case, or in characters LIKE treats as wildcards
+    dirs = [str(tmp_path / name) for name in ["Replays", "replays", "re_plays", "re%plays"]]
+
+    for i, dir_p in enumerate(dirs):
+        writeReplay(os.path.join(dir_p, "match.rep"), ticks=5, seed=i)
+
+    with ReplayCatalog(str(tmp_path / "catalog.sqlite")) as catalog:
+        for dir_p in dirs:
+            assert catalog.rescan(dir_p) == (1, 0, 0, 0)
+
+        for dir_p in dirs:
+            assert catalog.rescan(dir_p) == (0, 1, 0, 0)
+
+        assert len(catalog.query()) == len(dirs)
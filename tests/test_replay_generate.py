@@ -0,0 +1,39 @@
+import io
+
+from replay import *
+from replay_generate import ReplayGenerator
+
+
+def test_same_seed_same_bytes():
+    parameters = dict(ticks=100, players=3, projectile_rate=20, damage_rate=20, chat_rate=5, vote_rate=5, seed=8)
+    first, second = io.BytesIO(), io.BytesIO()
+
+    ReplayGenerator(**parameters).write(first)
+    ReplayGenerator(**parameters).write(second)
+
+    assert first.getvalue() == second.getvalue()
+    assert Replay.build(ReplayGenerator(**parameters).replay()) == first.getvalue()
+
+
+def test_events_reference_live_players():
+    replay = ReplayGenerator(ticks=400, players=3, damage_rate=20, chat_rate=5, vote_rate=5, seed=8).replay()
+    players = {entity.ent.id for entity in allInitialEntities(replay) if entity.entityType == 0x02}
+    creates = {}
+    destroyed = set()
+
+    for tc, entity in allEntities(replay):
+        if entity.ent.destroy:
+            destroyed.add(entity.ent.id)
+        elif entity.entityType in ENTITY_REFERENCE_FIELDS and entity.m1.x1:
+            creates[entity.ent.id] = entity
+
+    for entity_type in [0x0E, 0x10, 0x11]:
+        events = [entity for entity in creates.values() if entity.entityType == entity_type]
+
+        # Created and destroyed again within the replay
+        assert events and set(entity.ent.id for entity in events) & destroyed
+
+        for entity in events:
+            assert all(entity.fields[field] in players for field in ENTITY_REFERENCE_FIELDS[entity_type])
+
+    assert all(entity.fields.senderId != entity.fields.receiverId for entity in creates.values() if entity.entityType == 0x11)
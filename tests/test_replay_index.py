@@ -0,0 +1,89 @@
+import pytest
+
+from replay import *
+from replay_generate import ReplayGenerator
+from replay_index import ReplayIndex, build_index, index_path
+
+
+@pytest.fixture(scope="module")
+def replay_p(tmp_path_factory):
+    replay_p = str(tmp_path_factory.mktemp("index") / "match.rep")
+    ReplayGenerator(ticks=600, players=2, projectile_rate=20, damage_rate=10, seed=7).write(replay_p)
+
+    return replay_p
+
+
+@pytest.fixture(scope="module")
+def replay(replay_p):
+    with open(replay_p, "rb") as replay_f:
+        return Replay.parse(replay_f.read(), engine="fast")
+
+
+@pytest.mark.parametrize("engine", ["fast", "construct"])
+def test_seek_matches_full_parse(replay_p, replay, engine):
+    timecodes = [tick.timecode for tick in replay.ticks]
+
+    # Before the first tick, on a tick, between ticks and past the end, around the checkpoint at tick 256
+    for timecode in [0, timecodes[0], timecodes[255], timecodes[256] - 1, timecodes[256], timecodes[400] + 1, timecodes[-1], timecodes[-1] + 1]:
+        expected = [tick for tick in replay.ticks if tick.timecode >= timecode][:20]
+
+        with Replay.open(replay_p, engine) as rep:
+            ticks = []
+
+            for tick in rep.seek(timecode):
+                ticks.append(tick)
+
+                if len(ticks) == len(expected):
+                    break
+
+        assert ticks == expected
+
+
+def test_index_round_trip(replay_p, replay):
+    index = build_index(replay_p, interval=100)
+
+    assert list(index.timecodes) == [tick.timecode for tick in replay.ticks]
+    assert len(index.checkpoints) == 7
+
+    copy = ReplayIndex.from_bytes(index.to_bytes())
+
+    assert (copy.offsets, copy.timecodes, copy.prefab_tables, copy.checkpoints) == (index.offsets, index.timecodes, index.prefab_tables, index.checkpoints)
+
+
+def test_stale_index_is_rebuilt(tmp_path):
+    replay_p = str(tmp_path / "match.rep")
+    ReplayGenerator(ticks=10, seed=7).write(replay_p)
+
+    with Replay.open(replay_p) as rep:
+        assert len(rep.index.offsets) == 10
+
+    ReplayGenerator(ticks=20, seed=7).write(replay_p)
+
+    with Replay.open(replay_p) as rep:
+        assert len(rep.index.offsets) == 20
+
+    with open(index_path(replay_p), "rb") as idx_f:
+        assert len(ReplayIndex.from_bytes(idx_f.read()).offsets) == 20
+
+
+def test_truncated_replays(tmp_path, replay_p, replay):
+    with open(replay_p, "rb") as replay_f:
+        replay_b = replay_f.read()
+
+    # Up to the last complete tick, like Replay.parse
+    truncated_p = str(tmp_path / "truncated.rep")
+
+    with open(truncated_p, "wb") as f:
+        f.write(replay_b[:len(replay_b) // 2])
+
+    with open(truncated_p, "rb") as f:
+        assert len(build_index(truncated_p).offsets) == len(Replay.parse(f.read(), engine="fast").ticks)
+
+    for size in [0, HEADER_SIZE - 1]:
+        short_p = str(tmp_path / ("short%d.rep" % size))
+
+        with open(short_p, "wb") as f:
+            f.write(replay_b[:size])
+
+        with pytest.raises(StreamError, match="too short for a header"):
+            build_index(short_p)
@@ -0,0 +1,82 @@
+import numpy as np
+import pytest
+
+from replay import *
+from replay_generate import ReplayGenerator
+from replay_mesh import load_map, map_geometry, tick_map, export_obj
+
+
+@pytest.fixture(scope="module")
+def replay_p(tmp_path_factory):
+    replay_p = str(tmp_path_factory.mktemp("mesh") / "match.rep")
+    ReplayGenerator(ticks=2, brushes=40, prefabs=4, seed=9).write(replay_p)
+
+    return replay_p
+
+
+@pytest.fixture(scope="module")
+def replay(replay_p):
+    with open(replay_p, "rb") as replay_f:
+        return Replay.parse(replay_f.read(), engine="fast")
+
+
+def numBrushes(replay):
+    # The map's own brushes plus the brushes of every prefab instance
+    tick = replay.ticks[0]
+    prefabs = {prefab.prefabName: prefab for prefab in tickItems(tick, "prefabs")}
+    instances = [entity.fields.prefabName for entity in tickItems(tick, "entities") if entity.entityType == 0x15]
+
+    return len(tickItems(tick, "brushes")) + sum(len(prefab_entity.brushes) for name in instances for prefab_entity in prefabs[name].entities)
+
+
+def test_obj_face_count(replay_p, replay, tmp_path):
+    obj_p = str(tmp_path / "match.obj")
+    geometry, num_triangles = export_obj(replay_p, obj_p)
+
+    # The generator's brushes are boxes: 8 corners, 6 quads of 2 triangles each
+    num_brushes = numBrushes(replay)
+    assert (len(geometry), geometry.skipped) == (num_brushes, 0)
+    assert num_triangles == 12 * num_brushes
+
+    with open(obj_p) as obj_f:
+        lines = obj_f.read().splitlines()
+
+    vertices = [line for line in lines if line.startswith("v ")]
+    faces = [[int(i) for i in line.split()[1:]] for line in lines if line.startswith("f ")]
+
+    assert len(vertices) == 8 * num_brushes
+    assert len(faces) == num_triangles
+    assert min(min(face) for face in faces) == 1 and max(max(face) for face in faces) == len(vertices)
+
+    with open(str(tmp_path / "match.mtl")) as mtl_f:
+        materials = [line.split()[1] for line in mtl_f if line.startswith("newmtl ")]
+
+    assert {line.split()[1] for line in lines if line.startswith("usemtl ")} <= set(materials)
+
+
+def test_numpy_brushes_give_the_same_geometry(replay_p, replay):
+    expected = map_geometry(*tick_map(replay.ticks[0]))
+    geometry = map_geometry(*load_map(replay_p))
+
+    for name in ["vertices", "brush_starts", "face_edges", "face_brush", "face_material", "face_table", "brush_prefab"]:
+        assert np.array_equal(getattr(geometry, name), getattr(expected, name)), name
+
+    assert (geometry.materials, geometry.colors) == (expected.materials, expected.colors)
+
+
+def test_prefab_brushes_keep_their_shape(replay_p, replay):
+    # Placing a prefab rotates and moves its brushes, the distances between their corners stay the same
+    geometry = map_geometry(*load_map(replay_p))
+    plain = map_geometry(tick_map(replay.ticks[0])[0])
+
+    placed = np.flatnonzero(geometry.brush_prefab >= 0)
+    assert len(placed) and len(plain) == len(geometry) - len(placed)
+
+    for brush in placed:
+        corners = geometry.vertices[geometry.brush_starts[brush]:geometry.brush_starts[brush + 1]].astype(np.float64)
+        squares = ((corners - corners[0]) ** 2).sum(axis=1)
+
+        # The generator's corner i is at +size on the axes of the bits of i, so corners 1, 2 and 4 are along
+        # the edges from corner 0 and 7 is across the box, and the edges stay at right angles
+        assert np.isclose(squares[1] + squares[2] + squares[4], squares[7], rtol=1e-4)
+        assert np.isclose(squares[1] + squares[2], squares[3], rtol=1e-4)
@@ -0,0 +1,83 @@
+import os
+import copy
+
+import pytest
+
+from replay import *
+from replay_generate import ReplayGenerator
+from replay_optimize import optimize
+from replay_state import WorldState
+
+
+def states(replay):
+    # The world after every tick, as plain values
+    world = WorldState()
+
+    for tick in replay.ticks:
+        world.apply(tick)
+
+        yield tick.timecode, {entity_id: (entity.entity_type, entity.created, {name: plain(value) for name, value in entity.fields.items()})
+                              for entity_id, entity in world.entities.items()}
+
+
+def plain(value):
+    # Containers compare slowly, compare them as dicts and lists
+    if isinstance(value, dict):
+        return {key: plain(item) for key, item in value.items() if not key.startswith("_")}
+
+    if isinstance(value, list):
+        return [plain(item) for item in value]
+
+    return value
+
+
+@pytest.fixture(scope="module")
+def redundant(tmp_path_factory):
+    # (path, updates resent): every Player update is sent again at the start of the next tick, which changes nothing
+    generated = ReplayGenerator(ticks=200, players=3, seed=6, damage_rate=5).replay()
+    previous = []
+    resent = 0
+
+    for tick in generated.ticks:
+        updates = [entity for entity in tickItems(tick, "entities") if entity.entityType == 0x02 and not entity.ent.destroy and not entity.m1.x1]
+        tick.entityChunks = makeChunks([copy.deepcopy(entity) for entity in previous] + tickItems(tick, "entities"), "entities")
+        resent += len(previous)
+        previous = updates
+
+    replay_p = str(tmp_path_factory.mktemp("optimize") / "match.rep")
+    write_replay(replay_p, generated)
+
+    return replay_p, resent
+
+
+def test_round_trip_keeps_state_at_every_tick(redundant, tmp_path):
+    replay_p, resent = redundant
+    out_p = str(tmp_path / "match.min.rep")
+    stats = optimize(replay_p, out_p)
+
+    with open(replay_p, "rb") as replay_f, open(out_p, "rb") as out_f:
+        before = Replay.parse(replay_f.read(), engine="fast")
+        after = Replay.parse(out_f.read(), engine="fast")
+
+    total = stats.total()
+
+    assert resent > 0 and total["dropped"] >= resent
+    assert len(after.ticks) == len(before.ticks)
+    assert sum(len(tickItems(tick, "entities")) for tick in before.ticks) - sum(len(tickItems(tick, "entities")) for tick in after.ticks) == total["dropped"]
+    assert os.path.getsize(replay_p) - os.path.getsize(out_p) == total["bytes"]
+
+    for (timecode, state), (optimized_timecode, optimized) in zip(states(before), states(after)):
+        assert (optimized_timecode, optimized) == (timecode, state)
+
+
+def test_optimized_replay_is_left_alone(redundant, tmp_path):
+    replay_p, resent = redundant
+    once_p = str(tmp_path / "once.rep")
+    twice_p = str(tmp_path / "twice.rep")
+    optimize(replay_p, once_p)
+    stats = optimize(once_p, twice_p)
+
+    assert stats.total()["bytes"] == 0
+
+    with open(once_p, "rb") as once_f, open(twice_p, "rb") as twice_f:
+        assert once_f.read() == twice_f.read()
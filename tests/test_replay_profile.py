@@ -0,0 +1,65 @@
+import pickle
+import collections
+
+import pytest
+
+from replay import *
+from replay_generate import ReplayGenerator
+from replay_profile import ParseProfile
+
+
+@pytest.fixture(scope="module")
+def replay_b(tmp_path_factory):
+    replay_p = str(tmp_path_factory.mktemp("profile") / "match.rep")
+    ReplayGenerator(ticks=200, seed=2, damage_rate=10, chat_rate=2).write(replay_p)
+
+    with open(replay_p, "rb") as replay_f:
+        return replay_f.read()
+
+
+@pytest.fixture(scope="module")
+def profiled(replay_b):
+    profile = ParseProfile()
+
+    return Replay.parse(replay_b, engine="fast", profile=profile), profile
+
+
+def test_counts_every_tick_and_byte(replay_b, profiled):
+    replay, profile = profiled
+
+    assert profile.ticks == {"count": len(replay.ticks), "bytes": len(replay_b) - HEADER_SIZE}
+    assert sum(profile.chunks[kind]["bytes"] for kind in profile.chunks) < profile.ticks["bytes"]
+
+    for kind in ["prefabs", "entities", "brushes"]:
+        assert profile.chunks[kind]["count"] == sum(len(tickItems(tick, kind)) for tick in replay.ticks)
+
+
+def test_counts_entities_by_type(profiled):
+    replay, profile = profiled
+    expected = collections.defaultdict(collections.Counter)
+    types = {}
+
+    for tick in replay.ticks:
+        for chunk in tick.entityChunks:
+            for entity in chunk.entities:
+                # Destroys carry no entityType, the profile takes it from the lookups like the decoder does
+                entity_type = types.setdefault(entity.ent.id, entity.entityType) if entity.entityType is not None else types.pop(entity.ent.id)
+                counts = expected[entity_type]
+                counts["count"] += 1
+                counts["destroys" if entity.ent.destroy else "creates" if entity.m1.x1 else "updates"] += 1
+
+    assert {entity_type: {name: counts[name] for name in ["count", "creates", "updates", "destroys"]} for entity_type, counts in profile.types.items()} == \
+        {entity_type: {name: counts[name] for name in ["count", "creates", "updates", "destroys"]} for entity_type, counts in expected.items()}
+
+    for (entity_type, mask_name, bit), counts in profile.bits.items():
+        assert counts["bytes"] <= profile.types[entity_type]["bytes"]
+
+
+def test_merge_after_pickling(profiled):
+    replay, profile = profiled
+    merged = ParseProfile().merge(pickle.loads(pickle.dumps(profile))).merge(profile)
+
+    assert merged.ticks["count"] == 2 * profile.ticks["count"]
+    assert merged.report()["entity_types"] == [dict(counts, count=2 * counts["count"], bytes=2 * counts["bytes"],
+                                                    **{name: 2 * counts[name] for name in ["creates", "updates", "destroys", "seconds"] if name in counts})
+                                               for counts in profile.report()["entity_types"]]
@@ -0,0 +1,115 @@
+import numpy as np
+import pytest
+
+from replay_cache import ParseCache
+from replay_mesh import MapGeometry
+from replay_generate import ReplayGenerator, MAP_SIZE
+from replay_spatial import BrushIndex, brush_index
+
+
+@pytest.fixture(scope="module", params=[None, 64.0])
+def index(request, tmp_path_factory):
+    # The default cells and small ones, where most brushes are too big for the grid
+    replay_p = str(tmp_path_factory.mktemp("spatial") / "match.rep")
+    ReplayGenerator(ticks=2, brushes=300, prefabs=4, seed=3).write(replay_p)
+
+    return brush_index(replay_p, cell_size=request.param, cache=ParseCache(max_bytes=0))
+
+
+@pytest.fixture(scope="module")
+def rng():
+    return np.random.default_rng(5)
+
+
+def everything(index, n):
+    # Every (query, brush) pair, the candidates a brute force search would test
+    return np.repeat(np.arange(n), len(index)), np.tile(np.arange(len(index)), n)
+
+
+def pairs(query, brush):
+    return sorted(zip(query.tolist(), brush.tolist()))
+
+
+def randomPoints(rng, n):
+    points = rng.uniform(-MAP_SIZE - 200, MAP_SIZE + 200, (n, 3))
+    points[:5] = np.nan
+
+    return points
+
+
+def test_points_match_brute_force(index, rng):
+    points = randomPoints(rng, 3000)
+
+    # Points inside brushes are rare at random, put some in the middle of brushes too
+    points[-len(index):] = (index.lo + index.hi) / 2
+
+    assert pairs(*index.points(points)) == pairs(*index._inside(points, *everything(index, len(points))))
+
+
+def test_map_brushes_are_their_boxes(index, rng):
+    # The generator's own brushes are axis aligned boxes, inside one is inside its bounds
+    points = randomPoints(rng, 3000)
+    query, brush = index.points(points)
+    own = np.flatnonzero(index.geometry.brush_prefab == -1)
+
+    inside = (points[:, None] > index.lo[own]).all(axis=2) & (points[:, None] < index.hi[own]).all(axis=2)
+    expected = np.nonzero(inside)
+
+    mine = np.isin(brush, own)
+    assert pairs(query[mine], brush[mine]) == pairs(expected[0], own[expected[1]])
+
+
+def test_boxes_match_brute_force(index, rng):
+    lo = randomPoints(rng, 500)
+    hi = lo + rng.uniform(0, 600, (500, 3))
+
+    overlap = (index.lo[None] <= hi[:, None]).all(axis=2) & (index.hi[None] >= lo[:, None]).all(axis=2)
+
+    assert pairs(*index.boxes(lo, hi)) == pairs(*np.nonzero(overlap))
+
+
+def test_within_matches_brute_force(index, rng):
+    points = randomPoints(rng, 500)
+    radius = 300.0
+
+    gap = np.maximum(np.maximum(index.lo[None] - points[:, None], 0), points[:, None] - index.hi[None])
+    near = np.einsum("ijk,ijk->ij", gap, gap) <= radius * radius
+
+    assert pairs(*index.pairs_within(points, radius)) == pairs(*np.nonzero(near))
+
+
+@pytest.mark.parametrize("length", [np.inf, 700.0])
+def test_rays_match_brute_force(index, rng, length):
+    origins = randomPoints(rng, 1000)
+    directions = rng.normal(size=(1000, 3))
+
+    # Along the axes too, where the slabs divide by zero
+    directions[10:16] = np.vstack([np.eye(3), -np.eye(3)])
+    directions[16] = 0
+
+    # Random rays mostly miss on a sparse map, aim some at brushes
+    directions[-len(index):] = (index.lo + index.hi) / 2 - origins[-len(index):]
+
+    result, distance = index.rays(origins, directions, length)
+
+    with np.errstate(invalid="ignore"):
+        unit = directions / np.linalg.norm(directions, axis=1)[:, None]
+
+    query, brush = everything(index, len(origins))
+    valid = np.isfinite(origins[query]).all(axis=1) & np.isfinite(unit[query]).all(axis=1)
+    query, brush, t = index._hits(origins, unit, query[valid], brush[valid], length)
+    expected = np.full(len(origins), np.inf)
+    np.minimum.at(expected, query, t)
+
+    assert (result >= 0).sum() > 20
+    assert np.array_equal(distance, expected)
+
+    hit = np.flatnonzero(result >= 0)
+    assert set(zip(hit.tolist(), result[hit].tolist())) <= set(zip(query.tolist(), brush.tolist()))
+
+
+def test_empty_index():
+    index = BrushIndex(MapGeometry())
+
+    assert index.points_inside([[0, 0, 0]]).tolist() == [-1]
+    assert index.ray([0, 0, 0], [1, 0, 0]) == (-1, np.inf)
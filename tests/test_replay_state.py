@@ -0,0 +1,82 @@
+import pytest
+
+from replay import *
+from replay_generate import ReplayGenerator
+from replay_state import StateEngine, WorldState, FIELD_PLANS
+
+
+@pytest.fixture(scope="module")
+def replay_p(tmp_path_factory):
+    replay_p = str(tmp_path_factory.mktemp("state") / "match.rep")
+    ReplayGenerator(ticks=300, players=3, seed=8, projectile_rate=10, damage_rate=5, chat_rate=2).write(replay_p)
+
+    return replay_p
+
+
+@pytest.fixture(scope="module")
+def replay(replay_p):
+    with open(replay_p, "rb") as replay_f:
+        return Replay.parse(replay_f.read(), engine="fast")
+
+
+def snapshot(state):
+    return state.timecode, {entity_id: (entity.entity_type, entity.created, entity.prefab, entity.fields) for entity_id, entity in state.entities.items()}
+
+
+def folds(replay):
+    # The state after every tick, folded from the start
+    world = WorldState()
+
+    for tick in replay.ticks:
+        world.apply(tick)
+        yield tick.timecode, snapshot(world)
+
+
+@pytest.mark.parametrize("source", ["replay", "path"])
+@pytest.mark.parametrize("interval, budget", [(16, None), (16, 1)])
+def test_state_at_matches_fold(replay_p, replay, source, interval, budget):
+    kwargs = {} if budget is None else {"memory_budget": budget}
+    engine = StateEngine(replay if source == "replay" else replay_p, interval=interval, **kwargs)
+
+    if budget is not None:
+        # Over budget, every other keyframe was dropped until only the first is left
+        assert len(engine.keyframes) == 1 and engine.interval > interval
+
+    assert engine.timecodes == [tick.timecode for tick in replay.ticks]
+
+    for i, (timecode, expected) in enumerate(folds(replay)):
+        if i % 7 == 0 or i % interval in [0, interval - 1]:
+            assert snapshot(engine.state_at(timecode)) == expected
+
+    assert snapshot(engine.final) == expected
+
+
+def test_seek_streams_on(replay_p, replay):
+    engine = StateEngine(replay_p, interval=32)
+    timecode = replay.ticks[100].timecode
+
+    state, ticks = engine.seek(timecode)
+    rest = list(ticks)
+
+    assert state.timecode == replay.ticks[99].timecode
+    assert [tick.timecode for tick in rest] == [tick.timecode for tick in replay.ticks[100:]]
+
+    for tick in rest:
+        state.apply(tick)
+
+    assert snapshot(state) == snapshot(engine.final)
+
+
+def test_plans_rebuild_entities(replay):
+    # An entity built from the fields an update carries carries the same fields again
+    for tick in replay.ticks[1:50]:
+        for entity in tickItems(tick, "entities"):
+            plan = FIELD_PLANS.get(entity.entityType)
+
+            if entity.ent.destroy or plan is None or entity.fields is None:
+                continue
+
+            values = plan.present(entity)
+            rebuilt = plan.entity(entity.ent.id, entity.entityType, values, create=bool(entity.m1.x1))
+
+            assert plan.present(rebuilt) == values
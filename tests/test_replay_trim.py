@@ -0,0 +1,31 @@
+import io
+
+import pytest
+
+from replay import *
+from replay_generate import ReplayGenerator
+from replay_state import StateEngine
+from replay_trim import trim
+
+
+@pytest.fixture(scope="module")
+def replay_p(tmp_path_factory):
+    replay_p = str(tmp_path_factory.mktemp("trim") / "match.rep")
+    ReplayGenerator(ticks=500, players=2, projectile_rate=20, seed=6).write(replay_p)
+
+    return replay_p
+
+
+@pytest.mark.parametrize("start, end", [(1400, 1800), (0, 1100), (2003, 2005), (4900, 9000), (9000, 9100)])
+def test_single_pass_matches_engine(replay_p, start, end):
+    with open(replay_p, "rb") as replay_f:
+        replay = Replay.parse(replay_f.read(), engine="fast")
+
+    clips = []
+
+    for source, engine in [(replay_p, StateEngine(replay_p)), (replay_p, None), (replay, None)]:
+        f = io.BytesIO()
+        trim(source, start, end, f, engine)
+        clips.append(f.getvalue())
+
+    assert clips[0] == clips[1] == clips[2]
@@ -0,0 +1,53 @@
+import os
+
+import pytest
+
+import fast_replay
+from replay import *
+from replay_generate import ReplayGenerator
+from replay_verify import verify_bytes, verify_batch, locate, describe
+
+
+@pytest.fixture(scope="module")
+def replay_dir(tmp_path_factory):
+    replay_dir = tmp_path_factory.mktemp("verify")
+
+    for seed in range(3):
+        ReplayGenerator(ticks=60, seed=seed, damage_rate=5, chat_rate=2).write(str(replay_dir / ("%d.rep" % seed)))
+
+    return str(replay_dir)
+
+
+@pytest.fixture(scope="module")
+def data(replay_dir):
+    with open(os.path.join(replay_dir, "0.rep"), "rb") as replay_f:
+        return replay_f.read()
+
+
+@pytest.mark.parametrize("writer", [False, True])
+def test_generated_replays_round_trip(replay_dir, writer):
+    results = list(verify_batch([os.path.join(replay_dir, name) for name in os.listdir(replay_dir)], jobs=2, writer=writer))
+
+    assert len(results) == 3
+    assert all(result.ok and result.error is None and result.mismatch is None for result in results)
+
+
+def test_trailing_bytes_are_a_mismatch(data):
+    ok, error, mismatch = verify_bytes(data + b"\xff" * 3)
+
+    assert not ok and error is None
+    assert (mismatch.offset, mismatch.kind, mismatch.expected) == (len(data), "end", b"\xff" * 3)
+    assert "end of replay" in describe(mismatch)
+
+
+def test_locate_finds_the_entity(data):
+    lookups = ReplayLookups()
+    tick, off = fast_replay.decode_tick(data, HEADER_SIZE, lookups)
+    items, end = fast_replay.tick_layout(data, off, lookups)
+
+    kind, index, start, stop, entity_id, entity_type = [item for item in items if item[0] == "entity"][-1]
+    mismatch = locate(data, stop - 1, b"\x00")
+
+    assert (mismatch.kind, mismatch.tick, mismatch.index, mismatch.start, mismatch.end) == ("entity", 1, index, start, stop)
+    assert (mismatch.entity_id, mismatch.entity_type, mismatch.timecode) == (entity_id, entity_type, int.from_bytes(data[off:off + 4], "little"))
+    assert locate(data, 10).kind == "header"
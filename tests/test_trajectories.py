@@ -0,0 +1,67 @@
+import numpy as np
+import pytest
+
+from replay import *
+from replay_generate import ReplayGenerator
+from trajectories import extract_trajectories, save_trajectories, load_trajectories
+
+
+@pytest.fixture(scope="module")
+def replay_p(tmp_path_factory):
+    replay_p = str(tmp_path_factory.mktemp("trajectories") / "match.rep")
+    ReplayGenerator(ticks=150, players=3, seed=4).write(replay_p)
+
+    return replay_p
+
+
+@pytest.fixture(scope="module")
+def replay(replay_p):
+    with open(replay_p, "rb") as replay_f:
+        return Replay.parse(replay_f.read(), engine="fast")
+
+
+def test_rows_match_player_updates(replay):
+    trajectories = extract_trajectories(replay)
+    players = {}
+
+    for tick in replay.ticks:
+        for entity in tickItems(tick, "entities"):
+            if entity.entityType == 0x02 and not entity.ent.destroy and entity.fields.position is not None:
+                players.setdefault(entity.ent.id, []).append((tick.timecode, entity.fields.position))
+
+    assert sorted(trajectories) == sorted(players)
+
+    for entity_id, rows in players.items():
+        columns = trajectories[entity_id]
+        has = columns["has_position"]
+
+        assert columns["timecode"][has].tolist() == [timecode for timecode, position in rows]
+        assert np.array_equal(columns["position"][has], np.array([[position.x, position.y, position.z] for timecode, position in rows], np.float32))
+        assert np.isnan(columns["position"][~has]).all()
+
+
+def test_streaming_matches_parsed(replay_p, replay):
+    streamed = extract_trajectories(iter_ticks(replay_p, engine="fast", entity_types={0x02}, prefabs=False, brushes=False))
+    parsed = extract_trajectories(replay)
+
+    assert sorted(streamed) == sorted(parsed)
+
+    for entity_id, columns in parsed.items():
+        for name, column in columns.items():
+            assert np.array_equal(streamed[entity_id][name], column, equal_nan=column.dtype.kind == "f")
+
+
+def test_npz_round_trip(tmp_path, replay):
+    trajectories = extract_trajectories(replay)
+    npz_p = str(tmp_path / "match.npz")
+    save_trajectories(npz_p, trajectories)
+    loaded = load_trajectories(npz_p)
+
+    assert sorted(loaded) == sorted(trajectories)
+
+    for entity_id, columns in trajectories.items():
+        assert sorted(loaded[entity_id]) == sorted(columns)
+
+        for name, column in columns.items():
+            assert loaded[entity_id][name].dtype == column.dtype
+            assert np.array_equal(loaded[entity_id][name], column, equal_nan=column.dtype.kind == "f")
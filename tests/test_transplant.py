@@ -0,0 +1,61 @@
+import struct
+
+import pytest
+
+from replay import *
+from replay_generate import ReplayGenerator
+from transplant import transplant_wrapper
+
+
+@pytest.fixture(autouse=True)
+def noCache(monkeypatch):
+    # Keep load_replay out of ~/.cache
+    monkeypatch.setenv("REPLAY_CACHE_SIZE", "0")
+
+
+def writeReplay(path, first_timecode=None, **parameters):
+    # A generated replay, with the first tick's timecode overwritten if first_timecode is given
+    ReplayGenerator(**parameters).write(path)
+
+    if first_timecode is not None:
+        with open(path, "r+b") as f:
+            f.seek(HEADER_SIZE)
+            f.write(struct.pack("<I", first_timecode))
+
+    return path
+
+
+@pytest.mark.parametrize("donor_timecode, recipient_timecode", [(None, None), (None, 0), (0, None), (0, 0)])
+def test_splice_matches_transplant(tmp_path, donor_timecode, recipient_timecode):
+    # A first tick with a timecode of 0 is skipped by getReferencedEntityIds and refactorChangeEntityIds
+    donor_p = writeReplay(str(tmp_path / "donor.rep"), donor_timecode, ticks=200, players=2, seed=1)
+    recipient_p = writeReplay(str(tmp_path / "recipient.rep"), recipient_timecode, ticks=200, players=3, projectile_rate=20,
+                              damage_rate=20, chat_rate=5, vote_rate=5, seed=2)
+
+    transplant_wrapper(donor_p, recipient_p, str(tmp_path / "classic.rep"))
+    transplant_wrapper(donor_p, recipient_p, str(tmp_path / "splice.rep"), splice=True)
+
+    with open(tmp_path / "classic.rep", "rb") as classic_f, open(tmp_path / "splice.rep", "rb") as splice_f:
+        classic_b = classic_f.read()
+        assert classic_b == splice_f.read()
+
+    # Every initial entity got an ID of its own, the donor's included
+    replay = Replay.parse(classic_b, engine="fast")
+    ids = [entity.ent.id for entity in tickItems(replay.ticks[0], "entities")]
+
+    assert len(ids) == len(set(ids))
+
+
+def test_referenced_ids_skip_timecode_0(tmp_path):
+    recipient_p = writeReplay(str(tmp_path / "recipient.rep"), 0, ticks=50, players=2, seed=2)
+
+    with open(recipient_p, "rb") as f:
+        replay = Replay.parse(f.read())
+
+    # The creates in the first tick don't count, the cameraPath included
+    ids = getReferencedEntityIds(replay)
+    camera_paths = [entity.ent.id for entity in allInitialEntities(replay) if entity.entityType == 0x0F]
+
+    assert camera_paths and not set(camera_paths) & set(ids)
+    assert ids == list(dict.fromkeys(entity.ent.id for tc, entity in allEntities(replay)
+                                     if entity.entityType != 0x00 and (entity.ent.destroy or not entity.m1.x1 or entity.entityType == 0x0F)))
@@ -0,0 +1,143 @@
+import os
+import sys
+import array
+
+import numpy as np
+
+from replay import *
+from replay_profile import ParseProfile
+
+# Columnar per-player trajectories
+#
+#   trajectories = extract_trajectories(iter_ticks("match.rep", engine="fast"))
+#   save_trajectories("match.npz", trajectories)
+#
+# One pass over the ticks (a parsed replay's .ticks or a streaming iter_ticks both work). Every Player
+# update that carries at least one of the tracked fields becomes a row. Fields an update doesn't carry
+# are NaN (floats) or 0 (ints), and has_<field> says which rows actually have them:
+#
+#   timecode        (n,)   uint32   tick timecode
+#   position        (n, 3) float32
+#   velocity        (n, 3) float32
+#   viewAngle       (n, 2) int32    ViewAngle32l x (uint16), y (int16)
+#   cameraRotation  (n, 3) float32
+#   input           (n,)   uint8    InputMask bits
+#
+# Usage: python trajectories.py match.rep [match.npz]
+
+FIELDS = ["position", "velocity", "viewAngle", "cameraRotation", "input"]
+
+_INPUT_FLAGS = list(InputMask.flags.items())
+
+
+class _Columns:
+    def __init__(self):
+        self.timecode = array.array("I")
+        self.position = array.array("f")
+        self.velocity = array.array("f")
+        self.viewAngle = array.array("i")
+        self.cameraRotation = array.array("f")
+        self.input = array.array("B")
+        self.present = array.array("B") # One byte per row, bit i set if FIELDS[i] is present
+
+    def arrays(self):
+        present = np.frombuffer(self.present, dtype=np.uint8)
+
+        columns = {
+            "timecode": np.frombuffer(self.timecode, dtype=np.uint32),
+            "position": np.frombuffer(self.position, dtype=np.float32).reshape(-1, 3),
+            "velocity": np.frombuffer(self.velocity, dtype=np.float32).reshape(-1, 3),
+            "viewAngle": np.frombuffer(self.viewAngle, dtype=np.int32).reshape(-1, 2),
+            "cameraRotation": np.frombuffer(self.cameraRotation, dtype=np.float32).reshape(-1, 3),
+            "input": np.frombuffer(self.input, dtype=np.uint8),
+        }
+
+        for i, field in enumerate(FIELDS):
+            columns["has_" + field] = (present & (1 << i)) != 0
+
+        return columns
+
+
+_NAN3 = [float("nan")] * 3
+
+
+def extract_trajectories(ticks):
+    # Returns {entity id: {column: ndarray}} for every Player entity, see above for the columns.
+    # ticks may also be a whole replay.
+    if isinstance(ticks, dict):
+        ticks = ticks.ticks
+
+    players = {}
+
+    for tick in ticks:
+        timecode = tick.timecode
+
+        for chunk in tick.entityChunks:
+            for entity in chunk.entities:
+                if entity.entityType != 0x02 or entity.ent.destroy:
+                    continue
+
+                fields = entity.fields
+                position = fields.position
+                velocity = fields.velocity
+                viewAngle = fields.viewAngle
+                cameraRotation = fields.cameraRotation
+                input = fields.input
+
+                present = ((position is not None) | (velocity is not None) << 1 | (viewAngle is not None) << 2 |
+                           (cameraRotation is not None) << 3 | (input is not None) << 4)
+
+                if not present:
+                    continue
+
+                columns = players.get(entity.ent.id)
+                if columns is None:
+                    columns = players[entity.ent.id] = _Columns()
+
+                columns.timecode.append(timecode)
+                columns.present.append(present)
+                columns.position.extend(_NAN3 if position is None else (position.x, position.y, position.z))
+                columns.velocity.extend(_NAN3 if velocity is None else (velocity.x, velocity.y, velocity.z))
+                columns.viewAngle.extend((0, 0) if viewAngle is None else (viewAngle.x, viewAngle.y))
+                columns.cameraRotation.extend(_NAN3 if cameraRotation is None else (cameraRotation.x, cameraRotation.y, cameraRotation.z))
+                columns.input.append(0 if input is None else sum(value for name, value in _INPUT_FLAGS if input[name]))
+
+    return {entity_id: columns.arrays() for entity_id, columns in players.items()}
+
+
+def save_trajectories(npz_p, trajectories):
+    # Flattened to "<entity id>/<column>" keys, np.load(npz_p)["3/position"]
+    np.savez_compressed(npz_p, **{"%d/%s" % (entity_id, name): column
+                                  for entity_id, columns in trajectories.items() for name, column in columns.items()})
+
+
+def load_trajectories(npz_p):
+    trajectories = {}
+
+    with np.load(npz_p) as npz:
+        for key in npz.files:
+            entity_id, name = key.split("/", 1)
+            trajectories.setdefault(int(entity_id), {})[name] = npz[key]
+
+    return trajectories
+
+
+if __name__ == "__main__":
+    # --profile also prints where the replay's bytes and parse time went, see replay_profile.py
+    profile = ParseProfile() if "--profile" in sys.argv else None
+    sys.argv = [arg for arg in sys.argv if arg != "--profile"]
+
+    replay_p = sys.argv[1]
+    npz_p = sys.argv[2] if len(sys.argv) > 2 else os.path.splitext(replay_p)[0] + ".npz"
+
+    trajectories = extract_trajectories(iter_ticks(replay_p, engine="fast", entity_types={0x02}, prefabs=False, brushes=False, profile=profile))
+    save_trajectories(npz_p, trajectories)
+
+    for entity_id, columns in trajectories.items():
+        print("Player", entity_id, len(columns["timecode"]), "updates")
+
+    print("Saved to", npz_p)
+
+    if profile is not None:
+        print()
+        profile.print()
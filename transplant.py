@@ -3,9 +3,15 @@ import re
 import sys
 
 import copy
+import mmap
+import array
+import struct
 import datetime
+import collections
 
+import fast_replay
 from replay import *
+from replay_cache import load_replay
 
 
 def extract_player_info(replay):
@@ -46,16 +52,17 @@ def extract_player_info(replay):
     return info
 
 
-def transplant_wrapper(donor_p, recipient_p, write_p):
+def transplant_wrapper(donor_p, recipient_p, write_p, splice=False, engine="construct", cache=None):
+    # engine and cache are passed on to load_replay. Both replays come with their lifetime tables, so
+    # transplant() doesn't have to walk them again.
+    if splice:
+        return transplant_splice(donor_p, recipient_p, write_p, engine, cache)
+
     print("Reading donor replay")
-    with open(donor_p, "rb") as donor_f:
-        donor_d = bytearray(donor_f.read())
-    donor = Replay.parse(donor_d)
+    donor = load_replay(donor_p, engine, cache, lifetimes=True)
 
     print("Reading recipient replay")
-    with open(recipient_p, "rb") as recipient_f:
-        recipient_d = bytearray(recipient_f.read())
-    recipient = Replay.parse(recipient_d)
+    recipient = load_replay(recipient_p, engine, cache, lifetimes=True)
 
     out = transplant(donor, recipient)
 
@@ -65,32 +72,262 @@ def transplant_wrapper(donor_p, recipient_p, write_p):
 
     print("Building and writing edited replay")
 
-    with open(write_p, "wb+") as write_f:
-        write_f.write(build(out))
+    write_replay(write_p, out)
 
     return out
 
 
+def transplant_splice(donor_p, recipient_p, write_p, engine="construct", cache=None):
+    # Same result as transplant_wrapper, but only the recipient's first tick is decoded and rebuilt.
+    # Every later tick is copied over byte for byte, except for the entity IDs transplanting changes:
+    # entity headers and brush attachments are patched in place, and only entities with references to
+    # other entities (see ENTITY_REFERENCE_FIELDS) are decoded and built again.
+    print("Reading donor replay")
+    donor = load_replay(donor_p, engine, cache, lifetimes=True)
+
+    print("Scanning recipient replay")
+    with open(recipient_p, "rb") as recipient_f, mmap.mmap(recipient_f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        header, off = fast_replay.decode_header(buf)
+
+        lookups = ReplayLookups()
+        tick0, ticks_off = fast_replay.decode_tick(buf, off, lookups)
+
+        rec_keep_ent_ids = set()
+        rec_prefabs = {}
+        rec_tail_creates = []
+
+        # Mirrors getReferencedEntityIds, allPrefabs and allEntities(after=tick0.timecode) in transplant()
+        if tick0.timecode > 0:
+            for chunk in tick0.prefabChunks:
+                for prefab in chunk.prefabs:
+                    rec_prefabs[prefab.prefabName] = prefab
+
+            for chunk in tick0.entityChunks:
+                for entity in chunk.entities:
+                    if entity.entityType != 0x00 and (entity.ent.destroy or not entity.m1.x1 or entity.entityType == 0x0F):
+                        rec_keep_ent_ids.add(entity.ent.id)
+
+        # The only pass over the later ticks, what has to be patched in them is remembered on the way
+        sites = SpliceSites(ticks_off)
+
+        for tick, tick_off, end in scanTicks(buf, ticks_off, lookups):
+            sites.end = end
+
+            if tick.timecode <= 0:
+                continue
+
+            sites.add_tick(buf, tick)
+
+            for chunk in tick.prefabChunks:
+                for prefab in chunk.prefabs:
+                    rec_prefabs[prefab.prefabName] = prefab
+
+            for chunk in tick.entityChunks:
+                for span in chunk.entities:
+                    start, unused, entity_id, destroy, create, entity_type = span
+
+                    if destroy:
+                        rec_keep_ent_ids.add(entity_id)
+                    elif entity_type != 0x00 and (not create or entity_type == 0x0F):
+                        rec_keep_ent_ids.add(entity_id)
+
+                    if create and tick.timecode > tick0.timecode:
+                        prefab_name = fast_replay.decode_span(buf, span).fields.prefabName if entity_type == 0x15 else None
+                        rec_tail_creates.append((entity_id, entity_type, prefab_name))
+
+        new_entities, rec_id_changes, donor_id_changes = planEntityIds(donor, rec_keep_ent_ids, allInitialEntities(Container(ticks=[tick0])), rec_prefabs, rec_tail_creates)
+
+        # Only the initial entities are refactored here, the later ticks are patched while they're copied
+        refactorChangeEntityIdsRaw(rec_id_changes, [(tick0.timecode, entity) for chunk in tick0.entityChunks for entity in chunk.entities], [])
+        refactorChangeEntityIds(donor_id_changes, donor)
+        refactorFirstTick(donor_id_changes, donor)
+
+        print("Converting new entities to chunks")
+
+        tick0 = Container(timecode=tick0.timecode, prefabChunks=donor.ticks[0].prefabChunks,
+                          entityChunks=entityChunks(new_entities, donor, rec_prefabs), brushChunks=donor.ticks[0].brushChunks)
+
+        all_prefabs = donorPrefabs(donor)
+        all_prefabs.update(rec_prefabs)
+
+        # Set workshopId to 0, see transplant_wrapper
+        header_b = bytearray(buf[:off])
+        struct.pack_into("<Q", header_b, _WORKSHOP_ID_OFFSET, 0)
+
+        print("Splicing and writing edited replay")
+
+        with open(write_p, "wb+") as write_f:
+            write_f.write(header_b)
+            write_f.write(Tick.build(tick0, lookups=ReplayLookups(prefabs={name: prefab.entities for name, prefab in all_prefabs.items()})))
+            write_f.writelines(sites.splice(buf, rec_id_changes))
+
+
+# Byte offsets of the fields that splicing patches in place
+_WORKSHOP_ID_OFFSET = 24 # ReplayHeader.workshopId
+_BRUSH_ATTACHED_TO_OFFSET = 13 # Brush.entityIdAttachedTo
+
+_COPY_BLOCK = 1 << 20
+
+
+def scanTicks(buf, off, lookups):
+    # Yields (tick, start, end) for every tick from fast_replay.scan_tick, stopping at the first one that
+    # fails like GreedyRange(Tick) does
+    while True:
+        try:
+            tick, end = fast_replay.scan_tick(buf, off, lookups)
+        except Exception:
+            return
+
+        yield tick, off, end
+        off = end
+
+
+def copyRange(buf, start, stop):
+    # buf[start:stop] in blocks, so a long untouched stretch of a mapped replay isn't read into memory at once
+    for off in range(start, stop, _COPY_BLOCK):
+        yield buf[off:min(off + _COPY_BLOCK, stop)]
+
+
+class SpliceSites:
+    # Every entity and brush in the recipient's ticks after the first, in file order, as recorded by
+    # add_tick while transplant_splice scans them. splice() then patches them without a second scan.
+    # Array columns, since a long replay has millions of entity updates:
+    #   starts, stops   the entity's span (see fast_replay.scan_entity), for brushes where the brush starts
+    #   ids             entity ID, for brushes the entityIdAttachedTo
+    #   kinds           entityType (UNKNOWN_TYPE if the scan didn't know it) | DESTROY | CREATE, or BRUSH
+    UNKNOWN_TYPE = 0xFF
+    DESTROY = 0x100
+    CREATE = 0x200
+    BRUSH = 0x400
+
+    def __init__(self, start):
+        self.start = start # Where the ticks after the first start
+        self.end = start # Where the last tick that parses ends
+        self.starts = array.array("Q")
+        self.stops = array.array("Q")
+        self.ids = array.array("I")
+        self.kinds = array.array("H")
+
+    def add_tick(self, buf, tick):
+        # Ticks with a timecode of 0 aren't added, like refactorChangeEntityIds(after=0) skips them
+        for chunk in tick.entityChunks:
+            for start, stop, entity_id, destroy, create, entity_type in chunk.entities:
+                self.starts.append(start)
+                self.stops.append(stop)
+                self.ids.append(entity_id)
+                self.kinds.append((self.UNKNOWN_TYPE if entity_type is None else entity_type) | (self.DESTROY if destroy else 0) | (self.CREATE if create else 0))
+
+        for chunk in tick.brushChunks:
+            for start, stop in chunk.brushes:
+                self.starts.append(start)
+                self.stops.append(stop)
+                self.ids.append(struct.unpack_from("<I", buf, start + _BRUSH_ATTACHED_TO_OFFSET)[0])
+                self.kinds.append(self.BRUSH)
+
+    def splice(self, buf, changes):
+        # Yields the pieces of buf[start:end] with changes applied to every entity and brush in it
+        copied = self.start
+
+        for start, stop, entity_id, kind in zip(self.starts, self.stops, self.ids, self.kinds):
+            if kind == self.BRUSH:
+                if entity_id in changes:
+                    yield from copyRange(buf, copied, start + _BRUSH_ATTACHED_TO_OFFSET)
+                    yield struct.pack("<I", changes[entity_id])
+                    copied = start + _BRUSH_ATTACHED_TO_OFFSET + 4
+
+                continue
+
+            destroy = 1 if kind & self.DESTROY else 0
+            entity_type = kind & 0xFF
+
+            if not destroy and (entity_type in ENTITY_REFERENCE_FIELDS or (entity_type == 0x15 and entity_id in changes)):
+                entity = fast_replay.decode_span(buf, (start, stop, entity_id, destroy, bool(kind & self.CREATE), entity_type))
+                before = copy.deepcopy(entity)
+
+                refactorChangeEntityIdsRaw(changes, [(None, entity)], [])
+
+                if entity != before:
+                    yield from copyRange(buf, copied, start)
+                    yield Entity.build(entity, lookups=ReplayLookups({entity.ent.id: entity_type}, collections.defaultdict(list)))
+                    copied = stop
+
+            elif entity_id in changes:
+                yield from copyRange(buf, copied, start)
+                yield struct.pack("<I", changes[entity_id] << 1 | destroy)
+                copied = start + 4
+
+        yield from copyRange(buf, copied, self.end)
+
+
+def refactorFirstTick(changes, replay):
+    # refactorChangeEntityIds skips a first tick with a timecode of 0, the initial entities (and the brushes
+    # attached to them) still need their IDs changed then. Both sides of a transplant go through this.
+    tick = replay.ticks[0]
+
+    if tick.timecode <= 0:
+        refactorChangeEntityIdsRaw(changes, [(tick.timecode, entity) for entity in tickItems(tick, "entities")],
+                                   [(tick.timecode, brush) for brush in tickItems(tick, "brushes")])
+
+
+def donorPrefabs(donor):
+    # {prefabName: Prefab} of every prefab the donor defines, like allPrefabs but including a first tick with
+    # a timecode of 0 (the donor's map is in there either way)
+    return {prefab.prefabName:prefab for tick in donor.ticks for prefab in tickItems(tick, "prefabs")}
+
+
 def transplant(donor, recipient):
+    # Just a lookup for replays parsed with lifetimes=True
+    rec_lifetimes = entityLifetimes(recipient)
+    rec_keep_ent_ids = getReferencedEntityIds(recipient, rec_lifetimes)
+    rec_prefabs = {prefab.prefabName:prefab for tc, prefab in allPrefabs(recipient)}
+
+    # All that matters about tail entities is that they are created after the first tick
+    rec_tail_creates = rec_lifetimes.creates_after(recipient.ticks[0].timecode)
+
+    new_entities, rec_id_changes, donor_id_changes = planEntityIds(donor, rec_keep_ent_ids, allInitialEntities(recipient, rec_lifetimes), rec_prefabs, rec_tail_creates)
+
+    # Refactor the initial replay objects
+    # This will refactor all entities in new_entities, since they were passed by reference
+    refactorChangeEntityIds(rec_id_changes, recipient)
+    refactorChangeEntityIds(donor_id_changes, donor)
+    refactorFirstTick(rec_id_changes, recipient)
+    refactorFirstTick(donor_id_changes, donor)
+
+    print("Changing initial prefab and brush chunks")
+
+    recipient.ticks[0].prefabChunks = donor.ticks[0].prefabChunks
+    recipient.ticks[0].brushChunks = donor.ticks[0].brushChunks
+
+    print("Converting new entities to chunks")
+
+    recipient.ticks[0].entityChunks = entityChunks(new_entities, donor, rec_prefabs)
+
+    # DEBUG: Limit number of ticks to diagnose crash
+    #recipient.ticks = recipient.ticks[:1255]
+
+    return recipient
+
+
+def planEntityIds(donor, rec_keep_ent_ids, rec_initial_entities, rec_prefabs, rec_tail_creates):
+    # Decides which initial entities end up in the transplanted replay and which IDs they get.
+    # Returns (new_entities, rec_id_changes, donor_id_changes), nothing is modified yet.
+
     # The recipient will keep all initial entities that are updated by packets later on
-    rec_keep_ent_ids = getReferencedEntityIds(recipient)
-    rec_ents = {entity.ent.id:entity for entity in allInitialEntities(recipient) if entity.ent.id in rec_keep_ent_ids}
+    rec_ents = {entity.ent.id:entity for entity in rec_initial_entities if entity.ent.id in rec_keep_ent_ids}
 
     # We will keep track of any ID changes that will be made to the entities that the recipient will keep
     rec_id_changes = {}
 
-    # We also have to know all prefabs
-    rec_prefabs = {prefab.prefabName:prefab for tc, prefab in allPrefabs(recipient)}
-
     # The donor will donate all entities that are not updated by packets later on TODO: Why not all entities except the obvious no-gos?
-    donor_keep_ent_ids = getReferencedEntityIds(donor)
-    donor_ents = {entity.ent.id:entity for entity in allInitialEntities(donor) if entity.ent.id not in donor_keep_ent_ids}
+    donor_lifetimes = entityLifetimes(donor)
+    donor_keep_ent_ids = getReferencedEntityIds(donor, donor_lifetimes)
+    donor_ents = {entity.ent.id:entity for entity in allInitialEntities(donor, donor_lifetimes) if entity.ent.id not in donor_keep_ent_ids}
 
     # We will also keep track of any ID changes that will be made to the entities that the donor will donate
     donor_id_changes = {}
 
     # We also have to know all prefabs at all times
-    donor_prefabs = {prefab.prefabName:prefab for tc, prefab in allPrefabs(donor)}
+    donor_prefabs = donorPrefabs(donor)
 
     num_entities_total = len(rec_ents.keys()) + len(donor_ents.keys())
     new_entities = []
@@ -149,44 +386,32 @@ def transplant(donor, recipient):
     # Adjust tail entities
     # All that matters is that these entities are created after the first tick
     # ALL of those entities need to be adjusted
-    for tc, entity in allEntities(recipient, recipient.ticks[0].timecode):
-        if not entity.ent.destroy and entity.m1.x1:
-            rec_id_changes[entity.ent.id] = id
+    for entity_id, entity_type, prefab_name in rec_tail_creates:
+        rec_id_changes[entity_id] = id
 
-            # Adjust ID for next entity
-            if entity.entityType == 0x15: # Prefab
-                id += rec_prefabs[entity.fields.prefabName].numEntities
+        # Adjust ID for next entity
+        if entity_type == 0x15: # Prefab
+            id += rec_prefabs[prefab_name].numEntities
 
-            id += 1
+        id += 1
 
-    # Refactor the initial replay objects
-    # This will refactor all entities in new_entities, since they were passed by reference
-    refactorChangeEntityIds(rec_id_changes, recipient)
-    refactorChangeEntityIds(donor_id_changes, donor)
+    return new_entities, rec_id_changes, donor_id_changes
 
-    print("Changing initial prefab and brush chunks")
-
-    recipient.ticks[0].prefabChunks = donor.ticks[0].prefabChunks
-    recipient.ticks[0].brushChunks = donor.ticks[0].brushChunks
-
-    recipient.ticks[0].entityChunks = []
-
-    print("Converting new entities to chunks")
 
+def entityChunks(new_entities, donor, rec_prefabs):
     # Convert new_entities to chunks...
-    while len(new_entities) > 0xFF:
-        recipient.ticks[0].entityChunks.append(TickEntityChunk.parse(TickEntityChunk.build({"amount": 0xFF, "entities": new_entities[:0xFF]})))
-        new_entities = new_entities[0xFF:]
+    # They're all creates, so the only types that have to be known up front are the prefabs' sub-entities
+    donor_prefabs = donorPrefabs(donor)
+    lookups = ReplayLookups(prefabs={name: prefab.entities for name, prefab in {**donor_prefabs, **rec_prefabs}.items()})
 
-    recipient.ticks[0].entityChunks.append(TickEntityChunk.parse(TickEntityChunk.build({"amount": len(new_entities), "entities": new_entities})))
-
-    # DEBUG: Limit number of ticks to diagnose crash
-    #recipient.ticks = recipient.ticks[:1255]
-
-    return recipient
+    return [TickEntityChunk.parse(TickEntityChunk.build(chunk, lookups=lookups), lookups=lookups) for chunk in makeChunks(new_entities, "entities")]
 
 
 if __name__ == "__main__":
+    # --splice copies the recipient's ticks byte for byte instead of parsing and building them
+    splice = "--splice" in sys.argv
+    sys.argv = [arg for arg in sys.argv if arg != "--splice"]
+
     if len(sys.argv) == 4:
         donor_p = sys.argv[1]
         recipient_p = sys.argv[2]
@@ -207,4 +432,4 @@ if __name__ == "__main__":
 
         out_p = os.path.join(os.path.dirname(recipient_p), out_name)
 
-    transplant_wrapper(donor_p, recipient_p, out_p)
+    transplant_wrapper(donor_p, recipient_p, out_p, splice)